@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#
+# Copyright © 2015 OnlineGroups.net and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+############################################################################
+'''A summary of the recent activity in each group
+
+The summary is kept up to date as posts are stored (see the
+``record_activity`` option of ``EmailMessageStore``), so a digest or the
+home page of a group can show the recent activity without reading the
+``post`` table. It is kept in memory, so each process has the summary of
+the posts that it has stored since it started.'''
+from __future__ import absolute_import, unicode_literals
+from collections import OrderedDict
+from threading import Lock
+
+#: The number of days that the posts are counted for
+DAYS = 31
+#: The number of topics that are kept for each group
+TOPICS = 20
+#: The number of authors that are kept for each group
+AUTHORS = 50
+
+
+class GroupActivity(object):
+    '''The recent activity in one group
+
+:param int days: The number of days that the posts are counted for.
+:param int topics: The number of recently active topics to keep.
+:param int authors: The number of recent authors to keep.
+
+Each part of the summary is a bounded ring: the oldest day, topic or
+author is dropped when a new one is added.'''
+
+    def __init__(self, days=DAYS, topics=TOPICS, authors=AUTHORS):
+        self.maxDays = days
+        self.maxTopics = topics
+        self.maxAuthors = authors
+        self.days = OrderedDict()
+        self.topics = OrderedDict()
+        self.authors = OrderedDict()
+
+    @staticmethod
+    def push(ring, key, value, size):
+        'Add an item to the end of a ring, dropping the oldest if it is full'
+        ring.pop(key, None)
+        ring[key] = value
+        while len(ring) > size:
+            ring.popitem(last=False)
+
+    def add(self, topicId, subject, userId, date):
+        '''Add a post to the summary
+
+:param str topicId: The identifier of the topic.
+:param str subject: The subject of the post.
+:param str userId: The identifier of the author.
+:param datetime date: The date of the post.'''
+        day = date.date()
+        if day in self.days:
+            self.days[day] += 1
+        else:
+            self.days[day] = 1
+            # The posts may not arrive in order, so the days are sorted
+            self.days = OrderedDict(sorted(self.days.items()))
+            while len(self.days) > self.maxDays:
+                self.days.popitem(last=False)
+
+        topic = self.topics.get(topicId, {'topic_id': topicId,
+                                          'subject': subject,
+                                          'posts': 0})
+        topic['posts'] += 1
+        topic['last_post_date'] = date
+        self.push(self.topics, topicId, topic, self.maxTopics)
+
+        author = self.authors.get(userId, {'user_id': userId, 'posts': 0})
+        author['posts'] += 1
+        author['last_post_date'] = date
+        self.push(self.authors, userId, author, self.maxAuthors)
+
+    def summary(self):
+        '''The summary of the activity
+
+:returns: The ``posts_per_day`` as ``(date, count)`` tuples (the oldest
+          first), and the ``topics`` and ``authors`` (the most recent
+          first).
+:rtype: dict'''
+        retval = {
+            'posts_per_day': list(self.days.items()),
+            'topics': [dict(t) for t in reversed(self.topics.values())],
+            'authors': [dict(a) for a in reversed(self.authors.values())], }
+        return retval
+
+
+class ActivitySummary(object):
+    '''The recent activity in every group, for the posts stored by this
+process'''
+
+    def __init__(self):
+        self.groups = {}
+        self.lock = Lock()
+
+    def record(self, siteId, groupId, topicId, subject, userId, date):
+        '''Add a post to the summary for its group
+
+:param str siteId: The identifier of the site.
+:param str groupId: The identifier of the group.
+:param str topicId: The identifier of the topic.
+:param str subject: The subject of the post.
+:param str userId: The identifier of the author.
+:param datetime date: The date of the post.'''
+        key = (siteId, groupId)
+        with self.lock:
+            if key not in self.groups:
+                self.groups[key] = GroupActivity()
+            self.groups[key].add(topicId, subject, userId, date)
+
+    def get(self, siteId, groupId):
+        '''Get the summary for a group
+
+:param str siteId: The identifier of the site.
+:param str groupId: The identifier of the group.
+:returns: The summary, from ``GroupActivity.summary``, which is empty if
+          no posts to the group have been stored.
+:rtype: dict'''
+        with self.lock:
+            activity = self.groups.get((siteId, groupId), GroupActivity())
+            retval = activity.summary()
+        return retval
+
+    def clear(self):
+        with self.lock:
+            self.groups.clear()
+
+
+#: The summary of the activity for this process
+activitySummary = ActivitySummary()
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#
+# Copyright © 2015 OnlineGroups.net and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+############################################################################
+'''Store posts from an asyncio service, without Zope
+
+The ``AsyncStorage`` writes the same rows as ``EmailMessageStorageQuery``
+and ``FileMetadataStorageQuery``, with the same statements (from
+``statements``), but over the asyncio extension to SQLAlchemy and the
+``asyncpg`` driver, so an intake service can have many deliveries in
+flight sharing a pool of connections. It needs Python 3, and PostgreSQL
+(or SQLite, with the ``aiosqlite`` driver, which the tests use).
+
+Only the rows in the relational database are written: the attachments
+themselves are stored in the ZODB by ``EmailMessageStore``.'''
+from __future__ import absolute_import, unicode_literals
+import asyncio
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import create_async_engine
+from .statements import (
+    DuplicateMessageError, file_insert_marking_posts, post_insert_new,
+    post_topics, rebuild_topics, topic_key, topic_upsert, topic_values,
+    unmarked_posts)
+
+
+class AsyncStorage(object):
+    '''Store posts using a pool of asynchronous connections
+
+:param str dsn: The URL of the database, such as
+                ``postgresql+asyncpg://groupserver@localhost/groupserver``.
+:param int poolSize: The number of connections in the pool, or ``None``
+                     for the default of the driver.
+
+Each method takes a connection from the pool for one transaction. Call
+``close`` when the service stops.'''
+
+    #: The tables that are written
+    tableNames = ('post', 'topic', 'file')
+
+    def __init__(self, dsn, poolSize=20):
+        kw = {} if poolSize is None else {'pool_size': poolSize}
+        self.engine = create_async_engine(dsn, **kw)
+        self.dialect = self.engine.dialect.name
+        self.tables = {}
+        # The lock is created by get_tables, so it belongs to the event loop
+        # that is running (rather than the one that is current now, before
+        # Python 3.10).
+        self.tablesLock = None
+
+    async def get_tables(self):
+        '''Look up the tables, the first time they are needed'''
+        if self.tablesLock is None:
+            self.tablesLock = asyncio.Lock()
+        async with self.tablesLock:
+            if not self.tables:
+                metadata = sa.MetaData()
+                async with self.engine.connect() as connection:
+                    await connection.run_sync(metadata.reflect,
+                                              only=self.tableNames)
+                self.tables = dict(metadata.tables)
+        return self.tables
+
+    async def insert(self, post, metadata=()):
+        '''Add a post, add it to its topic, and add its file-metadata
+
+:param dict post: The values for the row in the ``post`` table (from
+                  ``gs.group.list.store.statements.post_values``).
+:param list metadata: The rows for the ``file`` table for the attachments
+                      of the post, which have already been stored.
+:raises DuplicateMessageError: The post is already in the database.
+
+The rows are written in one transaction, which is rolled back if the post
+is a duplicate.'''
+        tables = await self.get_tables()
+        async with self.engine.begin() as connection:
+            i = post_insert_new(tables['post'], self.dialect,
+                                returning=False)
+            r = await connection.execute(i, post)
+            if r.rowcount == 0:
+                m = 'Post id "{0}" already existed in database.'
+                raise DuplicateMessageError(m.format(post['post_id']))
+            u = topic_upsert(tables['topic'], self.dialect)
+            await connection.execute(u, topic_values(post))
+            if metadata:
+                await self.execute_insert_metadata(connection, metadata)
+
+    async def insert_metadata(self, metadata):
+        '''Add the metadata for the files, and mark the posts as having
+attachments
+
+:param list metadata: The rows for the ``file`` table, for any number of
+                      posts.'''
+        if metadata:
+            async with self.engine.begin() as connection:
+                await self.execute_insert_metadata(connection, metadata)
+
+    async def execute_insert_metadata(self, connection, metadata):
+        tables = await self.get_tables()
+        if self.dialect == 'postgresql':
+            u = file_insert_marking_posts(tables['file'], tables['post'],
+                                          metadata)
+        else:
+            await connection.execute(tables['file'].insert(), metadata)
+            postIds = list(set([m['post_id'] for m in metadata]))
+            u = tables['post'].update().where(
+                unmarked_posts(tables['post'], postIds)).values(
+                has_attachments=True)
+        await connection.execute(u)
+
+    async def remove_many(self, postIds):
+        '''Remove many posts at once, and fix their topics
+
+:param list postIds: The identifiers of the posts to remove.
+:returns: The number of posts that were removed.
+:rtype: int'''
+        retval = 0
+        postIds = list(postIds)
+        if postIds:
+            tables = await self.get_tables()
+            pt = tables['post']
+            ft = tables['file']
+            tt = tables['topic']
+            async with self.engine.begin() as connection:
+                r = await connection.execute(post_topics(pt, postIds))
+                topics = [tuple(row) for row in r]
+                await connection.execute(
+                    ft.delete().where(ft.c.post_id.in_(postIds)))
+                r = await connection.execute(
+                    pt.delete().where(pt.c.post_id.in_(postIds)))
+                retval = r.rowcount
+                if topics:
+                    statements = rebuild_topics(
+                        pt, tt, [topic_key(pt).in_(topics)],
+                        [topic_key(tt).in_(topics)],
+                        self.dialect == 'postgresql')
+                    for statement in statements:
+                        await connection.execute(statement)
+        return retval
+
+    async def close(self):
+        '''Close the connections in the pool'''
+        await self.engine.dispose()
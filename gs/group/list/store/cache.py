@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#
+# Copyright © 2015 OnlineGroups.net and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+############################################################################
+from __future__ import absolute_import, unicode_literals
+from collections import OrderedDict
+from threading import Lock
+import time
+
+
+class LRUCache(object):
+    '''A small mapping that forgets the least-recently used items
+
+:param int maxSize: The most items to keep.
+:param float ttl: The number of seconds to keep each item, or ``None`` to
+                  keep the items until they are the least-recently used.
+
+The cache is shared by all the threads in the process.'''
+
+    def __init__(self, maxSize=1024, ttl=None):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        '''Get an item, marking it as recently used'''
+        with self.lock:
+            try:
+                expires, retval = self.items.pop(key)
+            except KeyError:
+                retval = default
+            else:
+                if (expires is not None) and (expires < time.time()):
+                    retval = default
+                else:
+                    self.items[key] = (expires, retval)
+        return retval
+
+    def set(self, key, value=True):
+        '''Add an item, forgetting the oldest if the cache is full'''
+        expires = None if self.ttl is None else (time.time() + self.ttl)
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (expires, value)
+            while len(self.items) > self.maxSize:
+                self.items.popitem(last=False)
+
+    def discard(self, key):
+        '''Forget an item, if it is in the cache'''
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#
+# Copyright © 2015 OnlineGroups.net and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+############################################################################
+'''Make the large columns of the ``post`` table smaller
+
+The ``header``, ``body`` and ``htmlbody`` columns can be compressed, and
+the headers that are of no use in the archive can be removed, before the
+post is stored. The compressed values are still text, so the columns do
+not change.'''
+from __future__ import absolute_import, unicode_literals
+from base64 import b64decode, b64encode
+from fnmatch import fnmatch
+import zlib
+
+#: The start of a compressed value. It starts with an escape character,
+#: which does not appear in the text of an email message.
+COMPRESSED_PREFIX = '\x1bz:'
+#: The columns of the ``post`` table that can be compressed
+COMPRESSIBLE_COLUMNS = ('header', 'body', 'htmlbody')
+#: The size of a value, in bytes, below which it is left alone
+COMPRESS_THRESHOLD = 4096
+
+
+def compress_text(text, threshold=COMPRESS_THRESHOLD):
+    '''Compress some text, if that makes it smaller
+
+:param str text: The text to compress.
+:param int threshold: The size, in bytes, below which the text is left
+                      alone.
+:returns: The compressed text (starting with ``COMPRESSED_PREFIX``), or the
+          text if it is small or does not compress well.
+:rtype: str'''
+    retval = text
+    if text:
+        data = text.encode('utf-8')
+        if len(data) >= threshold:
+            c = b64encode(zlib.compress(data, 9)).decode('ascii')
+            compressed = COMPRESSED_PREFIX + c
+            if len(compressed) < len(text):
+                retval = compressed
+    return retval
+
+
+def decompress_text(value):
+    '''Get the text from a value that may be compressed
+
+:param str value: The value, from ``compress_text``.
+:returns: The original text.
+:rtype: str'''
+    retval = value
+    if value and value.startswith(COMPRESSED_PREFIX):
+        data = b64decode(value[len(COMPRESSED_PREFIX):].encode('ascii'))
+        retval = zlib.decompress(data).decode('utf-8')
+    return retval
+
+
+def compress_post(post, columns, threshold=COMPRESS_THRESHOLD):
+    '''Compress the columns of a row in the ``post`` table
+
+:param dict post: The values for the row, which are changed.
+:param columns: The columns to compress.
+:param int threshold: The size, in bytes, below which a value is left
+                      alone.
+:returns: The row.
+:rtype: dict'''
+    for column in columns:
+        if column not in COMPRESSIBLE_COLUMNS:
+            m = 'Cannot compress the "{0}" column of a post'
+            raise ValueError(m.format(column))
+        post[column] = compress_text(post.get(column), threshold)
+    return post
+
+
+def decode_post(post):
+    '''Get the row for a post, with the compressed columns decompressed
+
+:param post: The row from the ``post`` table (a mapping).
+:returns: A copy of the row, with the text of every column.
+:rtype: dict
+
+Every column that can be compressed is checked, so the posts that were
+stored before compression was switched on (or switched off) are decoded
+correctly.'''
+    retval = dict(post)
+    for column in COMPRESSIBLE_COLUMNS:
+        if column in retval:
+            retval[column] = decompress_text(retval[column])
+    return retval
+
+
+def trim_headers(headers, names):
+    '''Remove some headers
+
+:param str headers: The headers of a message, one per line, with the
+                    long headers folded onto the following lines.
+:param names: The names of the headers to remove, such as ``Received``
+              or ``X-*`` (which are matched ignoring case).
+:returns: The headers, without the headers that are named.
+:rtype: str'''
+    patterns = [n.lower() for n in names]
+    lines = []
+    removing = False
+    for line in headers.splitlines(True):
+        if line[:1] in (' ', '\t'):
+            # A folded line belongs to the header before it
+            if not removing:
+                lines.append(line)
+        else:
+            name = line.split(':', 1)[0].strip().lower()
+            removing = any(fnmatch(name, p) for p in patterns)
+            if not removing:
+                lines.append(line)
+    retval = ''.join(lines)
+    if not headers.endswith('\n'):
+        retval = retval.rstrip('\n')
+    return retval
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#
+# Copyright © 2015 OnlineGroups.net and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+############################################################################
+from __future__ import absolute_import, unicode_literals
+from datetime import datetime, timedelta, tzinfo
+import re
+from zope.datetime import parseDatetimetz
+
+# Sat, 10 Mar 2007 22:47:20 +1300 (NZDT)
+RFC2822_DATE = re.compile(
+    r'^(?:[A-Za-z]{3},\s*)?(\d{1,2})\s+([A-Za-z]{3})\s+(\d{2,4})\s+'
+    r'(\d{1,2}):(\d{2})(?::(\d{2}))?\s+([+-]\d{4}|[A-Za-z]{1,5})'
+    r'(?:\s*\(.*\))?$')
+COMMENT = re.compile(r' \(.*?\)')
+
+MONTHS = {'jan': 1, 'feb': 2, 'mar': 3, 'apr': 4, 'may': 5, 'jun': 6,
+          'jul': 7, 'aug': 8, 'sep': 9, 'oct': 10, 'nov': 11, 'dec': 12}
+#: The offsets, in minutes, of the zone names allowed by RFC 2822
+ZONES = {'ut': 0, 'utc': 0, 'gmt': 0, 'z': 0,
+         'est': -300, 'edt': -240, 'cst': -360, 'cdt': -300,
+         'mst': -420, 'mdt': -360, 'pst': -480, 'pdt': -420}
+
+
+class FixedOffset(tzinfo):
+    'A timezone that is a fixed number of minutes from UTC'
+
+    def __init__(self, minutes):
+        self.minutes = minutes
+        self.offset = timedelta(minutes=minutes)
+
+    def utcoffset(self, dt):
+        return self.offset
+
+    def dst(self, dt):
+        return timedelta(0)
+
+    def tzname(self, dt):
+        sign = '-' if self.minutes < 0 else '+'
+        h, m = divmod(abs(self.minutes), 60)
+        retval = '{0}{1:02d}{2:02d}'.format(sign, h, m)
+        return retval
+
+    def __getinitargs__(self):
+        # So the dates can be pickled, and sent between processes.
+        return (self.minutes, )
+
+    def __repr__(self):
+        return 'FixedOffset({0})'.format(self.minutes)
+
+
+# There are only a few dozen offsets in use, so they are all kept.
+_timezones = {}
+
+
+def get_timezone(minutes):
+    '''Get the timezone for an offset, which is only created once
+
+:param int minutes: The offset from UTC, in minutes.
+:rtype: FixedOffset'''
+    retval = _timezones.get(minutes)
+    if retval is None:
+        retval = _timezones[minutes] = FixedOffset(minutes)
+    return retval
+
+
+def parse_rfc2822(d):
+    '''Parse a date in the format used by email
+
+:param str d: The value of the ``Date`` header.
+:returns: The date, with a timezone; ``None`` if the date is not in the
+          RFC 2822 format, or the zone is a name that is not in
+          ``ZONES``.
+:rtype: datetime.datetime'''
+    retval = None
+    m = RFC2822_DATE.match(d)
+    month = MONTHS.get(m.group(2).lower()) if m else None
+    if month is not None:
+        day, _m, year, hour, minute, second, zone = m.groups()
+        year = int(year)
+        if year < 50:  # Two-digit years, see Section 4.3 of RFC 2822
+            year += 2000
+        elif year < 1000:
+            year += 1900
+
+        if zone[0] in '+-':
+            minutes = (int(zone[1:3]) * 60) + int(zone[3:5])
+            if zone[0] == '-':
+                minutes = -minutes
+        else:
+            # Zones that are not in the table (such as NZDT) are left to
+            # the slower parser, which knows more of them.
+            minutes = ZONES.get(zone.lower())
+        if minutes is not None:
+            try:
+                retval = datetime(year, month, int(day), int(hour),
+                                  int(minute), int(second or 0),
+                                  tzinfo=get_timezone(minutes))
+            except ValueError:
+                retval = None
+    return retval
+
+
+def parse_date(d):
+    '''Parse the date of a message
+
+:param str d: The value of the ``Date`` header.
+:returns: The date, with a timezone.
+:rtype: datetime.datetime
+
+The common RFC 2822 format is parsed directly. Anything else is handed to
+:func:`zope.datetime.parseDatetimetz`, which is slower but copes with more
+formats.'''
+    d = d.strip()
+    retval = parse_rfc2822(d)
+    if retval is None:
+        # if we have the format Sat, 10 Mar 2007 22:47:20 +1300 (NZDT)
+        # strip the (NZDT) bit before parsing, otherwise we break the
+        # parser
+        retval = parseDatetimetz(COMMENT.sub('', d))
+    return retval
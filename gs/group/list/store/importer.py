@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#
+# Copyright © 2015 OnlineGroups.net and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+############################################################################
+'''Import an archive of messages (an mbox file or a Maildir) into a group
+
+The messages are parsed by a pool of processes, and the posts and files
+are written in large batches, each in its own transaction. The topics
+are rebuilt from the posts once all the messages have been imported.
+After each batch the number of messages that have been imported is
+written to a checkpoint file, so an import that is stopped can be
+resumed.
+
+This module also provides the commands that rebuild the topics, and fill
+in the full-text search vectors, after an import.'''
+from __future__ import absolute_import, print_function, unicode_literals
+from argparse import ArgumentParser
+import email
+from io import BytesIO
+from logging import getLogger, basicConfig, INFO
+log = getLogger('gs.group.list.store.importer')
+import mailbox
+from multiprocessing import Pool, cpu_count
+import os
+import sys
+import transaction
+from .messagestore import EmailMessageStore
+from .queries import (BatchStorageQuery, SearchIndexQuery,
+                      TopicAggregateQuery, post_values)
+from .reindex import (REINDEX_AT_COMMIT, REINDEX_OFF)
+
+
+def parse(raw):
+    'Parse a message from a string, or bytes'
+    if isinstance(raw, bytes) and hasattr(email, 'message_from_bytes'):
+        retval = email.message_from_bytes(raw)
+    else:
+        retval = email.message_from_string(raw)
+    return retval
+
+
+class PreparedMessage(EmailMessageStore):
+    '''A message that is prepared for storage in a worker process
+
+Only the text parts without a file name (which the bodies are read from)
+are decoded. The other parts are classified by the length of their
+encoded payload, rather than decoded, as the files are decoded once, by
+``ArchiveImporter.store_batch``, when they are stored.'''
+
+    def spool_attachment(self, part):
+        if (part.get_filename('') == '') \
+                and (part.get_content_maintype() == 'text'):
+            retval = super(PreparedMessage, self).spool_attachment(part)
+        else:
+            encoded = part.get_payload()
+            filename = part.get_filename('')
+            if isinstance(filename, bytes):
+                filename = filename.decode('utf-8', 'replace')
+            retval = {
+                'payload': BytesIO(),
+                'filename': filename,
+                'length': len(encoded.strip()) if encoded else 0,
+                'md5': '',
+                'charset': part.get_content_charset('utf-8'),
+                'maintype': part.get_content_maintype(),
+                'subtype': part.get_content_subtype(),
+                'mimetype': part.get_content_type(),
+                'contentid': part.get('content-id', '')}
+        return retval
+
+
+def prepare(args):
+    '''Prepare a message for storage
+
+:param tuple args: The raw message, the title of the list, the identifier
+                   of the group and the identifier of the site.
+:returns: The values for the row in the ``post`` table, the address of the
+          sender, and the raw message if it has attachments that should be
+          stored as files (or ``None``).
+:rtype: tuple
+
+This is run in the worker processes, so it does not touch the database
+or the ZODB. The identifier of the sender is looked up later, and the
+files are decoded, by ``ArchiveImporter.store_batch``.'''
+    raw, listTitle, groupId, siteId = args
+    message = PreparedMessage(None, parse(raw), listTitle, groupId, siteId,
+                              replace_mail_date=False)
+    post = post_values(message)
+    files = raw if message.manifest.archivable else None
+    retval = (post, message.sender, files)
+    return retval
+
+
+def open_mailbox(path):
+    'Open a Maildir, or an mbox file'
+    if os.path.isdir(path):
+        retval = mailbox.Maildir(path, factory=None, create=False)
+    else:
+        retval = mailbox.mbox(path, factory=None, create=False)
+    return retval
+
+
+def iter_raw_messages(box, start=0):
+    '''Get the raw messages from a mailbox, in a stable order
+
+:param box: The mailbox.
+:param int start: The number of messages to skip.'''
+    get = getattr(box, 'get_bytes', box.get_string)
+    for key in sorted(box.keys())[start:]:
+        yield get(key)
+
+
+class Checkpoint(object):
+    'The number of messages that have been imported'
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        retval = 0
+        if os.path.exists(self.path):
+            with open(self.path) as infile:
+                retval = int(infile.read().strip() or 0)
+        return retval
+
+    def save(self, count):
+        # Write, then rename, so a crash never leaves a partial checkpoint
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as outfile:
+            outfile.write('{0}\n'.format(count))
+        os.rename(tmp, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ArchiveImporter(object):
+    '''Import an archive into a group
+
+:param group: The group to import the messages into.
+:param str siteId: The identifier of the site.
+:param str groupId: The identifier of the group.
+:param str listTitle: The title of the mailing list.
+:param bool reindex: Reindex the files at the end of each batch.
+:param senderIdCb: The function that looks up the identifier of a user
+                   from an email address (default the user folder of the
+                   group).'''
+
+    def __init__(self, group, siteId, groupId, listTitle, reindex=True,
+                 senderIdCb=None):
+        self.group = group
+        self.siteId = siteId
+        self.groupId = groupId
+        self.listTitle = listTitle
+        self.reindex = REINDEX_AT_COMMIT if reindex else REINDEX_OFF
+        self.senderIdCb = senderIdCb
+        self.senderIds = {}
+
+    def sender_id(self, address):
+        '''The identifier of the user that sent a message
+
+:param str address: The email address of the sender.
+:returns: The identifier of the user, or ``''`` if no user has the address.
+:rtype: str
+
+An archive has many messages from each sender, so the identifiers are
+cached.'''
+        if address not in self.senderIds:
+            cb = self.senderIdCb
+            if cb is None:
+                cb = self.group.acl_users.get_userIdByEmail
+            self.senderIds[address] = (cb(address) or '') if address else ''
+        retval = self.senderIds[address]
+        return retval
+
+    def store_batch(self, prepared):
+        '''Store a batch of prepared messages
+
+:param list prepared: The prepared messages, from ``prepare``.
+:returns: The number of posts that were stored (duplicates are skipped).
+:rtype: int'''
+        batchQuery = BatchStorageQuery()
+        seen = batchQuery.existing_post_ids([p['post_id']
+                                             for p, s, f in prepared])
+        posts = []
+        withFiles = []
+        for post, sender, files in prepared:
+            if post['post_id'] not in seen:
+                seen.add(post['post_id'])
+                # The workers cannot see the users, so the sender is
+                # looked up here.
+                post['user_id'] = self.sender_id(sender)
+                posts.append(post)
+                if files is not None:
+                    withFiles.append(files)
+        # The topics are rebuilt at the end, rather than now.
+        batchQuery.insert_posts(posts)
+
+        fileMetadata = []
+        for raw in withFiles:
+            message = EmailMessageStore(self.group, parse(raw),
+                                        self.listTitle, self.groupId,
+                                        self.siteId, self.sender_id,
+                                        replace_mail_date=False)
+            message.reindex = self.reindex
+            fileMetadata.extend(message.store_attachments())
+        batchQuery.insert_files(fileMetadata)
+        retval = len(posts)
+        return retval
+
+    def finish(self):
+        'Rebuild the topics of the group'
+        TopicAggregateQuery().recompute(self.siteId, self.groupId)
+
+
+def get_app(zopeConfig):
+    'Start Zope, and get the root of the instance'
+    from Zope2.Startup.run import configure
+    configure(zopeConfig)
+    import Zope2
+    retval = Zope2.app()
+    return retval
+
+
+def get_group(zopeConfig, groupPath):
+    'Start Zope, and get the group'
+    app = get_app(zopeConfig)
+    retval = app.unrestrictedTraverse(groupPath)
+    return retval
+
+
+def recompute_main(args=None):
+    p = ArgumentParser(
+        description='Rebuild the number of posts, and the last post, of '
+                    'the topics from the posts.')
+    p.add_argument('-c', '--config', required=True,
+                   help='The configuration file for the Zope instance.')
+    p.add_argument('-s', '--site-id', default=None,
+                   help='The identifier of the site (default all sites).')
+    p.add_argument('-i', '--group-id', default=None,
+                   help='The identifier of the group (default all '
+                        'groups).')
+    a = p.parse_args(args)
+    basicConfig(level=INFO)
+
+    get_app(a.config)
+    updated = TopicAggregateQuery().recompute(a.site_id, a.group_id)
+    transaction.commit()
+    log.info('Rebuilt {0} topics'.format(updated))
+    return 0
+
+
+def index_main(args=None):
+    p = ArgumentParser(
+        description='Set the full-text search vectors for the posts that '
+                    'do not have one.')
+    p.add_argument('-c', '--config', required=True,
+                   help='The configuration file for the Zope instance.')
+    p.add_argument('-b', '--batch', type=int, default=1000,
+                   help='The number of posts to index in each '
+                        'transaction (default %(default)s).')
+    a = p.parse_args(args)
+    basicConfig(level=INFO)
+
+    get_app(a.config)
+    searchQuery = SearchIndexQuery()
+    total = 0
+    indexed = searchQuery.backfill(a.batch)
+    while indexed:
+        transaction.commit()
+        total += indexed
+        log.info('Indexed {0} posts'.format(total))
+        indexed = searchQuery.backfill(a.batch)
+    transaction.commit()
+    log.info('Finished indexing {0} posts'.format(total))
+    return 0
+
+
+def main(args=None):
+    p = ArgumentParser(
+        description='Import an archive of messages into a group.')
+    p.add_argument('mailbox',
+                   help='The mbox file, or Maildir directory, to import.')
+    p.add_argument('-c', '--config', required=True,
+                   help='The configuration file for the Zope instance.')
+    p.add_argument('-g', '--group', required=True,
+                   help='The path to the group, from the root of the '
+                        'Zope instance.')
+    p.add_argument('-s', '--site-id', required=True,
+                   help='The identifier of the site.')
+    p.add_argument('-i', '--group-id', required=True,
+                   help='The identifier of the group.')
+    p.add_argument('-t', '--list-title', default='',
+                   help='The title of the mailing list.')
+    p.add_argument('-b', '--batch', type=int, default=1000,
+                   help='The number of messages to store in each '
+                        'transaction (default %(default)s).')
+    p.add_argument('-p', '--processes', type=int, default=cpu_count(),
+                   help='The number of processes that parse the messages '
+                        '(default %(default)s).')
+    p.add_argument('--checkpoint', default=None,
+                   help='The file that records how far the import has '
+                        'got (default the mailbox with ".checkpoint" '
+                        'appended).')
+    p.add_argument('--no-reindex', dest='reindex', action='store_false',
+                   help='Do not reindex the files that are stored.')
+    a = p.parse_args(args)
+    basicConfig(level=INFO)
+
+    checkpoint = Checkpoint(a.checkpoint or (a.mailbox + '.checkpoint'))
+    done = checkpoint.load()
+    if done:
+        log.info('Resuming after {0} messages'.format(done))
+
+    group = get_group(a.config, a.group)
+    importer = ArchiveImporter(group, a.site_id, a.group_id, a.list_title,
+                               a.reindex)
+    box = open_mailbox(a.mailbox)
+    jobs = ((raw, a.list_title, a.group_id, a.site_id)
+            for raw in iter_raw_messages(box, done))
+    pool = Pool(a.processes)
+    try:
+        batch = []
+        for prepared in pool.imap(prepare, jobs, chunksize=16):
+            batch.append(prepared)
+            if len(batch) >= a.batch:
+                stored = importer.store_batch(batch)
+                transaction.commit()
+                done += len(batch)
+                checkpoint.save(done)
+                m = 'Imported {0} messages ({1} new)'.format(done, stored)
+                log.info(m)
+                batch = []
+        if batch:
+            importer.store_batch(batch)
+            transaction.commit()
+            done += len(batch)
+            checkpoint.save(done)
+    finally:
+        pool.close()
+        pool.join()
+
+    importer.finish()
+    transaction.commit()
+    checkpoint.clear()
+    log.info('Finished importing {0} messages'.format(done))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
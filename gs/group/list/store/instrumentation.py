@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#
+# Copyright © 2015 OnlineGroups.net and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+############################################################################
+from __future__ import absolute_import, unicode_literals
+from threading import Lock
+from timeit import default_timer
+from zope.component import queryUtility
+from zope.interface import implementer
+from .interfaces import IStorageInstrumentation
+
+
+class NullStage(object):
+    'A stage that records nothing'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        return False
+
+
+class NullTimings(object):
+    '''The timings for a message when there is no instrumentation
+
+Every stage is the same :class:`NullStage`, so timing a stage costs one
+method call when the instrumentation is off.'''
+    nullStage = NullStage()
+
+    def stage(self, name, rows=0, size=0):
+        return self.nullStage
+
+
+class Stage(object):
+    'A stage of storing a message, which records its duration on exit'
+
+    def __init__(self, instrumentation, postId, name, rows, size):
+        self.instrumentation = instrumentation
+        self.postId = postId
+        self.name = name
+        self.rows = rows
+        self.size = size
+        self.start = None
+
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        duration = default_timer() - self.start
+        self.instrumentation.record(self.postId, self.name, duration,
+                                    self.rows, self.size)
+        return False
+
+
+class MessageTimings(object):
+    '''The timings for storing a message
+
+:param instrumentation: The utility that records the timings.
+:type instrumentation: IStorageInstrumentation
+:param str postId: The identifier of the post being stored.'''
+
+    def __init__(self, instrumentation, postId):
+        self.instrumentation = instrumentation
+        self.postId = postId
+
+    def stage(self, name, rows=0, size=0):
+        '''Time a stage
+
+:param str name: The name of the stage.
+:param int rows: The number of rows written during the stage.
+:param int size: The number of bytes written during the stage.
+:returns: A context manager that records the stage when it exits.'''
+        retval = Stage(self.instrumentation, self.postId, name, rows, size)
+        return retval
+
+
+def get_timings(postId):
+    '''Get the timings for storing a message
+
+:param str postId: The identifier of the post being stored.
+:returns: A :class:`MessageTimings` if an ``IStorageInstrumentation``
+          utility is registered, a :class:`NullTimings` otherwise.'''
+    instrumentation = queryUtility(IStorageInstrumentation)
+    if instrumentation is None:
+        retval = NullTimings()
+    else:
+        retval = MessageTimings(instrumentation, postId)
+    return retval
+
+
+@implementer(IStorageInstrumentation)
+class StageCollector(object):
+    '''Collect the timings of the stages in memory
+
+The count, total and maximum duration, rows and bytes are kept for each
+stage, for all messages. Register it as a utility to turn the
+instrumentation on::
+
+  <utility
+    provides="gs.group.list.store.interfaces.IStorageInstrumentation"
+    factory="gs.group.list.store.instrumentation.StageCollector" />
+
+The totals can be exported with :meth:`prometheus_text`.'''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.stages = {}
+
+    def record(self, postId, stage, duration, rows, size):
+        with self.lock:
+            s = self.stages.get(stage)
+            if s is None:
+                s = self.stages[stage] = {'count': 0, 'duration': 0.0,
+                                          'max_duration': 0.0, 'rows': 0,
+                                          'bytes': 0}
+            s['count'] += 1
+            s['duration'] += duration
+            s['max_duration'] = max(s['max_duration'], duration)
+            s['rows'] += rows
+            s['bytes'] += size
+
+    def snapshot(self):
+        'Get a copy of the totals for each stage'
+        with self.lock:
+            retval = dict([(k, dict(v)) for k, v in self.stages.items()])
+        return retval
+
+    def prometheus_text(self, prefix='gs_group_list_store'):
+        '''Get the totals in the Prometheus text format
+
+:param str prefix: The prefix for the names of the metrics.
+:rtype: str'''
+        metrics = (
+            ('stage_count', 'count', 'counter',
+             'The number of times the stage was run'),
+            ('stage_seconds', 'duration', 'counter',
+             'The total time spent in the stage'),
+            ('stage_max_seconds', 'max_duration', 'gauge',
+             'The longest time spent in the stage'),
+            ('stage_rows', 'rows', 'counter',
+             'The number of rows written in the stage'),
+            ('stage_bytes', 'bytes', 'counter',
+             'The number of bytes written in the stage'), )
+        stages = self.snapshot()
+        lines = []
+        for name, key, metricType, helpText in metrics:
+            metric = '{0}_{1}'.format(prefix, name)
+            lines.append('# HELP {0} {1}'.format(metric, helpText))
+            lines.append('# TYPE {0} {1}'.format(metric, metricType))
+            for stage in sorted(stages):
+                lines.append('{0}{{stage="{1}"}} {2}'.format(
+                    metric, stage, stages[stage][key]))
+        retval = '\n'.join(lines) + '\n'
+        return retval
@@ -19,3 +19,20 @@ from zope.interface import Interface
 class IStorageForEmailMessage(Interface):
     def store():  # lint:ok
         'Store the message'
+
+
+class IStorageInstrumentation(Interface):
+    '''Record how long it takes to store a message
+
+A utility that provides this interface is called for each stage of
+storing each message. If no utility is registered then nothing is
+recorded.'''
+
+    def record(postId, stage, duration, rows, size):
+        '''Record a stage of storing a message
+
+:param str postId: The identifier of the post being stored.
+:param str stage: The name of the stage, such as ``post`` or ``reindex``.
+:param float duration: The time the stage took, in seconds.
+:param int rows: The number of rows written during the stage.
+:param int size: The number of bytes written during the stage.'''
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#
+# Copyright © 2015 OnlineGroups.net and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+############################################################################
+from __future__ import absolute_import, unicode_literals
+from zope.cachedescriptors.property import Lazy
+
+#: The attachment is archived as a file
+ARCHIVE = 'archive'
+#: The attachment is the plain-text body, which is stored with the post
+TEXT_BODY = 'text-body'
+#: The attachment is the HTML body, which is stored with the post
+HTML_BODY = 'html-body'
+#: The attachment is part of the HTML body, such as an image
+INLINE = 'inline'
+#: The attachment is empty
+EMPTY = 'empty'
+
+
+def classify(attachment):
+    '''Decide what to do with an attachment
+
+:param dict attachment: The attachment.
+:returns: ``ARCHIVE`` if the attachment should be stored as a file, or
+          the reason it should not be stored (``TEXT_BODY``,
+          ``HTML_BODY``, ``INLINE`` or ``EMPTY``).
+:rtype: str'''
+    if ((attachment['filename'] == '')
+            and (attachment['subtype'] == 'plain')):
+        retval = TEXT_BODY
+    elif ((attachment['filename'] == '')
+            and (attachment['subtype'] == 'html')):
+        retval = HTML_BODY
+    elif attachment['contentid'] and (attachment['filename'] == ''):
+        retval = INLINE
+    elif attachment['length'] <= 0:
+        retval = EMPTY
+    else:
+        retval = ARCHIVE
+    return retval
+
+
+class AttachmentManifest(object):
+    '''The attachments of a message, classified once
+
+:param list attachments: The attachments, in the order they appear in the
+                         message.'''
+
+    def __init__(self, attachments):
+        self.attachments = attachments
+
+    @Lazy
+    def entries(self):
+        '''The attachments, and what to do with them
+
+:returns: A 2-tuple of the attachment and its classification (see
+          ``classify``) for each attachment.
+:rtype: list'''
+        retval = [(a, classify(a)) for a in self.attachments]
+        return retval
+
+    @Lazy
+    def count(self):
+        'The number of attachments that have a file name'
+        retval = len([a for a in self.attachments if a['filename']])
+        return retval
+
+    @Lazy
+    def archivable(self):
+        'The attachments that are stored as files'
+        retval = [a for a, c in self.entries if c == ARCHIVE]
+        return retval
+
+    @Lazy
+    def skipped(self):
+        'The attachments that are not stored as files, and why'
+        retval = [(a, c) for a, c in self.entries if c != ARCHIVE]
+        return retval
@@ -13,18 +13,94 @@
 #
 ############################################################################
 from __future__ import absolute_import, unicode_literals
+from contextlib import contextmanager
 from datetime import datetime
 from logging import getLogger
 log = getLogger('gs.group.list.store.messagestore')
-import re
+from multiprocessing.pool import ThreadPool
+import transaction
 from zope.cachedescriptors.property import Lazy
-from zope.datetime import parseDatetimetz
 from gs.group.list.base import EmailMessage
 from Products.XWFCore.XWFUtils import removePathsFromFilenames
-from .queries import (EmailMessageStorageQuery, FileMetadataStorageQuery)
+from .queries import (EmailMessageStorageQuery, FileMetadataStorageQuery,
+                      FileDigestQuery, BatchStorageQuery,
+                      DuplicateMessageError, SearchIndexQuery,
+                      duplicate_error, forget_posts)
+from .activity import activitySummary
+from .compression import COMPRESS_THRESHOLD
+from .dates import parse_date
+from .instrumentation import get_timings
+from .manifest import (AttachmentManifest, ARCHIVE, TEXT_BODY, HTML_BODY,
+                       INLINE, EMPTY, classify)
+from .payload import (SPOOL_THRESHOLD, leaf_parts, spool_payload)
+from .reindex import (REINDEX_INLINE, REINDEX_AT_COMMIT, reindexQueue)
+
+
+@contextmanager
+def rollback_on_error(postIds):
+    '''Roll back the changes made in a block if it raises an exception
+
+:param list postIds: The identifiers of the posts written in the block.
+
+A savepoint of the Zope transaction is taken, so the files added to the
+ZODB are rolled back along with the rows written to the database (which
+uses a ``SAVEPOINT``). The rest of the transaction is kept. The posts are
+removed from ``storedPostIds`` as their rows were rolled back, unless the
+error is a ``DuplicateMessageError`` (as then the post is stored).'''
+    savepoint = transaction.savepoint(optimistic=True)
+    try:
+        yield
+    except Exception as e:
+        try:
+            savepoint.rollback()
+        except TypeError:
+            # A data manager that cannot roll back to a savepoint
+            log.exception('Could not roll back to the savepoint')
+        if not isinstance(e, DuplicateMessageError):
+            transaction.get().addAfterCommitHook(forget_posts, (postIds, ))
+        raise
 
 
 class EmailMessageStore(EmailMessage):
+    #: Store the attachments once the post has been committed, rather than
+    #: in the same transaction as the post.
+    defer_attachments = False
+    #: When the stored files are reindexed: as they are added
+    #: (``REINDEX_INLINE``), together when the transaction is committed
+    #: (``REINDEX_AT_COMMIT``), or not at all (``REINDEX_OFF``) so a bulk
+    #: import can reindex them afterwards.
+    reindex = REINDEX_INLINE
+    #: The size of an attachment, in bytes, above which it is decoded into
+    #: a temporary file on disk rather than into memory.
+    spool_threshold = SPOOL_THRESHOLD
+    #: Share the content of an attachment with a file that has already
+    #: been stored with the same content, rather than storing it again.
+    deduplicate_files = False
+    #: Keep the rows for the topics that were written recently in memory,
+    #: so the topic is not read for every post to a busy topic. (Only
+    #: databases other than PostgreSQL read the topic.)
+    cache_topics = False
+    #: Set the full-text search vector for the post (in the
+    #: ``post_search`` table) when it is stored.
+    index_search = False
+    #: The columns of the post (``header``, ``body`` or ``htmlbody``) that
+    #: are compressed, if they are larger than ``compress_threshold``
+    #: bytes. Use ``compression.decode_post`` to read the post.
+    compress_columns = ()
+    compress_threshold = COMPRESS_THRESHOLD
+    #: The names of the headers (such as ``Received`` or ``X-*``) that are
+    #: not stored with the post.
+    trim_headers = ()
+    #: The number of threads that decode the attachments of a message at
+    #: the same time; ``0`` (or ``1``) decodes them one at a time.
+    attachment_threads = 0
+    #: Add the post to the summary of the activity in the group (see the
+    #: ``activity`` module) once it has been committed.
+    record_activity = False
+    #: The ``writebehind.WriteBehind`` that the rows for the post are
+    #: added to once the transaction is committed, to be written to the
+    #: database later in a batch; ``None`` writes the rows straight away.
+    write_behind = None
 
     def __init__(self, context, message, list_title='', group_id='',
                  site_id='', sender_id_cb=None, replace_mail_date=True):
@@ -52,57 +128,316 @@ class EmailMessageStore(EmailMessage):
         retval = FileMetadataStorageQuery()
         return retval
 
+    @Lazy
+    def timings(self):
+        '''The timings of the stages of storing the message'''
+        retval = get_timings(self.post_id)
+        return retval
+
+    @Lazy
+    def searchQuery(self):
+        retval = SearchIndexQuery()
+        return retval
+
+    @Lazy
+    def digestQuery(self):
+        retval = FileDigestQuery()
+        return retval
+
     @Lazy
     def inreplyto(self):
         return self.message.get('in-reply-to', '')
 
+    @Lazy
+    def spooled_attachments(self):
+        '''The attachments, with the payloads in temporary files
+
+This is like the ``attachments`` property of ``EmailMessage``, except the
+``payload`` of each attachment is a file-like object rather than a string,
+so the decoded attachments are not all held in memory at once. Large
+payloads are written to disk (see ``spool_threshold``). An attachment that
+cannot be decoded is skipped, and the error is logged and added to
+``attachment_errors``, whether or not the attachments are decoded in
+threads.'''
+        parts = list(leaf_parts(self.message))
+        if (self.attachment_threads > 1) and (len(parts) > 1):
+            results = self.spool_in_threads(parts)
+        else:
+            results = [self.spool_or_error(part) for part in parts]
+
+        retval = []
+        for part, result in zip(parts, results):
+            if isinstance(result, Exception):
+                filename = part.get_filename('')
+                m = 'Could not decode the attachment "{0}" of the post '\
+                    '{1}: {2}'
+                log.warn(m.format(filename, self.post_id, result))
+                self.attachment_errors.append((filename, result))
+            else:
+                retval.append(result)
+        return retval
+
+    @Lazy
+    def attachments(self):
+        '''The attachments, as ``EmailMessage`` uses them for the ``body``
+and ``html_body``
+
+They are made from the ``spooled_attachments``, rather than by decoding
+every payload into a string again. Only the payloads of the text parts
+that have no file name (which the bodies are read from) are read into
+memory; the payload of every other attachment is empty, so an attachment
+that is stored as a file is decoded once, into a temporary file.'''
+        retval = []
+        for attachment in self.spooled_attachments:
+            a = dict(attachment)
+            payload = attachment['payload']
+            if ((attachment['filename'] == '')
+                    and (attachment['maintype'] == 'text')
+                    and not payload.closed):
+                a['payload'] = payload.read()
+                payload.seek(0)
+            else:
+                a['payload'] = b''
+            retval.append(a)
+        return retval
+
+    def forget_attachments(self):
+        '''Forget the attachments, so they are decoded from the message
+again
+
+The payload of an attachment is closed once it has been stored, so the
+attachments must be decoded again before storing a message a second time
+(after the batch it was in was rolled back, for example).'''
+        for attachment in self.__dict__.get('spooled_attachments', []):
+            payload = attachment['payload']
+            if hasattr(payload, 'close'):
+                payload.close()
+        for name in ('spooled_attachments', 'attachments',
+                     'attachment_errors', 'manifest', 'attachment_count'):
+            self.__dict__.pop(name, None)
+
+    @Lazy
+    def attachment_errors(self):
+        '''The errors raised when decoding the attachments in threads, as
+``(filename, exception)`` tuples'''
+        return []
+
+    def spool_attachment(self, part):
+        '''Decode a part of the message into a temporary file
+
+:param part: The part of the message.
+:returns: The attachment.
+:rtype: dict'''
+        charset = part.get_content_charset('utf-8')
+        filename = part.get_filename('')
+        if isinstance(filename, bytes):
+            filename = filename.decode(charset, 'replace')
+        payload, length, md5Sum = spool_payload(part, self.spool_threshold)
+        retval = {
+            'payload': payload,
+            'filename': filename,
+            'length': length,
+            'md5': md5Sum,
+            'charset': charset,
+            'maintype': part.get_content_maintype(),
+            'subtype': part.get_content_subtype(),
+            'mimetype': part.get_content_type(),
+            'contentid': part.get('content-id', '')}
+        return retval
+
+    def spool_or_error(self, part):
+        try:
+            retval = self.spool_attachment(part)
+        except Exception as e:
+            retval = e
+        return retval
+
+    def spool_in_threads(self, parts):
+        '''Decode the parts of the message at the same time
+
+:param list parts: The parts of the message.
+:returns: The attachment, or the exception raised when decoding it, for
+          each part (in the same order as the parts).
+:rtype: list
+
+The parts are decoded, checksummed, and written to temporary files by a
+pool of ``attachment_threads`` threads. (The files are still added to the
+ZODB one at a time, by the thread that is storing the message, as a ZODB
+connection belongs to one thread.)'''
+        pool = ThreadPool(min(self.attachment_threads, len(parts)))
+        try:
+            retval = pool.map(self.spool_or_error, parts)
+        finally:
+            pool.close()
+            pool.join()
+        return retval
+
+    @Lazy
+    def manifest(self):
+        '''The attachments, classified once for everything that uses them'''
+        retval = AttachmentManifest(self.spooled_attachments)
+        return retval
+
     @Lazy
     def attachment_count(self):
-        count = 0
-        for item in self.attachments:
-            if item['filename']:
-                count += 1
-        return count
+        return self.manifest.count
 
     @Lazy
     def date(self):
         retval = datetime.now()
         d = self.get('date', '').strip()
         if d and not self.replace_mail_date:
-            # if we have the format Sat, 10 Mar 2007 22:47:20 +1300 (NZDT)
-            # strip the (NZDT) bit before parsing, otherwise we break the
-            # parser
-            d = re.sub(' \(.*?\)', '', d)
-            retval = parseDatetimetz(d)
+            retval = parse_date(d)
         assert retval
         return retval
 
     def store(self):
-        """ Store mail & attachments in a folder and return it."""
+        """ Store mail & attachments in a folder and return it.
+
+If ``defer_attachments`` is set then the attachments are stored after the
+post has been committed, and the list of file-identifiers that is
+returned is empty. If ``write_behind`` is set then the rows for the post
+are written to the database later, by the flusher of the spool."""
         logMsg = 'Storing post "{0}"'.format(self.post_id)
         log.info(logMsg)
 
-        self.emailQuery.insert()
-        # --=mpj17=-- The file meatadata can only be added once the
-        # email is stored.
-        fileMetadata = []
-        for attachment in self.attachments:
-                d = self.store_attachment(attachment)
-                if d is not None:
-                    fileMetadata.append(d)
-        self.fileQuery.insert_metadata(fileMetadata)
-        fileIds = [f['file_id'] for f in fileMetadata]
+        with self.timings.stage('store'):
+            if self.write_behind is not None:
+                fileIds = self.store_write_behind()
+            else:
+                fileIds = self.store_now()
+            if self.record_activity:
+                transaction.get().addAfterCommitHook(
+                    self.activity_after_commit)
+        if self.attachment_errors:
+            m = 'Stored the post {0} without the {1} attachments that could '\
+                'not be decoded: {2}'
+            log.warn(m.format(self.post_id, len(self.attachment_errors),
+                              ', '.join(['"{0}"'.format(f) for f, e
+                                         in self.attachment_errors])))
         return (self.post_id, fileIds)
 
-    def store_attachment(self, attachment):
+    def store_now(self):
+        '''Write the post, its topic and the metadata for its files
+
+:returns: The identifiers of the files that were stored.
+:rtype: list'''
+        with rollback_on_error([self.post_id]):
+            self.emailQuery.insert()
+            if self.index_search:
+                with self.timings.stage('search', rows=1):
+                    self.searchQuery.index_text([self.search_text()])
+            # --=mpj17=-- The file meatadata can only be added once the
+            # email is stored.
+            if self.defer_attachments:
+                transaction.get().addAfterCommitHook(
+                    self.store_attachments_after_commit)
+                retval = []
+            else:
+                fileMetadata = self.store_attachments()
+                self.insert_metadata(fileMetadata)
+                retval = [f['file_id'] for f in fileMetadata]
+        return retval
+
+    def store_write_behind(self):
+        '''Store the attachments, and add the rows for the post to the
+spool of the ``write_behind`` as the transaction is committed
+
+:returns: The identifiers of the files that were stored.
+:rtype: list
+:raises DuplicateMessageError: The post is already in the database, or in
+                               the spool.'''
+        with self.timings.stage('duplicate', rows=1):
+            isDuplicate = ((self.post_id in self.write_behind)
+                           or self.emailQuery.stored())
+        if isDuplicate:
+            raise duplicate_error(self.post_id)
+
+        with rollback_on_error([self.post_id]):
+            fileMetadata = self.store_attachments()
+        post = self.emailQuery.post_values()
+        self.write_behind.append_at_commit(post, fileMetadata)
+        retval = [f['file_id'] for f in fileMetadata]
+        return retval
+
+    def search_text(self):
+        '''The text that the search vector is built from, which is never
+compressed'''
+        retval = {'post_id': self.post_id, 'subject': self.subject,
+                  'body': self.body}
+        return retval
+
+    def insert_metadata(self, fileMetadata):
+        with self.timings.stage('file_metadata', rows=len(fileMetadata)):
+            self.fileQuery.insert_metadata(fileMetadata)
+
+    def activity_after_commit(self, committed):
+        '''Add the post to the summary of the activity in the group, once it
+has been committed'''
+        if committed:
+            activitySummary.record(self.site_id, self.group_id,
+                                   self.topic_id, self.subject,
+                                   self.sender_id, self.date)
+
+    def store_attachments_after_commit(self, committed):
+        '''Store the attachments after the post has been committed
+
+:param bool committed: ``True`` if the transaction that stored the post
+                       was committed.
+
+This is an after-commit hook. The locks on the post and topic are released
+before the files are written and indexed. Each attachment, and its row in
+the ``file`` table, is then committed in its own transaction, so one
+attachment that fails to be stored does not lose the others.'''
+        if committed:
+            for attachment, disposition in self.manifest.entries:
+                try:
+                    with transaction.manager:
+                        d = self.store_attachment(attachment, disposition)
+                        if d is not None:
+                            self.insert_metadata([d])
+                except Exception as e:
+                    m = '{0} ({1}): failed to store the {2} attachment '\
+                        '"{3}" to post {4}: {5}'
+                    logMsg = m.format(self.list_title, self.group_id,
+                                      attachment['maintype'],
+                                      attachment['filename'], self.post_id,
+                                      e)
+                    log.error(logMsg)
+        else:
+            m = '{0} ({1}): not storing the attachments to post {2}, as '\
+                'the post was not committed.'
+            log.warn(m.format(self.list_title, self.group_id, self.post_id))
+
+    def store_attachments(self):
+        '''Store the attachments as files
+
+:returns: The metadata for the files that were stored.
+:rtype: list'''
+        retval = []
+        for attachment, disposition in self.manifest.entries:
+            d = self.store_attachment(attachment, disposition)
+            if d is not None:
+                retval.append(d)
+        return retval
+
+    def store_attachment(self, attachment, disposition=None):
+        '''Store an attachment as a file, if it should be
+
+:param dict attachment: The attachment.
+:param str disposition: What to do with the attachment, from the
+                        ``manifest``. It is worked out if it is ``None``.
+:returns: The metadata for the file, or ``None`` if the attachment was not
+          stored.'''
         retval = None
-        if ((attachment['filename'] == '')
-                and (attachment['subtype'] == 'plain')):
+        if disposition is None:
+            disposition = classify(attachment)
+
+        if disposition == TEXT_BODY:
             # We definately don't want to save the plain text body
             # again!
             pass
-        elif ((attachment['filename'] == '')
-                and (attachment['subtype'] == 'html')):
+        elif disposition == HTML_BODY:
             # We might want to do something with the HTML body some day,
             # but we archive the HTML body here, as it suggests in the
             # log message. The HTML body is archived along with the
@@ -110,7 +445,7 @@ class EmailMessageStore(EmailMessage):
             m = '{0} ({1}): archiving HTML message.'
             logMsg = m.format(self.list_title, self.group_id)
             log.info(logMsg)
-        elif attachment['contentid'] and (attachment['filename'] == ''):
+        elif disposition == INLINE:
             # TODO: What do we want to do with these? They are typically
             # part of an HTML message, for example the images, but what
             # should we do with them once we've stripped them?
@@ -119,14 +454,14 @@ class EmailMessageStore(EmailMessage):
                 (self.list_title, self.group_id,
                  attachment['maintype'], attachment['filename'])
             log.info(m)
-        elif attachment['length'] <= 0:
+        elif disposition == EMPTY:
             # Empty attachment. Kinda pointless archiving this!
             m = '%s (%s): stripped, but not archiving %s attachment '\
                 '%s; attachment was of zero size.' % \
                 (self.list_title, self.group_id,
                  attachment['maintype'], attachment['filename'])
             log.warn(m)
-        else:
+        elif disposition == ARCHIVE:
             m = '{0} ({1}): stripped and archiving {2} attachment {3}'
             logMsg = m.format(self.list_title, self.group_id,
                               attachment['maintype'],
@@ -151,15 +486,30 @@ class EmailMessageStore(EmailMessage):
         return retval
 
     def add_file(self, attachment, topic, creator):
-        """ Adds an attachment as a file."""
-        fileId = self.storage.add_file(attachment['payload'])
+        """ Adds an attachment as a file.
+
+The ``payload`` of the attachment can be a string or a file-like object,
+which is closed once it has been stored."""
+        payload = attachment['payload']
+        with self.timings.stage('add_file', size=attachment['length']):
+            if self.deduplicate_files:
+                fileId = self.add_deduplicated_file(attachment)
+            else:
+                fileId = self.storage.add_file(payload)
+        if hasattr(payload, 'close'):
+            payload.close()
         fileObj = self.storage.get_file(fileId)
         fixedTitle = removePathsFromFilenames(attachment['filename'])
-        fileObj.manage_changeProperties(
-            content_type=attachment['mimetype'], title=fixedTitle,
-            tags=['attachment'], group_ids=[self.group_id],
-            dc_creator=creator, topic=topic)
-        fileObj.reindex_file()
+        with self.timings.stage('properties'):
+            fileObj.manage_changeProperties(
+                content_type=attachment['mimetype'], title=fixedTitle,
+                tags=['attachment'], group_ids=[self.group_id],
+                dc_creator=creator, topic=topic)
+        if self.reindex == REINDEX_INLINE:
+            with self.timings.stage('reindex'):
+                fileObj.reindex_file()
+        elif self.reindex == REINDEX_AT_COMMIT:
+            reindexQueue.add(self.storage, fileId)
         #
         # Commit the ZODB transaction -- this basically makes it impossible
         # for us to rollback, but since our RDB transactions won't be rolled
@@ -170,6 +520,121 @@ class EmailMessageStore(EmailMessage):
         # transaction.commit()
         return fileId
 
+    def add_deduplicated_file(self, attachment):
+        '''Add the payload of an attachment to the storage, once
+
+If a file with the same content is already stored then a new file is
+created that shares the data of the existing file; otherwise the payload
+is stored and recorded in the ``file_digest`` table. Either way every
+attachment gets its own file, with its own identifier, title and
+properties.'''
+        existing = None
+        existingId = self.digestQuery.get_file_id(attachment['md5'],
+                                                  attachment['length'])
+        if existingId is not None:
+            existing = self.storage.get_file(existingId)
+
+        if existing is not None:
+            m = '{0} ({1}): sharing the content of file {2} with the {3} '\
+                'attachment {4}'
+            log.info(m.format(self.list_title, self.group_id, existingId,
+                              attachment['maintype'], attachment['filename']))
+            retval = self.storage.add_file(b'')
+            fileObj = self.storage.get_file(retval)
+            fileObj.update_data(existing.data, attachment['mimetype'],
+                                attachment['length'])
+        else:
+            retval = self.storage.add_file(attachment['payload'])
+            self.digestQuery.set_file_id(attachment['md5'],
+                                         attachment['length'], retval)
+        return retval
+
+
+def store_many(messages, update_topics=True):
+    '''Store many messages in one transaction
+
+:param list messages: The messages to store, as ``EmailMessageStore``
+                      instances (from ``group_store_factory`` for example).
+:param bool update_topics: If ``False`` the topics are left alone, and
+                           should be rebuilt later with
+                           ``TopicAggregateQuery.recompute``.
+:returns: One item for each message, in order. It is either the
+          ``(post_id, fileIds)`` tuple that ``EmailMessageStore.store``
+          returns, the ``DuplicateMessageError`` for a message that is
+          already in the database, or the exception raised when storing a
+          message failed.
+:rtype: list
+
+The posts and the file-metadata are each written with a single
+``executemany``, and the topics are written once each, rather than issuing
+the queries for each message in turn. A duplicate message does not stop
+the rest of the batch from being stored. If storing the batch fails it is
+rolled back to a savepoint, and the messages are stored one at a time.
+
+The stages of writing the batch are timed as a whole (with no post
+identifier), with the number of rows written in each.'''
+    timings = get_timings(None)
+    batchQuery = BatchStorageQuery(any(m.cache_topics for m in messages))
+    with timings.stage('duplicate', rows=len(messages)):
+        seen = batchQuery.existing_post_ids([m.post_id for m in messages])
+    retval = []
+    toStore = []
+    for message in messages:
+        if message.post_id in seen:
+            m = 'Post {0} already existed in database.'
+            msg = m.format(message.post_id)
+            log.warn(msg)
+            retval.append(DuplicateMessageError(msg))
+        else:
+            seen.add(message.post_id)
+            toStore.append((len(retval), message))
+            retval.append(None)
+
+    m = 'Storing {0} posts ({1} duplicates)'
+    log.info(m.format(len(toStore), len(messages) - len(toStore)))
+    posts = [message.emailQuery.post_values() for i, message in toStore]
+    try:
+        with timings.stage('store_many', rows=len(posts)), \
+                rollback_on_error([p['post_id'] for p in posts]):
+            with timings.stage('post', rows=len(posts)):
+                batchQuery.insert_posts(posts)
+            if update_topics:
+                topics = batchQuery.aggregate_topics(posts)
+                with timings.stage('topic', rows=len(topics)):
+                    batchQuery.update_topics(topics)
+            toIndex = [m.search_text() for i, m in toStore if m.index_search]
+            if toIndex:
+                with timings.stage('search', rows=len(toIndex)):
+                    SearchIndexQuery().index_text(toIndex)
+
+            fileMetadata = []
+            for i, message in toStore:
+                metadata = message.store_attachments()
+                fileMetadata.extend(metadata)
+                fileIds = [f['file_id'] for f in metadata]
+                retval[i] = (message.post_id, fileIds)
+            with timings.stage('file_metadata', rows=len(fileMetadata)):
+                batchQuery.insert_files(fileMetadata)
+        for i, message in toStore:
+            if message.record_activity:
+                transaction.get().addAfterCommitHook(
+                    message.activity_after_commit)
+    except Exception:
+        # The batch has been rolled back, so the messages are stored one
+        # at a time (each in its own savepoint) and only the messages that
+        # fail are lost.
+        m = 'Could not store the batch, storing the {0} posts one at a time'
+        log.exception(m.format(len(toStore)))
+        for i, message in toStore:
+            try:
+                message.forget_attachments()
+                retval[i] = message.store()
+            except Exception as e:
+                m = 'Could not store the post {0}: {1}'
+                log.warn(m.format(message.post_id, e))
+                retval[i] = e
+    return retval
+
 
 def group_store_factory(group, message):
     'For the ZCML, which really does not like class methods.'
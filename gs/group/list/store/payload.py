@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#
+# Copyright © 2015 OnlineGroups.net and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+############################################################################
+'''Decode the payloads of the parts of a message into temporary files,
+rather than into strings, so a large attachment is never held in memory
+in its decoded form.'''
+from __future__ import absolute_import, unicode_literals
+from binascii import Error as BinasciiError, a2b_base64
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5  # lint:ok
+from logging import getLogger
+log = getLogger('gs.group.list.store.payload')
+from tempfile import SpooledTemporaryFile
+
+#: The number of characters of an encoded payload that are decoded at once.
+CHUNK_SIZE = 64 * 1024
+#: Payloads larger than this (in bytes) are written to disk.
+SPOOL_THRESHOLD = 1024 * 1024
+
+
+def leaf_parts(message):
+    '''Get the parts of a message that are not multipart
+
+:param message: The email message.
+:type message: :class:`email.message.Message`
+:returns: The parts of the message, in the order they appear.
+:rtype: list'''
+    retval = []
+    if message.is_multipart():
+        for part in message.get_payload():
+            retval.extend(leaf_parts(part))
+    else:
+        retval.append(message)
+    return retval
+
+
+def iter_base64(encoded, chunkSize=CHUNK_SIZE):
+    '''Decode base64 in pieces
+
+:param str encoded: The base64-encoded data.
+:param int chunkSize: The number of characters to decode at once.
+:returns: A generator of the decoded bytes.'''
+    carry = ''
+    for i in range(0, len(encoded), chunkSize):
+        chunk = carry + ''.join(encoded[i:i + chunkSize].split())
+        end = len(chunk) - (len(chunk) % 4)
+        carry = chunk[end:]
+        if end:
+            yield a2b_base64(chunk[:end])
+    if carry.strip('='):
+        # Like the standard library, be lenient about missing padding.
+        try:
+            yield a2b_base64(carry + ('=' * (-len(carry) % 4)))
+        except BinasciiError as be:
+            log.warn('Could not decode the end of a payload: {0}'.format(be))
+
+
+def iter_payload(part, chunkSize=CHUNK_SIZE):
+    '''Decode the payload of a part of a message in pieces
+
+:param part: A part of the message that is not multipart.
+:param int chunkSize: The number of characters to decode at once.
+:returns: A generator of the decoded bytes.
+
+Only base64 is decoded in pieces, as that is how files are normally
+attached; the other encodings are decoded in one go by the standard
+library.'''
+    cte = part.get('content-transfer-encoding', '').strip().lower()
+    if cte == 'base64':
+        for chunk in iter_base64(part.get_payload(), chunkSize):
+            yield chunk
+    else:
+        retval = part.get_payload(decode=True)
+        if retval:
+            yield retval
+
+
+def spool_payload(part, threshold=SPOOL_THRESHOLD):
+    '''Decode the payload of a part of a message into a temporary file
+
+:param part: A part of the message that is not multipart.
+:param int threshold: The size, in bytes, above which the file is written
+                      to disk rather than kept in memory.
+:returns: A 3-tuple of the file (positioned at the start), the length of
+          the decoded payload, and the MD5 sum of the payload.
+:rtype: tuple'''
+    outfile = SpooledTemporaryFile(max_size=threshold)
+    checksum = md5()
+    length = 0
+    for chunk in iter_payload(part):
+        outfile.write(chunk)
+        checksum.update(chunk)
+        length += len(chunk)
+    outfile.seek(0)
+    retval = (outfile, length, checksum.hexdigest())
+    return retval
@@ -17,148 +17,886 @@ try:
     from hashlib import md5
 except:
     from md5 import md5  # lint:ok
+from collections import OrderedDict
+from contextlib import contextmanager
 from logging import getLogger
 log = getLogger('gs.group.list.store.queries')
 import time
 import sqlalchemy as sa
 from sqlalchemy.exc import SQLAlchemyError
+import transaction
+try:
+    from sqlalchemy.dialects.postgresql import insert as pg_insert
+except ImportError:  # SQLAlchemy < 1.1
+    pg_insert = None  # lint:ok
 from zope.sqlalchemy import mark_changed
 from gs.database import getSession, getTable
+from .cache import LRUCache
+from .compression import decode_post
+from .instrumentation import NullTimings
+from .statements import (
+    DuplicateMessageError, file_insert_marking_posts, post_insert_new,
+    post_topics, post_values, rebuild_topics, same_topic, topic_key,
+    topic_upsert, topic_values, unmarked_posts)
+
+
+# The tables and statements are the same for every message, so they are
+# looked up and built once, and the SQL compiled from the statements is
+# kept in _compiled by SQLAlchemy.
+_tables = {}
+_statements = {}
+_compiled = {}
+
+
+def get_table(name):
+    '''Get a table, which is only looked up once per process'''
+    retval = _tables.get(name)
+    if retval is None:
+        retval = _tables[name] = getTable(name)
+    return retval
+
+
+def get_statement(name, factory):
+    '''Get a statement, which is only built once per process
+
+:param str name: The name of the statement.
+:param factory: A callable that builds the statement, using
+                ``sqlalchemy.bindparam`` for anything that changes.'''
+    retval = _statements.get(name)
+    if retval is None:
+        retval = _statements[name] = factory()
+    return retval
+
+
+def execute(session, statement, params=None):
+    '''Execute a statement from ``get_statement``, reusing the compiled SQL
+
+:param session: The database session.
+:param statement: The statement to execute.
+:param params: The parameters for the statement, or a list of them for an
+               ``executemany``.'''
+    connection = session.connection().execution_options(
+        compiled_cache=_compiled)
+    if params is None:
+        retval = connection.execute(statement)
+    else:
+        retval = connection.execute(statement, params)
+    return retval
+
+
+def later(a, b):
+    'Is the date ``a`` after the date ``b``?'
+    # The comparison is done with timestamps as some dates are naïve, and
+    # others have a timezone.
+    retval = (time.mktime(a.timetuple()) > time.mktime(b.timetuple()))
+    return retval
+
+
+#: The identifiers of the posts that this process has recently committed,
+#: so most duplicates (from mail loops and retries) are spotted without
+#: asking the database. The identifiers are only kept for five minutes, in
+#: case another process removes the post.
+storedPostIds = LRUCache(4096, ttl=300)
+
+
+#: The rows for the topics that this process has recently written, keyed
+#: by ``(topic_id, group_id, site_id)``, so the busiest topics are not read
+#: for every post (see ``EmailMessageStore.cache_topics``). The rows are
+#: only kept for a minute, in case another process changes the topic.
+topicCache = LRUCache(1024, ttl=60)
+
+
+def remember_posts(committed, postIds):
+    '''Add posts to ``storedPostIds``, once they are committed'''
+    if committed:
+        for postId in postIds:
+            storedPostIds.set(postId)
+
+
+def forget_posts(committed, postIds):
+    '''Remove posts that were rolled back from ``storedPostIds``
 
+This is registered after ``remember_posts``, so it undoes it once the
+transaction is committed.'''
+    for postId in postIds:
+        storedPostIds.discard(postId)
 
-class DuplicateMessageError(Exception):
-    pass
+
+def duplicate_error(postId):
+    m = 'Post {0} already existed in database.'.format(postId)
+    log.warn(m)
+    retval = DuplicateMessageError(m)
+    return retval
+
+
+@contextmanager
+def savepoint(session):
+    '''Run some statements in a ``SAVEPOINT``
+
+:param session: The database session.
+
+If the statements raise an exception then only they are rolled back, and
+the rest of the work in the session (and the Zope transaction) is kept.'''
+    nested = session.begin_nested()
+    try:
+        yield nested
+    except Exception:
+        nested.rollback()
+        raise
+    else:
+        nested.commit()
+
+
+def supports_upsert(session):
+    '''Can ``INSERT ... ON CONFLICT`` be used with the session?'''
+    retval = ((pg_insert is not None)
+              and (session.get_bind().dialect.name == 'postgresql'))
+    return retval
+
+
+class TopicStorageQuery(object):
+    '''Add posts to a topic
+
+On PostgreSQL a topic is added or updated by a single
+``INSERT ... ON CONFLICT DO UPDATE``, so posts that are delivered to the
+same topic at the same time neither wait on a read nor lose a count. Other
+databases read the topic and then write it.
+
+:param cache: The cache of the rows for the topics (such as
+              ``topicCache``), or ``None`` to always read the topic.'''
+
+    def __init__(self, cache=None):
+        self.topicTable = get_table('topic')
+        self.cache = cache
+
+    def upsert(self, session, topic):
+        '''Add a topic, or add posts to an existing topic
+
+:param session: The database session.
+:param dict topic: The values for the row in the ``topic`` table, with
+                   ``num_posts`` set to the number of posts being added.'''
+        if supports_upsert(session):
+            self.upsert_postgresql(session, topic)
+            if self.cache is not None:
+                self.cache.discard((topic['topic_id'], topic['group_id'],
+                                    topic['site_id']))
+        else:
+            self.upsert_generic(session, topic)
+
+    def build_upsert(self):
+        return topic_upsert(self.topicTable)
+
+    def build_select(self):
+        tt = self.topicTable
+        retval = tt.select().where(sa.and_(
+            tt.c.topic_id == sa.bindparam('topic_id'),
+            tt.c.group_id == sa.bindparam('group_id'),
+            tt.c.site_id == sa.bindparam('site_id')))
+        return retval
+
+    def build_update(self):
+        # The names of the parameters in the WHERE clause cannot be the same
+        # as the names of the columns that are set.
+        tt = self.topicTable
+        lastPostDate = sa.bindparam('b_last_post_date')
+        # The posts are added to the count, and the last post is only
+        # replaced by a later one, in the UPDATE itself so a topic that
+        # was read earlier (or cached) cannot overwrite another write.
+        # --=mpj17=-- Hypothesis: the following condition is
+        # screwing up, and causing the Last Author to be bung.
+        # Test: check the Last Post in topics where the last
+        # author is bung.
+        older = (tt.c.last_post_date > lastPostDate)
+        retval = tt.update().where(sa.and_(
+            tt.c.topic_id == sa.bindparam('b_topic_id'),
+            tt.c.group_id == sa.bindparam('b_group_id'),
+            tt.c.site_id == sa.bindparam('b_site_id'))).values(
+            num_posts=tt.c.num_posts + sa.bindparam('b_num_posts'),
+            last_post_id=sa.case(
+                (older, tt.c.last_post_id),
+                else_=sa.bindparam('b_last_post_id')),
+            last_post_date=sa.case(
+                (older, tt.c.last_post_date), else_=lastPostDate))
+        return retval
+
+    def get(self, session, topicId, groupId, siteId):
+        '''Get the row for a topic, or ``None``'''
+        key = (topicId, groupId, siteId)
+        retval = None if self.cache is None else self.cache.get(key)
+        if retval is None:
+            s = get_statement('topic_select', self.build_select)
+            r = execute(session, s, {'topic_id': topicId,
+                                     'group_id': groupId,
+                                     'site_id': siteId})
+            retval = r.mappings().first()
+            if (retval is not None) and (self.cache is not None):
+                retval = dict(retval)
+                self.cache.set(key, retval)
+        return retval
+
+    def upsert_postgresql(self, session, topic):
+        i = get_statement('topic_upsert', self.build_upsert)
+        execute(session, i, topic)
+
+    def upsert_generic(self, session, topic):
+        key = (topic['topic_id'], topic['group_id'], topic['site_id'])
+        existing = self.get(session, *key)
+        if existing is not None:
+            p = {'b_num_posts': topic['num_posts'],
+                 'b_last_post_id': topic['last_post_id'],
+                 'b_last_post_date': topic['last_post_date'],
+                 'b_topic_id': topic['topic_id'],
+                 'b_group_id': topic['group_id'],
+                 'b_site_id': topic['site_id']}
+            u = get_statement('topic_update', self.build_update)
+            r = execute(session, u, p)
+            if r.rowcount == 0:
+                # The topic was removed after it was read (or cached)
+                existing = None
+            elif self.cache is not None:
+                updated = dict(existing)
+                updated['num_posts'] += topic['num_posts']
+                if not later(existing['last_post_date'],
+                             topic['last_post_date']):
+                    updated['last_post_id'] = topic['last_post_id']
+                    updated['last_post_date'] = topic['last_post_date']
+                self.cache.set(key, updated)
+
+        if existing is None:
+            i = get_statement('topic_insert', self.topicTable.insert)
+            try:
+                execute(session, i, topic)
+            except SQLAlchemyError as se:
+                log.warn(se)
+                m = 'Topic id "{0}" already existed in database. This '\
+                    'should be changed to raise a specific error to the UI.'
+                log.warn(m.format(topic['topic_id']))
+
+                m = 'Topic "{0}" already existed in database.'
+                msg = m.format(topic['topic_id'])
+                raise DuplicateMessageError(msg)
+            if self.cache is not None:
+                self.cache.set(key, dict(topic))
 
 
 class FileMetadataStorageQuery(object):
+    '''Add the metadata for the files, and mark the posts as having
+attachments
+
+On PostgreSQL the rows are added to the ``file`` table, and the posts are
+marked, with one statement: a multi-row ``INSERT ... RETURNING`` in a
+common table expression, followed by the ``UPDATE`` of the posts. Other
+databases use an ``executemany`` and then the ``UPDATE``. Either way, only
+the posts that are not already marked are updated.'''
+
     def __init__(self):
-        self.fileTable = getTable('file')
-        self.postTable = getTable('post')
+        self.fileTable = get_table('file')
+        self.postTable = get_table('post')
+
+    def unmarked_posts(self, postIds):
+        '''The clause that matches the posts that are not marked as having
+attachments'''
+        return unmarked_posts(self.postTable, postIds)
 
     def insert_metadata(self, metadata):
+        '''Add the metadata for the files
+
+:param list metadata: The rows for the ``file`` table, for any number of
+                      posts.'''
         session = getSession()
         if metadata:
-            i = self.fileTable.insert()
-            session.execute(i, params=metadata)
+            if supports_upsert(session):
+                self.insert_metadata_postgresql(session, metadata)
+            else:
+                self.insert_metadata_generic(session, metadata)
+            mark_changed(session)
+
+    def insert_metadata_postgresql(self, session, metadata):
+        u = file_insert_marking_posts(self.fileTable, self.postTable,
+                                      metadata)
+        session.execute(u)
+
+    def insert_metadata_generic(self, session, metadata):
+        i = get_statement('file_insert', self.fileTable.insert)
+        execute(session, i, metadata)
+
+        postIds = list(set([m['post_id'] for m in metadata]))
+        u = self.postTable.update().where(
+            self.unmarked_posts(postIds)).values(has_attachments=True)
+        session.execute(u)
+
+
+class FileDigestQuery(object):
+    '''The stored files, indexed by the digest and size of their content'''
+
+    def __init__(self):
+        self.fileDigestTable = get_table('file_digest')
+
+    def build_select(self):
+        fdt = self.fileDigestTable
+        retval = sa.select(fdt.c.file_id).where(sa.and_(
+            fdt.c.digest == sa.bindparam('digest'),
+            fdt.c.file_size == sa.bindparam('file_size')))
+        return retval
+
+    def build_upsert(self):
+        fdt = self.fileDigestTable
+        retval = pg_insert(fdt)
+        retval = retval.on_conflict_do_update(
+            index_elements=[fdt.c.digest, fdt.c.file_size],
+            set_={'file_id': retval.excluded.file_id})
+        return retval
+
+    def build_update(self):
+        fdt = self.fileDigestTable
+        retval = fdt.update().where(sa.and_(
+            fdt.c.digest == sa.bindparam('b_digest'),
+            fdt.c.file_size == sa.bindparam('b_file_size')))
+        return retval
+
+    def get_file_id(self, digest, size):
+        '''Get the identifier of the file with the content
+
+:param str digest: The MD5 sum of the content.
+:param int size: The size of the content, in bytes.
+:returns: The identifier of the file, or ``None``.'''
+        s = get_statement('file_digest_select', self.build_select)
+        session = getSession()
+        r = execute(session, s, {'digest': digest, 'file_size': size})
+        retval = r.scalar()
+        return retval
+
+    def set_file_id(self, digest, size, fileId):
+        '''Record the file that holds the content
+
+:param str digest: The MD5 sum of the content.
+:param int size: The size of the content, in bytes.
+:param str fileId: The identifier of the file.'''
+        session = getSession()
+        p = {'digest': digest, 'file_size': size, 'file_id': fileId}
+        if supports_upsert(session):
+            i = get_statement('file_digest_upsert', self.build_upsert)
+            execute(session, i, p)
+        else:
+            u = get_statement('file_digest_update', self.build_update)
+            r = execute(session, u, {'b_digest': digest, 'b_file_size': size,
+                                     'file_id': fileId})
+            if r.rowcount == 0:
+                i = get_statement('file_digest_insert',
+                                  self.fileDigestTable.insert)
+                execute(session, i, p)
+        mark_changed(session)
+
+
+#: The text-search configuration that is used to build the search vectors
+SEARCH_CONFIG = 'english'
+
+
+class SearchIndexQuery(object):
+    '''The full-text search vectors for the posts
+
+:param str config: The PostgreSQL text-search configuration.
+
+The vectors are built by PostgreSQL from the subject and the body of the
+posts, with the subject weighted above the body, and are stored in the
+``post_search`` table (see ``sql/02-post_search.sql``). The text is always
+uncompressed first (see ``compress_columns``), so a compressed body is
+indexed as words rather than as its encoding. Other databases have no
+full-text search, so nothing is stored.'''
+
+    def __init__(self, config=SEARCH_CONFIG):
+        self.postTable = get_table('post')
+        self.searchTable = get_table('post_search')
+        self.config = config
+
+    def search_vector(self, subject, body):
+        '''The search vector for the text of a post
 
-            postId = metadata[0]['post_id']
-            u = self.postTable.update(self.postTable.c.post_id == postId)
-            session.execute(u, params={'has_attachments': True})
+:param str subject: The subject of the post.
+:param str body: The body of the post, uncompressed.'''
+        subject = sa.func.setweight(sa.func.to_tsvector(
+            self.config, subject or ''), 'A')
+        body = sa.func.setweight(sa.func.to_tsvector(
+            self.config, body or ''), 'B')
+        retval = subject.op('||')(body)
+        return retval
+
+    def index_text(self, posts):
+        '''Set the search vectors for some posts from their text
+
+:param list posts: The ``post_id``, ``subject`` and (uncompressed) ``body``
+                   of each post.
+:returns: The number of posts that were indexed.
+:rtype: int'''
+        retval = 0
+        session = getSession()
+        if posts and supports_upsert(session):
+            st = self.searchTable
+            values = [{'post_id': post['post_id'],
+                       'search_vector': self.search_vector(post['subject'],
+                                                           post['body'])}
+                      for post in posts]
+            i = pg_insert(st).values(values)
+            i = i.on_conflict_do_update(
+                index_elements=[st.c.post_id],
+                set_={'search_vector': i.excluded.search_vector})
+            r = session.execute(i)
+            retval = r.rowcount
             mark_changed(session)
+        return retval
+
+    def read_text(self, session, whereClause, limit=None):
+        '''Read the text of posts, decompressing the body'''
+        pt = self.postTable
+        s = sa.select(pt.c.post_id, pt.c.subject, pt.c.body).where(
+            whereClause)
+        if limit is not None:
+            s = s.limit(limit)
+        r = session.execute(s).mappings()
+        retval = [decode_post(row) for row in r]
+        return retval
+
+    def index_posts(self, postIds):
+        '''Set the search vectors for some posts that are stored
+
+:param list postIds: The identifiers of the posts.
+:returns: The number of posts that were indexed.
+:rtype: int'''
+        retval = 0
+        session = getSession()
+        if postIds and supports_upsert(session):
+            posts = self.read_text(session,
+                                   self.postTable.c.post_id.in_(postIds))
+            retval = self.index_text(posts)
+        return retval
+
+    def backfill(self, batchSize=1000):
+        '''Set the search vectors for some of the posts that have none
+
+:param int batchSize: The most posts to index.
+:returns: The number of posts that were indexed, which is ``0`` once every
+          post has been indexed.
+:rtype: int'''
+        retval = 0
+        session = getSession()
+        if supports_upsert(session):
+            pt = self.postTable
+            st = self.searchTable
+            missing = ~sa.exists().where(st.c.post_id == pt.c.post_id)
+            posts = self.read_text(session, missing, batchSize)
+            retval = self.index_text(posts)
+        return retval
 
 
 class EmailMessageStorageQuery(object):
 
     def __init__(self, email_message):
         self.email_message = email_message
-        self.postTable = getTable('post')
-        self.topicTable = getTable('topic')
-        self.post_id_mapTable = getTable('post_id_map')
+        self.postTable = get_table('post')
+        self.topicTable = get_table('topic')
+        self.post_id_mapTable = get_table('post_id_map')
+        # The message may be a plain EmailMessage (to remove a post, for
+        # example) rather than an EmailMessageStore, without the options.
+        cache = topicCache if getattr(email_message, 'cache_topics', False) \
+            else None
+        self.topicQuery = TopicStorageQuery(cache)
 
-    def _get_topic(self):
-        and_ = sa.and_
+    @property
+    def timings(self):
+        '''The timings of the message, or ``NullTimings`` if the message
+does not have any'''
+        retval = getattr(self.email_message, 'timings', None)
+        if retval is None:
+            retval = NullTimings()
+        return retval
 
-        s = self.topicTable.select(
-            and_(self.topicTable.c.topic_id == self.email_message.topic_id,
-                 self.topicTable.c.group_id == self.email_message.group_id,
-                 self.topicTable.c.site_id == self.email_message.site_id))
-        session = getSession()
-        r = session.execute(s)
+    def post_values(self):
+        'The values for the row in the ``post`` table'
+        return post_values(self.email_message)
 
-        return r.fetchone()
+    def build_insert_new(self):
+        '''Insert a post, unless it is already there, returning the
+identifier of the post that was added'''
+        return post_insert_new(self.postTable)
+
+    def build_exists(self):
+        pt = self.postTable
+        retval = sa.select(sa.exists().where(
+            pt.c.post_id == sa.bindparam('b_post_id')))
+        return retval
+
+    def exists(self, session):
+        '''Is the post already in the database?'''
+        s = get_statement('post_exists', self.build_exists)
+        r = execute(session, s, {'b_post_id': self.email_message.post_id})
+        retval = bool(r.scalar())
+        return retval
+
+    def stored(self):
+        '''Is the post already in the database (or was it recently
+committed by this process)?'''
+        retval = ((self.email_message.post_id in storedPostIds)
+                  or self.exists(getSession()))
+        return retval
 
     def insert(self):
-        and_ = sa.and_
+        '''Add the post, and add it to its topic
+
+:raises DuplicateMessageError: The post is already in the database.
+
+A duplicate is normally spotted before the post is written (from
+``storedPostIds``, with ``INSERT ... ON CONFLICT DO NOTHING`` on PostgreSQL,
+or with an ``EXISTS`` query), so the transaction is left alone. The post
+and the topic are written in a ``SAVEPOINT``, so if either fails (because
+another transaction added the same post at the same time, for example)
+only they are rolled back.'''
         session = getSession()
+        timings = self.timings
+        postId = self.email_message.post_id
+        if postId in storedPostIds:
+            raise duplicate_error(postId)
 
-        #
-        # add the post itself
-        #
-        i = self.postTable.insert()
-        try:
-            hasAttachments = bool(self.email_message.attachment_count)
-            p = {
-                'post_id': self.email_message.post_id,
-                'topic_id': self.email_message.topic_id,
-                'group_id': self.email_message.group_id,
-                'site_id': self.email_message.site_id,
-                'user_id': self.email_message.sender_id,
-                'in_reply_to': self.email_message.inreplyto,
-                'subject': self.email_message.subject,
-                'date': self.email_message.date,
-                'body': self.email_message.body,
-                'htmlbody': self.email_message.html_body,
-                'header': self.email_message.headers,
-                'has_attachments': hasAttachments, }
-            session.execute(i, params=p)
-        except SQLAlchemyError as se:
-            log.warn(se)
-            m = "Post id %s already existed in database. This should be"\
-                "changed changed to raise a specific error to the UI."
-            log.warn(m % self.email_message.post_id)
-            session.rollback()
-            m = "Post %s already existed in database."
-            raise DuplicateMessageError(m % self.email_message.post_id)
-
-        #
-        # add/update the topic
-        #
-        topic = self._get_topic()
-        if not topic:
-            i = self.topicTable.insert()
-            try:
-                session.execute(i, params={
-                    'topic_id': self.email_message.topic_id,
-                    'group_id': self.email_message.group_id,
-                    'site_id': self.email_message.site_id,
-                    'original_subject': self.email_message.subject,
-                    'first_post_id': self.email_message.post_id,
-                    'last_post_id': self.email_message.post_id,
-                    'last_post_date': self.email_message.date,
-                    'num_posts': 1})
-            except SQLAlchemyError as se:
-                log.warn(se)
-                m = 'Topic id "{0}" already existed in database. This '\
-                    'should be changed to raise a specific error to the UI.'
-                log.warn(m.format(self.email_message.topic_id))
-                session.rollback()
+        p = self.post_values()
+        if not supports_upsert(session):
+            with timings.stage('duplicate', rows=1):
+                isDuplicate = self.exists(session)
+            if isDuplicate:
+                raise duplicate_error(postId)
 
-                m = 'Topic "{0}" already existed in database.'
-                msg = m.format(self.email_message.topic_id)
-                raise DuplicateMessageError(msg)
-        else:
-            num_posts = topic['num_posts']
-            # --=mpj17=-- Hypothesis: the following condition is
-            # screwing up, and causing the Last Author to be bung.
-            # Test: check the Last Post in topics where the last
-            # author is bung.
-            if (time.mktime(topic['last_post_date'].timetuple()) >
-                    time.mktime(self.email_message.date.timetuple())):
-                last_post_date = topic['last_post_date']
-                last_post_id = topic['last_post_id']
-            else:
-                last_post_date = self.email_message.date
-                last_post_id = self.email_message.post_id
-
-            uselect = and_(
-                self.topicTable.c.topic_id == self.email_message.topic_id,
-                self.topicTable.c.group_id == self.email_message.group_id,
-                self.topicTable.c.site_id == self.email_message.site_id)
-            u = self.topicTable.update(uselect)
-            session.execute(u, params={'num_posts': num_posts + 1,
-                                       'last_post_id': last_post_id,
-                                       'last_post_date': last_post_date})
+        # The post and the topic are written in a SAVEPOINT so a failure
+        # only rolls back this message, rather than the whole session.
+        with savepoint(session):
+            #
+            # add the post itself
+            #
+            self.insert_post(session, p)
+
+            #
+            # add/update the topic
+            #
+            with timings.stage('topic', rows=1):
+                self.topicQuery.upsert(session, topic_values(p))
+        transaction.get().addAfterCommitHook(remember_posts, ([postId], ))
         mark_changed(session)
 
+    def insert_post(self, session, values):
+        '''Add the row to the ``post`` table
+
+:raises DuplicateMessageError: The post is already in the database.'''
+        postId = self.email_message.post_id
+        with self.timings.stage('post', rows=1):
+            if supports_upsert(session):
+                i = get_statement('post_insert_new', self.build_insert_new)
+                r = execute(session, i, values)
+                if r.first() is None:
+                    raise duplicate_error(postId)
+            else:
+                i = get_statement('post_insert', self.postTable.insert)
+                try:
+                    execute(session, i, values)
+                except SQLAlchemyError as se:
+                    log.warn(se)
+                    raise duplicate_error(postId)
+
     def remove(self):
+        RemoveQuery().remove_many([self.email_message.post_id])
+
+
+class ArchiveQuery(object):
+    '''Read the archive of a group, a page at a time
+
+The pages use keyset (seek) pagination: rather than an ``OFFSET``, the
+sort key of the last row of one page is passed in to get the next page,
+so a page deep in the archive is as quick to get as the first. Only the
+columns needed to list the topics, posts and files are read (the bodies
+of the posts only when asked for). The indexes that these queries need
+are in ``sql/03-archive_indexes.sql``.'''
+
+    def __init__(self):
+        self.topicTable = get_table('topic')
+        self.postTable = get_table('post')
+        self.fileTable = get_table('file')
+
+    @staticmethod
+    def rows(statement):
+        session = getSession()
+        r = session.execute(statement).mappings()
+        retval = [dict(row) for row in r]
+        return retval
+
+    def topics(self, siteId, groupId, limit=20, before=None):
+        '''The topics in a group, the most recently active first
+
+:param str siteId: The identifier of the site.
+:param str groupId: The identifier of the group.
+:param int limit: The number of topics to get.
+:param tuple before: The ``(last_post_date, topic_id)`` of the last topic
+                     of the previous page, or ``None`` for the first page.
+:returns: The topics.
+:rtype: list'''
+        tt = self.topicTable
+        s = sa.select(
+            tt.c.topic_id, tt.c.original_subject, tt.c.first_post_id,
+            tt.c.last_post_id, tt.c.last_post_date, tt.c.num_posts).where(
+            sa.and_(tt.c.site_id == siteId, tt.c.group_id == groupId))
+        if before is not None:
+            s = s.where(sa.tuple_(tt.c.last_post_date, tt.c.topic_id) <
+                        sa.tuple_(*before))
+        s = s.order_by(tt.c.last_post_date.desc(),
+                       tt.c.topic_id.desc()).limit(limit)
+        retval = self.rows(s)
+        return retval
+
+    def posts(self, topicId, limit=20, after=None, withBody=False):
+        '''The posts in a topic, the oldest first
+
+:param str topicId: The identifier of the topic.
+:param int limit: The number of posts to get.
+:param tuple after: The ``(date, post_id)`` of the last post of the
+                    previous page, or ``None`` for the first page.
+:param bool withBody: Get the ``body`` and ``htmlbody`` of each post too
+                      (decompressed if necessary).
+:returns: The posts.
+:rtype: list'''
+        pt = self.postTable
+        columns = [pt.c.post_id, pt.c.user_id, pt.c.subject, pt.c.date,
+                   pt.c.has_attachments]
+        if withBody:
+            columns.extend([pt.c.body, pt.c.htmlbody])
+        s = sa.select(*columns).where(pt.c.topic_id == topicId)
+        if after is not None:
+            s = s.where(sa.tuple_(pt.c.date, pt.c.post_id) >
+                        sa.tuple_(*after))
+        s = s.order_by(pt.c.date, pt.c.post_id).limit(limit)
+        retval = self.rows(s)
+        if withBody:
+            retval = [decode_post(post) for post in retval]
+        return retval
+
+    def files(self, topicId, limit=20, after=None):
+        '''The files posted to a topic, the oldest first
+
+:param str topicId: The identifier of the topic.
+:param int limit: The number of files to get.
+:param tuple after: The ``(date, file_id)`` of the last file of the
+                    previous page, or ``None`` for the first page.
+:returns: The metadata for the files.
+:rtype: list'''
+        ft = self.fileTable
+        s = sa.select(
+            ft.c.file_id, ft.c.file_name, ft.c.mime_type, ft.c.file_size,
+            ft.c.date, ft.c.post_id).where(ft.c.topic_id == topicId)
+        if after is not None:
+            s = s.where(sa.tuple_(ft.c.date, ft.c.file_id) >
+                        sa.tuple_(*after))
+        s = s.order_by(ft.c.date, ft.c.file_id).limit(limit)
+        retval = self.rows(s)
+        return retval
+
+
+class RemoveQuery(object):
+    '''Remove posts, and fix their topics'''
+
+    def __init__(self):
+        self.postTable = get_table('post')
+        self.fileTable = get_table('file')
+
+    def remove_many(self, postIds):
+        '''Remove many posts at once
+
+:param list postIds: The identifiers of the posts to remove.
+:returns: The number of posts that were removed.
+:rtype: int
+
+The posts, and the rows in the ``file`` table for their attachments, are
+deleted with one statement each. The topics that the posts were in are then
+rebuilt in one pass: the number of posts, and the first and last posts, are
+set from the posts that are left, and topics that are left empty are
+deleted.'''
+        retval = 0
+        postIds = list(postIds)
+        if postIds:
+            pt = self.postTable
+            ft = self.fileTable
+            session = getSession()
+            s = post_topics(pt, postIds)
+            topics = [tuple(row) for row in session.execute(s)]
+
+            session.execute(ft.delete().where(ft.c.post_id.in_(postIds)))
+            r = session.execute(pt.delete().where(pt.c.post_id.in_(postIds)))
+            retval = r.rowcount
+            TopicAggregateQuery().recompute_topics(topics)
+            mark_changed(session)
+            for topic in topics:
+                topicCache.discard(topic)
+            for postId in postIds:
+                storedPostIds.discard(postId)
+        return retval
+
+
+class BatchStorageQuery(object):
+    '''Store the rows for many messages at once
+
+The posts and the file-metadata are each written using a single
+statement, and every topic is written once no matter how many posts are
+added to it.
+
+:param bool cacheTopics: Keep the rows for the topics in ``topicCache``.'''
+
+    def __init__(self, cacheTopics=False):
+        self.postTable = get_table('post')
+        cache = topicCache if cacheTopics else None
+        self.topicQuery = TopicStorageQuery(cache)
+
+    def existing_post_ids(self, postIds):
+        'Get the set of post-identifiers that are already stored'
+        retval = set([p for p in postIds if p in storedPostIds])
+        unknown = [p for p in postIds if p not in retval]
+        if unknown:
+            s = sa.select(self.postTable.c.post_id).where(
+                self.postTable.c.post_id.in_(unknown))
+            session = getSession()
+            r = session.execute(s)
+            retval.update(r.scalars())
+        return retval
+
+    @staticmethod
+    def aggregate_topics(posts):
+        '''Collapse the rows for the posts into one row per topic
+
+:param list posts: The values for the rows in the ``post`` table.
+:returns: The values for the rows in the ``topic`` table, with
+          ``num_posts`` set to the number of posts in ``posts``.
+:rtype: list'''
+        topics = OrderedDict()
+        firstDates = {}
+        for post in posts:
+            key = (post['topic_id'], post['group_id'], post['site_id'])
+            if key not in topics:
+                topics[key] = {
+                    'topic_id': post['topic_id'],
+                    'group_id': post['group_id'],
+                    'site_id': post['site_id'],
+                    'original_subject': post['subject'],
+                    'first_post_id': post['post_id'],
+                    'last_post_id': post['post_id'],
+                    'last_post_date': post['date'],
+                    'num_posts': 0}
+                firstDates[key] = post['date']
+            topic = topics[key]
+            topic['num_posts'] += 1
+            if later(firstDates[key], post['date']):
+                firstDates[key] = post['date']
+                topic['first_post_id'] = post['post_id']
+                topic['original_subject'] = post['subject']
+            if not later(topic['last_post_date'], post['date']):
+                topic['last_post_date'] = post['date']
+                topic['last_post_id'] = post['post_id']
+        retval = list(topics.values())
+        return retval
+
+    def insert_posts(self, posts):
+        session = getSession()
+        if posts:
+            i = get_statement('post_insert', self.postTable.insert)
+            execute(session, i, posts)
+            mark_changed(session)
+            transaction.get().addAfterCommitHook(
+                remember_posts, ([p['post_id'] for p in posts], ))
+
+    def update_topics(self, topics):
+        '''Add or update the topics
+
+:param list topics: The rows for the topics, from ``aggregate_topics``.'''
+        session = getSession()
+        for topic in topics:
+            self.topicQuery.upsert(session, topic)
+        if topics:
+            mark_changed(session)
+
+    def insert_files(self, metadata):
+        '''Add the metadata for the files
+
+:param list metadata: The rows for the ``file`` table, for any number of
+                      posts.'''
+        FileMetadataStorageQuery().insert_metadata(metadata)
+
+
+class TopicAggregateQuery(object):
+    '''Work out the number of posts, and the last post, of topics from the
+posts themselves, rather than one post at a time'''
+
+    def __init__(self):
+        self.postTable = get_table('post')
+        self.topicTable = get_table('topic')
+
+    def same_topic(self, table, other):
+        '''The clause that matches the topic of ``table`` with ``other``'''
+        return same_topic(table, other)
+
+    @staticmethod
+    def in_scope(table, siteId, groupId):
+        '''The clauses that limit ``table`` to a site, or a group'''
+        retval = []
+        if siteId is not None:
+            retval.append(table.c.site_id == siteId)
+        if groupId is not None:
+            retval.append(table.c.group_id == groupId)
+        return retval
+
+    def recompute(self, siteId=None, groupId=None):
+        '''Rebuild the topics from their posts
+
+:param str siteId: The identifier of the site, or ``None`` for all sites.
+:param str groupId: The identifier of the group, or ``None`` for all the
+                    groups.
+:returns: The number of topics that were updated.
+:rtype: int
+
+Topics that are missing are added, the ``num_posts``, ``last_post_id`` and
+``last_post_date`` of every topic is set from the posts with a single
+``GROUP BY`` (along with the ``first_post_id`` and ``original_subject``,
+from the earliest post), and topics without posts are deleted. This repairs
+any drift in the topics, and can be run after storing messages without
+updating the topics (see ``store_many``).'''
+        postScope = self.in_scope(self.postTable, siteId, groupId)
+        topicScope = self.in_scope(self.topicTable, siteId, groupId)
+        retval = self.rebuild(postScope, topicScope)
+        return retval
+
+    @staticmethod
+    def topic_key(table):
+        return topic_key(table)
+
+    def recompute_topics(self, topics):
+        '''Rebuild some topics from their posts
+
+:param topics: The ``(topic_id, group_id, site_id)`` of each topic.
+:returns: The number of topics that were updated.
+:rtype: int'''
+        retval = 0
+        topics = list(topics)
+        if topics:
+            postScope = [self.topic_key(self.postTable).in_(topics)]
+            topicScope = [self.topic_key(self.topicTable).in_(topics)]
+            retval = self.rebuild(postScope, topicScope)
+        return retval
+
+    def rebuild(self, postScope, topicScope):
+        '''Rebuild the topics
+
+:param list postScope: The clauses that select the posts to rebuild from.
+:param list topicScope: The clauses that select the topics to rebuild.
+:returns: The number of topics that were updated.
+:rtype: int'''
         session = getSession()
-        topic = self._get_topic()
-        if topic['num_posts'] == 1:
-            d = self.topicTable.delete(
-                self.topicTable.c.topic_id == self.email_message.topic_id)
-            session.execute(d)
-
-        d = self.postTable.delete(
-            self.postTable.c.post_id == self.email_message.post_id)
+        postgresql = session.get_bind().dialect.name == 'postgresql'
+        i, u, d = rebuild_topics(self.postTable, self.topicTable, postScope,
+                                 topicScope, postgresql)
+        session.execute(i)
+        r = session.execute(u)
+        retval = r.rowcount
         session.execute(d)
         mark_changed(session)
+        topicCache.clear()
+        return retval
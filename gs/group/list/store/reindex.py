@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#
+# Copyright © 2015 OnlineGroups.net and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+############################################################################
+from __future__ import absolute_import, unicode_literals
+from collections import OrderedDict
+from logging import getLogger
+log = getLogger('gs.group.list.store.reindex')
+from threading import local
+import transaction
+
+#: Reindex each file as soon as it is added
+REINDEX_INLINE = 'inline'
+#: Reindex all the files added in a transaction when it is committed
+REINDEX_AT_COMMIT = 'commit'
+#: Do not reindex the files; the caller will do it (see ``reindex_files``)
+REINDEX_OFF = 'off'
+
+
+def reindex_files(storage, fileIds):
+    '''Reindex some files
+
+:param storage: The file-storage that holds the files.
+:param fileIds: The identifiers of the files to reindex.
+:returns: The number of files that were reindexed.
+:rtype: int'''
+    retval = 0
+    for fileId in fileIds:
+        fileObj = storage.get_file(fileId)
+        if fileObj is None:
+            m = 'Not reindexing the file "{0}", as it could not be found.'
+            log.warn(m.format(fileId))
+        else:
+            fileObj.reindex_file()
+            retval += 1
+    return retval
+
+
+class ReindexQueue(object):
+    '''Reindex the files added during a transaction all at once
+
+The identifiers of the files are collected for the current transaction,
+and the files are reindexed by a before-commit hook. If more than
+``maxSize`` files are waiting then they are reindexed straight away, so a
+long-running import does not hold everything until the end.'''
+
+    def __init__(self, maxSize=256):
+        self.maxSize = maxSize
+        # Transactions belong to a thread, so the pending files do too.
+        self.local = local()
+
+    @property
+    def pending(self):
+        'The files waiting to be reindexed in the current transaction'
+        txn = transaction.get()
+        if getattr(self.local, 'txn', None) is not txn:
+            self.local.txn = txn
+            self.local.pending = OrderedDict()
+            txn.addBeforeCommitHook(self.flush)
+        return self.local.pending
+
+    def add(self, storage, fileId):
+        '''Add a file to the queue
+
+:param storage: The file-storage that holds the file.
+:param str fileId: The identifier of the file.'''
+        pending = self.pending
+        pending[fileId] = storage
+        if len(pending) >= self.maxSize:
+            self.flush()
+
+    def flush(self):
+        '''Reindex all the files in the queue for the current transaction
+
+:returns: The number of files that were reindexed.
+:rtype: int'''
+        retval = 0
+        pending = getattr(self.local, 'pending', None)
+        if pending:
+            for fileId, storage in list(pending.items()):
+                retval += reindex_files(storage, [fileId])
+            pending.clear()
+            log.info('Reindexed {0} files'.format(retval))
+        return retval
+
+
+#: The queue used by ``EmailMessageStore`` when it reindexes at commit.
+reindexQueue = ReindexQueue()
@@ -0,0 +1,11 @@
+SET CLIENT_ENCODING = 'UTF8';
+SET CLIENT_MIN_MESSAGES = WARNING;
+
+-- The stored files, indexed by the MD5 sum and size of their content,
+-- so the content of a file that is posted again can be shared.
+CREATE TABLE file_digest (
+    digest     TEXT     NOT NULL,
+    file_size  INTEGER  NOT NULL,
+    file_id    TEXT     NOT NULL,
+    PRIMARY KEY (digest, file_size)
+);
@@ -0,0 +1,15 @@
+SET CLIENT_ENCODING = 'UTF8';
+SET CLIENT_MIN_MESSAGES = WARNING;
+
+-- The full-text search vectors for the posts, filled in when each post is
+-- stored (if the index_search option is set), or by the
+-- gs_store_index_search command. The subject is weighted above the body.
+CREATE TABLE post_search (
+    post_id        TEXT      PRIMARY KEY
+                             REFERENCES post (post_id) ON DELETE CASCADE,
+    search_vector  TSVECTOR  NOT NULL
+);
+
+CREATE INDEX post_search_vector_idx
+    ON post_search
+    USING GIN (search_vector);
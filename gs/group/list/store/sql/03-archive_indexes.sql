@@ -0,0 +1,17 @@
+SET CLIENT_ENCODING = 'UTF8';
+SET CLIENT_MIN_MESSAGES = WARNING;
+
+-- The indexes used by gs.group.list.store.queries.ArchiveQuery, so each
+-- page of the archive is read from an index rather than sorted.
+
+-- The topics in a group, the most recently active first
+CREATE INDEX topic_group_last_post_idx
+    ON topic (site_id, group_id, last_post_date DESC, topic_id DESC);
+
+-- The posts in a topic, the oldest first
+CREATE INDEX post_topic_date_idx
+    ON post (topic_id, date, post_id);
+
+-- The files posted to a topic, the oldest first
+CREATE INDEX file_topic_date_idx
+    ON file (topic_id, date, file_id);
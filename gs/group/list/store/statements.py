@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#
+# Copyright © 2015 OnlineGroups.net and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+############################################################################
+'''The statements used to store the posts, which need no database session
+
+These are shared by the storage queries (in ``queries``, which use the
+session of the Zope transaction) and the asynchronous storage (in
+``asyncstore``, which does not use Zope at all). Like the queries, they are
+written so they work with SQLAlchemy 1.4 and 2.'''
+from __future__ import absolute_import, unicode_literals
+import sqlalchemy as sa
+try:
+    from sqlalchemy.dialects.postgresql import insert as pg_insert
+except ImportError:  # SQLAlchemy < 1.1
+    pg_insert = None  # lint:ok
+try:
+    from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+except ImportError:  # SQLAlchemy < 1.4
+    sqlite_insert = None  # lint:ok
+from .compression import COMPRESS_THRESHOLD, compress_post, trim_headers
+
+
+class DuplicateMessageError(Exception):
+    pass
+
+
+def post_values(emailMessage):
+    '''The values for the row in the ``post`` table for a message
+
+This needs no database connection, so it can be called from a process
+that is only parsing messages. The headers named by the ``trim_headers``
+option of the message are removed, and the columns named by the
+``compress_columns`` option are compressed.'''
+    hasAttachments = bool(emailMessage.attachment_count)
+    headers = emailMessage.headers
+    # A plain EmailMessage does not have the options of EmailMessageStore
+    trimHeaders = getattr(emailMessage, 'trim_headers', ())
+    if trimHeaders:
+        headers = trim_headers(headers, trimHeaders)
+    retval = {
+        'post_id': emailMessage.post_id,
+        'topic_id': emailMessage.topic_id,
+        'group_id': emailMessage.group_id,
+        'site_id': emailMessage.site_id,
+        'user_id': emailMessage.sender_id,
+        'in_reply_to': emailMessage.inreplyto,
+        'subject': emailMessage.subject,
+        'date': emailMessage.date,
+        'body': emailMessage.body,
+        'htmlbody': emailMessage.html_body,
+        'header': headers,
+        'has_attachments': hasAttachments, }
+    compressColumns = getattr(emailMessage, 'compress_columns', ())
+    if compressColumns:
+        threshold = getattr(emailMessage, 'compress_threshold',
+                            COMPRESS_THRESHOLD)
+        compress_post(retval, compressColumns, threshold)
+    return retval
+
+
+def topic_values(post):
+    '''The values for the row in the ``topic`` table that adds a post to its
+topic
+
+:param dict post: The values for the row in the ``post`` table (from
+                  ``post_values``).'''
+    retval = {
+        'topic_id': post['topic_id'],
+        'group_id': post['group_id'],
+        'site_id': post['site_id'],
+        'original_subject': post['subject'],
+        'first_post_id': post['post_id'],
+        'last_post_id': post['post_id'],
+        'last_post_date': post['date'],
+        'num_posts': 1}
+    return retval
+
+
+def same_topic(table, other):
+    '''The clause that matches the topic of ``table`` with ``other``'''
+    retval = sa.and_(table.c.topic_id == other.c.topic_id,
+                     table.c.group_id == other.c.group_id,
+                     table.c.site_id == other.c.site_id)
+    return retval
+
+
+def topic_key(table):
+    '''The ``(topic_id, group_id, site_id)`` of the rows in ``table``'''
+    retval = sa.tuple_(table.c.topic_id, table.c.group_id, table.c.site_id)
+    return retval
+
+
+def upsert_insert(dialect):
+    '''The ``insert`` that supports ``ON CONFLICT`` for a dialect
+
+:param str dialect: The name of the dialect: ``postgresql`` or
+                    ``sqlite``.'''
+    retval = sqlite_insert if dialect == 'sqlite' else pg_insert
+    return retval
+
+
+def post_insert_new(postTable, dialect='postgresql', returning=True):
+    '''Insert a post, unless it is already there
+
+:param str dialect: The name of the dialect (see ``upsert_insert``).
+:param bool returning: Return the identifier of the post that was added.
+                       Otherwise the row-count is ``0`` if the post was
+                       already there.'''
+    pt = postTable
+    retval = upsert_insert(dialect)(pt).on_conflict_do_nothing(
+        index_elements=[pt.c.post_id])
+    if returning:
+        retval = retval.returning(pt.c.post_id)
+    return retval
+
+
+def topic_upsert(topicTable, dialect='postgresql'):
+    '''Add a topic, or add posts to it if it is already there
+
+:param str dialect: The name of the dialect (see ``upsert_insert``).'''
+    tt = topicTable
+    retval = upsert_insert(dialect)(tt)
+    # The max() of SQLite is GREATEST() when it is given two values
+    greatest = sa.func.max if dialect == 'sqlite' else sa.func.greatest
+    newer = (retval.excluded.last_post_date >= tt.c.last_post_date)
+    retval = retval.on_conflict_do_update(
+        index_elements=[tt.c.topic_id, tt.c.group_id, tt.c.site_id],
+        set_={
+            'num_posts': tt.c.num_posts + retval.excluded.num_posts,
+            'last_post_date': greatest(
+                tt.c.last_post_date, retval.excluded.last_post_date),
+            'last_post_id': sa.case(
+                (newer, retval.excluded.last_post_id),
+                else_=tt.c.last_post_id), })
+    return retval
+
+
+def unmarked_posts(postTable, postIds):
+    '''The clause that matches the posts that are not marked as having
+attachments'''
+    pt = postTable
+    retval = sa.and_(pt.c.post_id.in_(postIds),
+                     pt.c.has_attachments.isnot(True))
+    return retval
+
+
+def file_insert_marking_posts(fileTable, postTable, metadata):
+    '''Add the metadata for the files, and mark their posts as having
+attachments, in one statement (PostgreSQL)
+
+:param list metadata: The rows for the ``file`` table.'''
+    ft = fileTable
+    newFiles = ft.insert().values(metadata).returning(
+        ft.c.post_id).cte('new_files')
+    retval = postTable.update().where(
+        unmarked_posts(postTable, sa.select(newFiles.c.post_id))).values(
+        has_attachments=True)
+    return retval
+
+
+def rebuild_topics(postTable, topicTable, postScope, topicScope,
+                   postgresql=True):
+    '''The statements that rebuild topics from their posts
+
+:param list postScope: The clauses that select the posts to rebuild from.
+:param list topicScope: The clauses that select the topics to rebuild.
+:param bool postgresql: Use ``UPDATE ... FROM``, which PostgreSQL supports.
+:returns: The statements that add the topics that are missing, set the
+          aggregates and the first post of the topics that exist (whose
+          row-count is the number of topics that were updated), and delete
+          the topics that have no posts. Each statement leaves the
+          ``topic`` table consistent.
+:rtype: tuple'''
+    pt = postTable
+    tt = topicTable
+    p2 = pt.alias('p2')
+
+    # Add the topics that are missing, from the first post, with the
+    # aggregates of all their posts so the topics are complete without the
+    # update
+    firstPostId = sa.select(p2.c.post_id).where(
+        same_topic(p2, pt)).order_by(
+        p2.c.date, p2.c.post_id).limit(1).scalar_subquery()
+    newLastPostId = sa.select(p2.c.post_id).where(
+        same_topic(p2, pt)).order_by(
+        p2.c.date.desc(), p2.c.post_id.desc()).limit(1).scalar_subquery()
+    newLastPostDate = sa.select(sa.func.max(p2.c.date)).where(
+        same_topic(p2, pt)).scalar_subquery()
+    newNumPosts = sa.select(sa.func.count(p2.c.post_id)).where(
+        same_topic(p2, pt)).scalar_subquery()
+    hasTopic = sa.exists().where(same_topic(tt, pt))
+    s = sa.select(
+        pt.c.topic_id, pt.c.group_id, pt.c.site_id,
+        pt.c.subject.label('original_subject'),
+        pt.c.post_id.label('first_post_id'),
+        newLastPostId.label('last_post_id'),
+        newLastPostDate.label('last_post_date'),
+        newNumPosts.label('num_posts')).where(
+        sa.and_(pt.c.post_id == firstPostId, ~hasTopic, *postScope))
+    i = tt.insert().from_select(
+        ['topic_id', 'group_id', 'site_id', 'original_subject',
+         'first_post_id', 'last_post_id', 'last_post_date',
+         'num_posts'], s)
+
+    # Set the aggregates, and the first post (which may have been removed)
+    earliest = sa.select(p2.c.post_id).where(
+        same_topic(p2, tt)).order_by(p2.c.date, p2.c.post_id).limit(1)
+    earliestPostId = earliest.scalar_subquery()
+    earliestSubject = earliest.with_only_columns(
+        p2.c.subject).scalar_subquery()
+    lastPostId = sa.select(p2.c.post_id).where(
+        same_topic(p2, tt)).order_by(
+        p2.c.date.desc(), p2.c.post_id.desc()).limit(1).scalar_subquery()
+    if postgresql:
+        agg = sa.select(
+            pt.c.topic_id, pt.c.group_id, pt.c.site_id,
+            sa.func.count(pt.c.post_id).label('num_posts'),
+            sa.func.max(pt.c.date).label('last_post_date'))
+        for clause in postScope:
+            agg = agg.where(clause)
+        agg = agg.group_by(
+            pt.c.topic_id, pt.c.group_id, pt.c.site_id).alias('agg')
+        u = tt.update().where(same_topic(tt, agg)).values(
+            num_posts=agg.c.num_posts,
+            last_post_date=agg.c.last_post_date,
+            last_post_id=lastPostId, first_post_id=earliestPostId,
+            original_subject=earliestSubject)
+    else:
+        # UPDATE ... FROM is not universal, so each aggregate is a
+        # correlated sub-query.
+        numPosts = sa.select(sa.func.count(p2.c.post_id)).where(
+            same_topic(p2, tt)).scalar_subquery()
+        lastPostDate = sa.select(sa.func.max(p2.c.date)).where(
+            same_topic(p2, tt)).scalar_subquery()
+        u = tt.update().where(sa.and_(
+            sa.exists().where(same_topic(pt, tt)),
+            *topicScope)).values(
+            num_posts=numPosts, last_post_date=lastPostDate,
+            last_post_id=lastPostId, first_post_id=earliestPostId,
+            original_subject=earliestSubject)
+
+    # Remove the topics that have no posts
+    hasPosts = sa.exists().where(same_topic(pt, tt))
+    d = tt.delete().where(sa.and_(~hasPosts, *topicScope))
+    retval = (i, u, d)
+    return retval
+
+
+def post_topics(postTable, postIds):
+    '''Select the ``(topic_id, group_id, site_id)`` of some posts'''
+    pt = postTable
+    retval = sa.select(pt.c.topic_id, pt.c.group_id, pt.c.site_id).where(
+        pt.c.post_id.in_(postIds)).distinct()
+    return retval
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#
+# Copyright © 2015 OnlineGroups.net and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+############################################################################
+from __future__ import absolute_import, unicode_literals
+from datetime import date, datetime
+from unittest import TestCase
+from gs.group.list.store.activity import (ActivitySummary, GroupActivity)
+
+
+class ActivityTest(TestCase):
+
+    def test_add(self):
+        a = GroupActivity()
+        a.add('x', 'Violence', 'durk', datetime(2015, 1, 1, 12, 0))
+        a.add('y', 'Gangland', 'dinsdale', datetime(2015, 1, 2, 12, 0))
+        a.add('x', 'Re: Violence', 'dinsdale', datetime(2015, 1, 2, 13, 0))
+        r = a.summary()
+
+        self.assertEqual([(date(2015, 1, 1), 1), (date(2015, 1, 2), 2)],
+                         r['posts_per_day'])
+        self.assertEqual(['x', 'y'], [t['topic_id'] for t in r['topics']])
+        self.assertEqual(2, r['topics'][0]['posts'])
+        self.assertEqual('Violence', r['topics'][0]['subject'])
+        self.assertEqual(['dinsdale', 'durk'],
+                         [u['user_id'] for u in r['authors']])
+        self.assertEqual(2, r['authors'][0]['posts'])
+
+    def test_bounded(self):
+        'Test that the oldest days, topics and authors are dropped'
+        a = GroupActivity(days=2, topics=2, authors=2)
+        for i in range(1, 4):
+            a.add('t{0}'.format(i), 'Violence', 'u{0}'.format(i),
+                  datetime(2015, 1, i, 12, 0))
+        r = a.summary()
+
+        self.assertEqual([date(2015, 1, 2), date(2015, 1, 3)],
+                         [d for d, n in r['posts_per_day']])
+        self.assertEqual(['t3', 't2'], [t['topic_id'] for t in r['topics']])
+        self.assertEqual(['u3', 'u2'], [u['user_id'] for u in r['authors']])
+
+    def test_out_of_order(self):
+        'Test that the days stay in order'
+        a = GroupActivity()
+        a.add('x', 'Violence', 'durk', datetime(2015, 1, 3, 12, 0))
+        a.add('x', 'Violence', 'durk', datetime(2015, 1, 1, 12, 0))
+        r = a.summary()
+
+        self.assertEqual([date(2015, 1, 1), date(2015, 1, 3)],
+                         [d for d, n in r['posts_per_day']])
+
+    def test_groups(self):
+        s = ActivitySummary()
+        s.record('example', 'ethel', 'x', 'Violence', 'durk',
+                 datetime(2015, 1, 1, 12, 0))
+
+        self.assertEqual(1, len(s.get('example', 'ethel')['topics']))
+        self.assertEqual([], s.get('example', 'other')['topics'])
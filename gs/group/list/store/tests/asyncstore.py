@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#
+# Copyright © 2015 OnlineGroups.net and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+############################################################################
+from __future__ import absolute_import, unicode_literals
+import asyncio
+from datetime import datetime
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase, skipIf
+import sqlalchemy as sa
+try:
+    import aiosqlite
+except ImportError:
+    aiosqlite = None  # lint:ok
+from gs.group.list.store.asyncstore import AsyncStorage
+from gs.group.list.store.statements import DuplicateMessageError
+
+
+@skipIf(aiosqlite is None, 'aiosqlite is not installed')
+class AsyncStorageTest(TestCase):
+    metadata = sa.MetaData()
+    postTable = sa.Table(
+        'post', metadata,
+        sa.Column('post_id', sa.Unicode, primary_key=True),
+        sa.Column('topic_id', sa.Unicode),
+        sa.Column('group_id', sa.Unicode),
+        sa.Column('site_id', sa.Unicode),
+        sa.Column('user_id', sa.Unicode),
+        sa.Column('subject', sa.Unicode),
+        sa.Column('date', sa.DateTime),
+        sa.Column('body', sa.UnicodeText),
+        sa.Column('has_attachments', sa.Boolean))
+    topicTable = sa.Table(
+        'topic', metadata,
+        sa.Column('topic_id', sa.Unicode, primary_key=True),
+        sa.Column('group_id', sa.Unicode, primary_key=True),
+        sa.Column('site_id', sa.Unicode, primary_key=True),
+        sa.Column('original_subject', sa.Unicode),
+        sa.Column('first_post_id', sa.Unicode),
+        sa.Column('last_post_id', sa.Unicode),
+        sa.Column('last_post_date', sa.DateTime),
+        sa.Column('num_posts', sa.Integer))
+    fileTable = sa.Table(
+        'file', metadata,
+        sa.Column('file_id', sa.Unicode, primary_key=True),
+        sa.Column('mime_type', sa.Unicode),
+        sa.Column('file_name', sa.Unicode),
+        sa.Column('file_size', sa.Integer),
+        sa.Column('date', sa.DateTime),
+        sa.Column('post_id', sa.Unicode),
+        sa.Column('topic_id', sa.Unicode))
+
+    def setUp(self):
+        self.tempDir = mkdtemp()
+        path = os.path.join(self.tempDir, 'posts.sqlite')
+        engine = sa.create_engine('sqlite:///' + path)
+        self.metadata.create_all(engine)
+        engine.dispose()
+        self.storage = AsyncStorage('sqlite+aiosqlite:///' + path, None)
+
+    def tearDown(self):
+        rmtree(self.tempDir)
+
+    def run_storage(self, coroutine):
+        'Run a coroutine, and close the storage, in a new event loop'
+        async def run():
+            try:
+                retval = await coroutine
+            finally:
+                await self.storage.close()
+            return retval
+        loop = asyncio.new_event_loop()
+        try:
+            retval = loop.run_until_complete(run())
+        finally:
+            loop.close()
+        return retval
+
+    async def rows(self, table):
+        async with self.storage.engine.connect() as connection:
+            r = await connection.execute(table.select())
+            retval = [dict(row._mapping) for row in r]
+        return retval
+
+    @staticmethod
+    def get_post(postId, day, topicId='x'):
+        retval = {
+            'post_id': postId,
+            'topic_id': topicId,
+            'group_id': 'ethel',
+            'site_id': 'example',
+            'user_id': 'dinsdale',
+            'subject': 'Violence',
+            'date': datetime(2015, 1, day, 12, 0),
+            'body': 'Tonight on Ethel the Frog',
+            'has_attachments': False, }
+        return retval
+
+    def test_insert(self):
+        'Test that the posts are added, and the topic is updated'
+        async def insert():
+            await self.storage.insert(self.get_post('b', 2))
+            await self.storage.insert(self.get_post('a', 1))
+            posts = await self.rows(self.postTable)
+            topics = await self.rows(self.topicTable)
+            return posts, topics
+        posts, topics = self.run_storage(insert())
+
+        self.assertEqual(['a', 'b'], sorted(p['post_id'] for p in posts))
+        self.assertEqual(1, len(topics))
+        self.assertEqual(2, topics[0]['num_posts'])
+        self.assertEqual('b', topics[0]['last_post_id'])
+        self.assertEqual(datetime(2015, 1, 2, 12, 0),
+                         topics[0]['last_post_date'])
+
+    def test_insert_duplicate(self):
+        'Test that a duplicate is spotted, and does not change the topic'
+        async def insert():
+            await self.storage.insert(self.get_post('a', 1))
+            with self.assertRaises(DuplicateMessageError):
+                await self.storage.insert(self.get_post('a', 1))
+            return await self.rows(self.topicTable)
+        topics = self.run_storage(insert())
+
+        self.assertEqual(1, topics[0]['num_posts'])
+
+    def test_insert_metadata(self):
+        'Test that the files are added, and the post is marked'
+        metadata = [{'file_id': 'f', 'mime_type': 'text/plain',
+                     'file_name': 'frog.txt', 'file_size': 4,
+                     'date': datetime(2015, 1, 1, 12, 0), 'post_id': 'a',
+                     'topic_id': 'x'}]
+
+        async def insert():
+            await self.storage.insert(self.get_post('a', 1), metadata)
+            await self.storage.insert(self.get_post('b', 2))
+            posts = await self.rows(self.postTable)
+            files = await self.rows(self.fileTable)
+            return posts, files
+        posts, files = self.run_storage(insert())
+
+        self.assertEqual(['f'], [f['file_id'] for f in files])
+        marked = dict((p['post_id'], p['has_attachments']) for p in posts)
+        self.assertEqual({'a': True, 'b': False}, marked)
+
+    def test_remove_many(self):
+        'Test that removing posts fixes their topics'
+        async def remove():
+            for postId, day in (('a', 1), ('b', 2), ('c', 3)):
+                await self.storage.insert(self.get_post(postId, day))
+            await self.storage.insert(self.get_post('d', 4, 'y'))
+            removed = await self.storage.remove_many(['c', 'd'])
+            topics = await self.rows(self.topicTable)
+            return removed, topics
+        removed, topics = self.run_storage(remove())
+
+        self.assertEqual(2, removed)
+        self.assertEqual(['x'], [t['topic_id'] for t in topics])
+        self.assertEqual(2, topics[0]['num_posts'])
+        self.assertEqual('b', topics[0]['last_post_id'])
+
+    def test_remove_first(self):
+        'Test that removing the first post of a topic sets a new first post'
+        async def remove():
+            await self.storage.insert(self.get_post('a', 1))
+            post = self.get_post('b', 2)
+            post['subject'] = 'Re: Violence'
+            await self.storage.insert(post)
+            await self.storage.remove_many(['a'])
+            return await self.rows(self.topicTable)
+        topics = self.run_storage(remove())
+
+        self.assertEqual(1, topics[0]['num_posts'])
+        self.assertEqual('b', topics[0]['first_post_id'])
+        self.assertEqual('Re: Violence', topics[0]['original_subject'])
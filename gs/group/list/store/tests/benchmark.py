@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#
+# Copyright © 2015 OnlineGroups.net and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+############################################################################
+'''Benchmark storing messages
+
+The messages are stored in SQLite (in memory by default) or a local
+PostgreSQL database, and the files in a fake ``FileLibrary2``::
+
+  python -m gs.group.list.store.tests.benchmark --corpus attachments
+
+The number of messages stored per second, the percentiles of the time
+taken by each stage, and the peak memory are reported.'''
+from __future__ import absolute_import, print_function, unicode_literals
+from argparse import ArgumentParser
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from mock import patch
+import os
+import sys
+from threading import Lock
+from timeit import default_timer
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None  # lint:ok
+    import resource
+import sqlalchemy as sa
+from sqlalchemy.orm import sessionmaker
+import transaction
+from zope.interface import implementer
+from zope.sqlalchemy import register
+from gs.group.list.base import EmailMessage
+from gs.group.list.store import queries
+from gs.group.list.store.cache import LRUCache
+from gs.group.list.store.interfaces import IStorageInstrumentation
+from gs.group.list.store.messagestore import (EmailMessageStore, store_many)
+
+
+def create_tables(engine):
+    '''Create the tables that messages are stored in
+
+The tables have the columns that are used by this product; the full
+definitions are in the Post code (``gs.group.messages.post``).'''
+    md = sa.MetaData()
+    sa.Table(
+        'post', md,
+        sa.Column('post_id', sa.Text, primary_key=True),
+        sa.Column('topic_id', sa.Text, nullable=False),
+        sa.Column('group_id', sa.Text, nullable=False),
+        sa.Column('site_id', sa.Text, nullable=False),
+        sa.Column('user_id', sa.Text, nullable=False),
+        sa.Column('in_reply_to', sa.Text, nullable=False),
+        sa.Column('subject', sa.Text, nullable=False),
+        sa.Column('date', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('body', sa.Text, nullable=False),
+        sa.Column('htmlbody', sa.Text),
+        sa.Column('header', sa.Text, nullable=False),
+        sa.Column('has_attachments', sa.Boolean, nullable=False))
+    sa.Table(
+        'topic', md,
+        sa.Column('topic_id', sa.Text, primary_key=True),
+        sa.Column('group_id', sa.Text, primary_key=True),
+        sa.Column('site_id', sa.Text, primary_key=True),
+        sa.Column('original_subject', sa.Text, nullable=False),
+        sa.Column('first_post_id', sa.Text, nullable=False),
+        sa.Column('last_post_id', sa.Text, nullable=False),
+        sa.Column('last_post_date', sa.DateTime(timezone=True),
+                  nullable=False),
+        sa.Column('num_posts', sa.Integer, nullable=False))
+    sa.Table(
+        'file', md,
+        sa.Column('file_id', sa.Text, primary_key=True),
+        sa.Column('mime_type', sa.Text, nullable=False),
+        sa.Column('file_name', sa.Text, nullable=False),
+        sa.Column('file_size', sa.Integer, nullable=False),
+        sa.Column('date', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('post_id', sa.Text, nullable=False),
+        sa.Column('topic_id', sa.Text, nullable=False))
+    sa.Table(
+        'file_digest', md,
+        sa.Column('digest', sa.Text, primary_key=True),
+        sa.Column('file_size', sa.Integer, primary_key=True),
+        sa.Column('file_id', sa.Text, nullable=False))
+    sa.Table(
+        'post_id_map', md,
+        sa.Column('old_post_id', sa.Text, primary_key=True),
+        sa.Column('new_post_id', sa.Text, nullable=False))
+    md.create_all(engine)
+    return md
+
+
+class FakeFile(object):
+    '''A file in the fake file storage'''
+
+    def __init__(self, data):
+        self.data = data
+        self.properties = {}
+
+    def manage_changeProperties(self, **kwargs):
+        self.properties.update(kwargs)
+
+    def update_data(self, data, contentType=None, size=None):
+        self.data = data
+
+    def reindex_file(self):
+        pass
+
+
+class FakeFileStorage(object):
+    '''A stand-in for the storage of the ``FileLibrary2``
+
+The files are read in chunks, like the real storage does, but only the
+size is kept.'''
+
+    def __init__(self):
+        self.files = {}
+
+    def add_file(self, data):
+        if hasattr(data, 'read'):
+            size = 0
+            chunk = data.read(64 * 1024)
+            while chunk:
+                size += len(chunk)
+                chunk = data.read(64 * 1024)
+        else:
+            size = len(data)
+        retval = 'f{0}'.format(len(self.files))
+        self.files[retval] = FakeFile(size)
+        return retval
+
+    def get_file(self, fileId):
+        return self.files.get(fileId)
+
+
+class FakeFileLibrary(object):
+    def __init__(self):
+        self.storage = FakeFileStorage()
+
+    def get_fileStorage(self):
+        return self.storage
+
+
+class FakeGroup(object):
+    def __init__(self):
+        self.FileLibrary2 = FakeFileLibrary()
+
+
+@implementer(IStorageInstrumentation)
+class DurationCollector(object):
+    '''Keep every duration for every stage, for the percentiles'''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.durations = {}
+
+    def record(self, postId, stage, duration, rows, size):
+        with self.lock:
+            self.durations.setdefault(stage, []).append(duration)
+
+    @staticmethod
+    def percentile(values, p):
+        values = sorted(values)
+        i = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+        retval = values[i]
+        return retval
+
+
+def get_message(n, subject, attachments=0, attachmentSize=0,
+                html=False):
+    '''Generate a message
+
+:param int n: The number of the message, which makes it unique.
+:param str subject: The subject, which picks the topic.
+:param int attachments: The number of files to attach.
+:param int attachmentSize: The size of each file, in bytes.
+:param bool html: Add a HTML body (``multipart/alternative``).
+:returns: The message, as a string.'''
+    text = 'Tonight on Ethel the Frog we look at violence ({0}).\n'.format(n)
+    if html:
+        body = MIMEMultipart('alternative')
+        body.attach(MIMEText(text, 'plain', 'utf-8'))
+        body.attach(MIMEText('<p>{0}</p>'.format(text), 'html', 'utf-8'))
+    else:
+        body = MIMEText(text, 'plain', 'utf-8')
+
+    if attachments:
+        retval = MIMEMultipart()
+        retval.attach(body)
+        for i in range(attachments):
+            f = MIMEApplication(os.urandom(attachmentSize))
+            f.add_header('Content-Disposition', 'attachment',
+                         filename='file-{0}-{1}.bin'.format(n, i))
+            retval.attach(f)
+    else:
+        retval = body
+    retval['From'] = 'Me <a.member@example.com>'
+    retval['To'] = 'Group <group@groups.example.com>'
+    retval['Subject'] = subject
+    retval['Message-ID'] = '<{0}@example.com>'.format(n)
+    return retval.as_string()
+
+
+#: The corpora, as functions that generate the ``n``th message.
+CORPORA = {
+    'plain': lambda n: get_message(n, 'Topic {0}'.format(n % 50)),
+    'alternative': lambda n: get_message(n, 'Topic {0}'.format(n % 50),
+                                         html=True),
+    'attachments': lambda n: get_message(n, 'Topic {0}'.format(n % 50),
+                                         attachments=8,
+                                         attachmentSize=32 * 1024),
+    'huge': lambda n: get_message(n, 'Topic {0}'.format(n % 50),
+                                  attachments=1,
+                                  attachmentSize=16 * 1024 * 1024),
+    'hot-topic': lambda n: get_message(n, 'Violence'),
+    'many-topics': lambda n: get_message(n, 'Topic {0}'.format(n)), }
+
+
+def peak_memory():
+    '''The peak memory use, in bytes, since the benchmark started'''
+    if tracemalloc is not None:
+        retval = tracemalloc.get_traced_memory()[1]
+    else:
+        # Kilobytes on Linux
+        retval = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return retval
+
+
+def store_batch(stores, batched):
+    '''Store a batch of messages in its own transaction
+
+:param list stores: The messages to store.
+:param bool batched: Store the messages using ``store_many``, rather than
+                     one at a time using ``store``.
+
+The session joins the transaction, as it does in Zope, so the commit and
+the after-commit hooks (which store the deferred attachments, and record
+the activity) are part of the time taken.'''
+    with transaction.manager:
+        if batched:
+            store_many(stores)
+        else:
+            for store in stores:
+                store.store()
+
+
+def run(corpus, count, dsn, batch):
+    '''Store the messages from a corpus, and report how it went'''
+    engine = sa.create_engine(dsn)
+    md = create_tables(engine)
+    session = sessionmaker(bind=engine)()
+    register(session)
+    collector = DurationCollector()
+    group = FakeGroup()
+    messages = [CORPORA[corpus](n) for n in range(count)]
+
+    with patch.object(queries, 'getSession', return_value=session), \
+            patch.object(queries, 'getTable', side_effect=md.tables.get), \
+            patch.dict(queries._tables, clear=True), \
+            patch.dict(queries._statements, clear=True), \
+            patch.dict(queries._compiled, clear=True), \
+            patch.object(queries, 'storedPostIds', LRUCache(4096)), \
+            patch.object(queries, 'topicCache', LRUCache(1024)), \
+            patch('gs.group.list.store.instrumentation.queryUtility',
+                  return_value=collector):
+        if tracemalloc is not None:
+            tracemalloc.start()
+        start = default_timer()
+        stores = []
+        for m in messages:
+            e = EmailMessage(m, list_title='Ethel the Frog',
+                             group_id='ethel', site_id='example')
+            stores.append(EmailMessageStore.from_email_message(group, e))
+            if len(stores) >= batch:
+                store_batch(stores, batch > 1)
+                stores = []
+        if stores:
+            store_batch(stores, batch > 1)
+        duration = default_timer() - start
+        peak = peak_memory()
+        if tracemalloc is not None:
+            tracemalloc.stop()
+
+    print('Corpus:          {0}'.format(corpus))
+    print('Messages:        {0}'.format(count))
+    print('Messages/second: {0:.1f}'.format(count / duration))
+    print('Peak memory:     {0:.1f}MB'.format(peak / (1024.0 * 1024.0)))
+    print('Stages timed:    each {0}'.format('message' if batch == 1
+                                             else 'batch'))
+    print('{0:<16}{1:>10}{2:>10}{3:>10}'.format('Stage (ms)', 'p50', 'p90',
+                                                'p99'))
+    for stage in sorted(collector.durations):
+        d = collector.durations[stage]
+        print('{0:<16}{1:>10.3f}{2:>10.3f}{3:>10.3f}'.format(
+            stage, collector.percentile(d, 50) * 1000,
+            collector.percentile(d, 90) * 1000,
+            collector.percentile(d, 99) * 1000))
+
+
+def main(args=None):
+    p = ArgumentParser(description='Benchmark storing messages.')
+    p.add_argument('--corpus', choices=sorted(CORPORA), default='plain',
+                   help='The messages to store (default "%(default)s").')
+    p.add_argument('--count', type=int, default=1000,
+                   help='The number of messages (default %(default)s).')
+    p.add_argument('--dsn', default='sqlite://',
+                   help='The database to store the messages in (default '
+                        '"%(default)s"). The tables are created if they '
+                        'are missing.')
+    p.add_argument('--batch', type=int, default=1,
+                   help='Store the messages in batches of this size using '
+                        'store_many, rather than one at a time using '
+                        'store (default %(default)s).')
+    a = p.parse_args(args)
+    run(a.corpus, a.count, a.dsn, a.batch)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#
+# Copyright © 2015 OnlineGroups.net and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+############################################################################
+from __future__ import absolute_import, unicode_literals
+from mock import patch
+from unittest import TestCase
+from gs.group.list.store.cache import LRUCache
+
+
+class LRUCacheTest(TestCase):
+
+    def test_set(self):
+        c = LRUCache()
+        c.set('a')
+
+        self.assertIn('a', c)
+        self.assertNotIn('b', c)
+
+    def test_full(self):
+        'Test that the oldest item is forgotten'
+        c = LRUCache(maxSize=2)
+        c.set('a', 1)
+        c.set('b', 2)
+        c.set('c', 3)
+
+        self.assertEqual(2, len(c))
+        self.assertIsNone(c.get('a'))
+        self.assertEqual(3, c.get('c'))
+
+    def test_recently_used(self):
+        'Test that getting an item stops it from being forgotten'
+        c = LRUCache(maxSize=2)
+        c.set('a', 1)
+        c.set('b', 2)
+        c.get('a')
+        c.set('c', 3)
+
+        self.assertEqual(1, c.get('a'))
+        self.assertIsNone(c.get('b'))
+
+    def test_discard(self):
+        c = LRUCache()
+        c.set('a')
+        c.discard('a')
+        c.discard('b')
+
+        self.assertNotIn('a', c)
+
+    @patch('gs.group.list.store.cache.time')
+    def test_ttl(self, t):
+        'Test that an item is forgotten once it expires'
+        t.time.return_value = 100
+        c = LRUCache(ttl=10)
+        c.set('a', 1)
+
+        t.time.return_value = 105
+        self.assertEqual(1, c.get('a'))
+        t.time.return_value = 111
+        self.assertIsNone(c.get('a'))
+        self.assertEqual(0, len(c))
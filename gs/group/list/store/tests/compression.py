@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#
+# Copyright © 2015 OnlineGroups.net and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+############################################################################
+from __future__ import absolute_import, unicode_literals
+from unittest import TestCase
+from gs.group.list.store.compression import (
+    COMPRESSED_PREFIX, compress_text, decompress_text, compress_post,
+    decode_post, trim_headers)
+
+
+class CompressionTest(TestCase):
+    html = '<p>Tonight on Ethel the Frog&#8230; we look at violence.</p>\n'
+
+    def test_compress(self):
+        'Test that large text is compressed, and can be decompressed'
+        t = self.html * 200
+        r = compress_text(t)
+
+        self.assertTrue(r.startswith(COMPRESSED_PREFIX))
+        self.assertLess(len(r), len(t))
+        self.assertEqual(t, decompress_text(r))
+
+    def test_compress_small(self):
+        'Test that small text is left alone'
+        r = compress_text(self.html)
+        self.assertEqual(self.html, r)
+        self.assertEqual(self.html, decompress_text(r))
+
+    def test_compress_none(self):
+        self.assertIsNone(compress_text(None))
+        self.assertIsNone(decompress_text(None))
+
+    def test_compress_post(self):
+        post = {'post_id': 'a', 'body': 'Violence',
+                'htmlbody': self.html * 200}
+        compress_post(post, ['htmlbody'])
+
+        self.assertEqual('Violence', post['body'])
+        self.assertTrue(post['htmlbody'].startswith(COMPRESSED_PREFIX))
+        r = decode_post(post)
+        self.assertEqual(self.html * 200, r['htmlbody'])
+
+    def test_compress_post_column(self):
+        'Test that only the large columns can be compressed'
+        with self.assertRaises(ValueError):
+            compress_post({'post_id': 'a'}, ['post_id'])
+
+    def test_trim_headers(self):
+        h = 'Received: from a.example.com\n'\
+            '\tby b.example.com\n'\
+            'Subject: Violence\n'\
+            'X-Spam-Score: 0\n'\
+            'Received: from c.example.com\n'\
+            'To: Group <group@groups.example.com>'
+        r = trim_headers(h, ['received', 'X-*'])
+
+        self.assertEqual('Subject: Violence\n'
+                         'To: Group <group@groups.example.com>', r)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#
+# Copyright © 2015 OnlineGroups.net and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+############################################################################
+from __future__ import absolute_import, unicode_literals
+from datetime import datetime, timedelta
+from mock import patch
+from unittest import TestCase
+from gs.group.list.store.dates import (get_timezone, parse_date,
+                                       parse_rfc2822)
+
+
+class DatesTest(TestCase):
+
+    def test_rfc2822(self):
+        r = parse_rfc2822('Tue, 20 Jan 2015 15:50:16 -0800')
+        self.assertEqual(datetime(2015, 1, 20, 15, 50, 16), r.replace(
+            tzinfo=None))
+        self.assertEqual(timedelta(hours=-8), r.utcoffset())
+
+    def test_rfc2822_comment(self):
+        'Test that the comment after the timezone is ignored'
+        r = parse_rfc2822('Sat, 10 Mar 2007 22:47:20 +1300 (NZDT)')
+        self.assertEqual(datetime(2007, 3, 10, 22, 47, 20), r.replace(
+            tzinfo=None))
+        self.assertEqual(timedelta(hours=13), r.utcoffset())
+
+    def test_rfc2822_obsolete(self):
+        'Test a date without the day, seconds, or a numeric zone'
+        r = parse_rfc2822('1 Feb 99 09:05 EST')
+        self.assertEqual(datetime(1999, 2, 1, 9, 5), r.replace(tzinfo=None))
+        self.assertEqual(timedelta(hours=-5), r.utcoffset())
+
+    def test_rfc2822_bad(self):
+        self.assertIsNone(parse_rfc2822('2015-01-20T15:50:16Z'))
+        self.assertIsNone(parse_rfc2822('Tue, 20 Foo 2015 15:50:16 -0800'))
+        self.assertIsNone(parse_rfc2822('Tue, 31 Feb 2015 15:50:16 -0800'))
+
+    def test_rfc2822_unknown_zone(self):
+        'Test that a zone that is not in the table is not taken as UTC'
+        self.assertIsNone(parse_rfc2822('Sat, 10 Mar 2007 22:47:20 NZDT'))
+
+    def test_timezone_cached(self):
+        self.assertIs(get_timezone(780), get_timezone(780))
+
+    @patch('gs.group.list.store.dates.parseDatetimetz')
+    def test_fast(self, parseDatetimetz):
+        'Test that the slow parser is not used for normal dates'
+        parse_date(' Tue, 20 Jan 2015 15:50:16 -0800 ')
+        self.assertEqual(0, parseDatetimetz.call_count)
+
+    @patch('gs.group.list.store.dates.parseDatetimetz')
+    def test_fallback(self, parseDatetimetz):
+        'Test that the slow parser is used for odd dates'
+        parse_date('2015-01-20 15:50:16 (Tuesday)')
+        parseDatetimetz.assert_called_once_with('2015-01-20 15:50:16')
+
+    @patch('gs.group.list.store.dates.parseDatetimetz')
+    def test_fallback_unknown_zone(self, parseDatetimetz):
+        'Test that the slow parser is used for a zone that is not known'
+        parse_date('Sat, 10 Mar 2007 22:47:20 NZDT')
+        parseDatetimetz.assert_called_once_with(
+            'Sat, 10 Mar 2007 22:47:20 NZDT')
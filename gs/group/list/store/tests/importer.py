@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#
+# Copyright © 2015 OnlineGroups.net and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+############################################################################
+from __future__ import absolute_import, unicode_literals
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from mock import (MagicMock, patch)
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+from gs.group.list.store.importer import (ArchiveImporter, Checkpoint,
+                                          iter_raw_messages, prepare)
+from gs.group.list.store.payload import spool_payload
+
+
+class CheckpointTest(TestCase):
+
+    def setUp(self):
+        self.tempDir = mkdtemp()
+        self.path = os.path.join(self.tempDir, 'archive.mbox.checkpoint')
+
+    def tearDown(self):
+        rmtree(self.tempDir)
+
+    def test_load_missing(self):
+        'Test that an import with no checkpoint starts at the beginning'
+        r = Checkpoint(self.path).load()
+        self.assertEqual(0, r)
+
+    def test_save_load(self):
+        Checkpoint(self.path).save(2000)
+        r = Checkpoint(self.path).load()
+        self.assertEqual(2000, r)
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+    def test_clear(self):
+        checkpoint = Checkpoint(self.path)
+        checkpoint.save(2000)
+        checkpoint.clear()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(0, checkpoint.load())
+
+    def test_resume(self):
+        'Test that the messages before the checkpoint are skipped'
+        box = MagicMock()
+        box.keys.return_value = ['c', 'a', 'd', 'b']
+        box.get_bytes.side_effect = lambda key: 'Message ' + key
+        Checkpoint(self.path).save(2)
+        done = Checkpoint(self.path).load()
+        r = list(iter_raw_messages(box, done))
+
+        self.assertEqual(['Message c', 'Message d'], r)
+
+
+class ArchiveImporterTest(TestCase):
+
+    @staticmethod
+    def get_prepared(postId, sender='member@example.com', files=None):
+        post = {'post_id': postId, 'user_id': '', 'subject': 'Violence'}
+        retval = (post, sender, files)
+        return retval
+
+    @staticmethod
+    def get_importer(senderIdCb=None):
+        retval = ArchiveImporter(MagicMock(), 'example', 'ethel', 'Ethel',
+                                 senderIdCb=senderIdCb)
+        return retval
+
+    @patch('gs.group.list.store.importer.BatchStorageQuery')
+    def test_store_batch_duplicates(self, BatchStorageQuery):
+        'Test that the posts that are already stored are skipped'
+        batchQuery = BatchStorageQuery()
+        batchQuery.existing_post_ids.return_value = set(['b'])
+        importer = self.get_importer(lambda address: 'a1')
+        prepared = [self.get_prepared('a'), self.get_prepared('b'),
+                    self.get_prepared('a')]
+        r = importer.store_batch(prepared)
+
+        self.assertEqual(1, r)
+        posts = batchQuery.insert_posts.call_args[0][0]
+        self.assertEqual(['a'], [p['post_id'] for p in posts])
+        batchQuery.insert_files.assert_called_once_with([])
+
+    @patch('gs.group.list.store.importer.BatchStorageQuery')
+    def test_store_batch_sender(self, BatchStorageQuery):
+        'Test that the identifiers of the senders are looked up, once'
+        BatchStorageQuery().existing_post_ids.return_value = set()
+        users = {'member@example.com': 'a1'}
+        senderIdCb = MagicMock(side_effect=users.get)
+        importer = self.get_importer(senderIdCb)
+        prepared = [self.get_prepared('a'), self.get_prepared('b'),
+                    self.get_prepared('c', 'stranger@example.com')]
+        importer.store_batch(prepared)
+
+        posts = BatchStorageQuery().insert_posts.call_args[0][0]
+        self.assertEqual(['a1', 'a1', ''], [p['user_id'] for p in posts])
+        self.assertEqual(2, senderIdCb.call_count)
+
+    def test_sender_id_user_folder(self):
+        'Test that the user folder of the group is used by default'
+        importer = self.get_importer()
+        userFolder = importer.group.acl_users
+        userFolder.get_userIdByEmail.return_value = 'a1'
+        r = importer.sender_id('member@example.com')
+
+        self.assertEqual('a1', r)
+        userFolder.get_userIdByEmail.assert_called_once_with(
+            'member@example.com')
+
+
+class PrepareTest(TestCase):
+
+    @staticmethod
+    def get_message():
+        retval = MIMEMultipart()
+        retval.attach(MIMEText('Tonight on Ethel the Frog we look at '
+                               'violence.\n', 'plain', 'utf-8'))
+        f = MIMEApplication(os.urandom(256 * 1024))
+        f.add_header('Content-Disposition', 'attachment',
+                     filename='gangland.bin')
+        retval.attach(f)
+        retval['From'] = 'Me <a.member@example.com>'
+        retval['To'] = 'Group <group@groups.example.com>'
+        retval['Subject'] = 'Violence'
+        retval['Message-ID'] = '<violence@example.com>'
+        retval['Date'] = 'Thu, 1 Jan 2015 12:00:00 +1300'
+        return retval
+
+    def test_prepare(self):
+        'Test that the worker only decodes the body, not the files'
+        raw = self.get_message().as_string()
+        with patch('gs.group.list.store.messagestore.spool_payload',
+                   wraps=spool_payload) as s:
+            post, sender, files = prepare((raw, 'Ethel the Frog', 'ethel',
+                                           'example'))
+
+        decoded = [c[0][0].get_content_type() for c in s.call_args_list]
+        self.assertEqual(['text/plain'], decoded)
+        self.assertIn('Ethel the Frog', post['body'])
+        self.assertTrue(post['has_attachments'])
+        self.assertEqual('a.member@example.com', sender)
+        self.assertEqual(raw, files)
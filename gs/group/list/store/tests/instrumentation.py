@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#
+# Copyright © 2015 OnlineGroups.net and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+############################################################################
+from __future__ import absolute_import, unicode_literals
+from mock import (MagicMock, patch)
+from unittest import TestCase
+from gs.group.list.store.instrumentation import (
+    MessageTimings, NullTimings, StageCollector, get_timings)
+
+
+class InstrumentationTest(TestCase):
+
+    @patch('gs.group.list.store.instrumentation.queryUtility')
+    def test_get_timings_off(self, queryUtility):
+        'Test that nothing is timed when there is no utility'
+        queryUtility.return_value = None
+        r = get_timings('a')
+        self.assertIsInstance(r, NullTimings)
+        with r.stage('post', rows=1):
+            pass
+
+    @patch('gs.group.list.store.instrumentation.queryUtility')
+    def test_get_timings(self, queryUtility):
+        'Test that the stages are recorded when there is a utility'
+        instrumentation = MagicMock()
+        queryUtility.return_value = instrumentation
+        r = get_timings('a')
+        self.assertIsInstance(r, MessageTimings)
+        with r.stage('add_file', size=42):
+            pass
+
+        self.assertEqual(1, instrumentation.record.call_count)
+        args, kwargs = instrumentation.record.call_args
+        self.assertEqual(('a', 'add_file'), args[:2])
+        self.assertEqual((0, 42), args[3:])
+
+    def test_stage_exception(self):
+        'Test that a stage that fails is recorded, and the error raised'
+        instrumentation = MagicMock()
+        timings = MessageTimings(instrumentation, 'a')
+        with self.assertRaises(ValueError):
+            with timings.stage('post'):
+                raise ValueError('Dinsdale')
+        self.assertEqual(1, instrumentation.record.call_count)
+
+    def test_collector(self):
+        c = StageCollector()
+        c.record('a', 'post', 0.5, 1, 0)
+        c.record('b', 'post', 0.25, 1, 0)
+        c.record('b', 'add_file', 0.125, 0, 1024)
+        r = c.snapshot()
+
+        self.assertEqual(2, r['post']['count'])
+        self.assertEqual(0.75, r['post']['duration'])
+        self.assertEqual(0.5, r['post']['max_duration'])
+        self.assertEqual(1024, r['add_file']['bytes'])
+
+    def test_prometheus(self):
+        c = StageCollector()
+        c.record('a', 'post', 0.5, 1, 0)
+        r = c.prometheus_text()
+
+        self.assertIn('# TYPE gs_group_list_store_stage_count counter', r)
+        self.assertIn('gs_group_list_store_stage_count{stage="post"} 1', r)
+        self.assertIn('gs_group_list_store_stage_seconds{stage="post"} 0.5',
+                      r)
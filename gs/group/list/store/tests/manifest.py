@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#
+# Copyright © 2015 OnlineGroups.net and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+############################################################################
+from __future__ import absolute_import, unicode_literals
+from unittest import TestCase
+from gs.group.list.store.manifest import (
+    AttachmentManifest, ARCHIVE, TEXT_BODY, HTML_BODY, INLINE, EMPTY,
+    classify)
+
+
+class AttachmentManifestTest(TestCase):
+
+    @staticmethod
+    def get_attachment(filename='', length=1, mimetype='text/plain',
+                       cid=''):
+        maintype, subtype = mimetype.split('/')
+        retval = {
+            'payload': b'',
+            'filename': filename,
+            'length': length,
+            'maintype': maintype,
+            'subtype': subtype,
+            'mimetype': mimetype,
+            'contentid': cid}
+        return retval
+
+    def test_classify(self):
+        self.assertEqual(TEXT_BODY, classify(self.get_attachment()))
+        self.assertEqual(HTML_BODY, classify(self.get_attachment(
+            mimetype='text/html')))
+        self.assertEqual(INLINE, classify(self.get_attachment(
+            mimetype='image/jpeg', cid='foo')))
+        self.assertEqual(EMPTY, classify(self.get_attachment(
+            filename='foo.jpg', mimetype='image/jpeg', length=0)))
+        self.assertEqual(ARCHIVE, classify(self.get_attachment(
+            filename='foo.jpg', mimetype='image/jpeg', cid='foo')))
+
+    def test_manifest(self):
+        attachments = [
+            self.get_attachment(),
+            self.get_attachment(mimetype='text/html'),
+            self.get_attachment(filename='foo.jpg', mimetype='image/jpeg'),
+            self.get_attachment(filename='empty.txt', length=0), ]
+        m = AttachmentManifest(attachments)
+
+        self.assertEqual(2, m.count)
+        self.assertEqual([attachments[2]], m.archivable)
+        self.assertEqual([TEXT_BODY, HTML_BODY, EMPTY],
+                         [c for a, c in m.skipped])
@@ -14,6 +14,7 @@
 ############################################################################
 from __future__ import absolute_import, unicode_literals
 import codecs
+from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.parser import Parser
@@ -23,7 +24,9 @@ from pkg_resources import resource_filename
 from unittest import TestCase
 from gs.group.list.base.emailmessage import EmailMessage
 import gs.group.list.store.messagestore  # lint:ok
-from gs.group.list.store.messagestore import (EmailMessageStore)
+from gs.group.list.store.messagestore import (EmailMessageStore, store_many)
+from gs.group.list.store.queries import (DuplicateMessageError,
+                                         forget_posts)
 
 
 class EmailMessageStoreTest(TestCase):
@@ -107,6 +110,93 @@ Tonight on Ethel the Frog we look at violence.\n'''
         r = self.messageStore.attachment_count
         self.assertEqual(2, r)
 
+    def get_files_msg(self, n):
+        retval = self.get_txt_html_msg()
+        for i in range(n):
+            textFile = MIMEText('The violence of British Gangland, part '
+                                '{0}.'.format(i))
+            textFile.add_header('Content-Disposition', 'attachment',
+                                filename='gangland{0}.txt'.format(i))
+            retval.attach(textFile)
+        return retval
+
+    def test_attachments_not_decoded(self):
+        'Test that a large attachment is never held in memory as a string'
+        m = self.get_txt_html_msg()
+        f = MIMEApplication(os.urandom(3 * 1024 * 1024))
+        f.add_header('Content-Disposition', 'attachment', filename='durk.bin')
+        m.attach(f)
+        self.messageStore.message = m
+        self.messageStore.spool_threshold = 64 * 1024
+        with patch.object(f, 'get_payload', wraps=f.get_payload) as gp:
+            body = self.messageStore.body
+            htmlBody = self.messageStore.html_body
+            self.messageStore.post_id
+            count = self.messageStore.attachment_count
+
+        decoded = [c for c in gp.call_args_list
+                   if c[1].get('decode') or (len(c[0]) > 1 and c[0][1])]
+        self.assertEqual([], decoded)
+        self.assertIn('Ethel the Frog', body)
+        self.assertIn('Ethel the Frog', htmlBody)
+        self.assertEqual(1, count)
+        a = self.messageStore.attachments[2]
+        self.assertEqual(('durk.bin', b''), (a['filename'], a['payload']))
+        self.assertEqual(3 * 1024 * 1024,
+                         self.messageStore.spooled_attachments[2]['length'])
+
+    def test_spool_in_threads(self):
+        'Test that the attachments decoded in threads keep their order'
+        self.messageStore.message = self.get_files_msg(5)
+        self.messageStore.attachment_threads = 3
+        r = self.messageStore.spooled_attachments
+
+        self.assertEqual(7, len(r))
+        self.assertEqual(['gangland{0}.txt'.format(i) for i in range(5)],
+                         [a['filename'] for a in r[2:]])
+        self.assertEqual([], self.messageStore.attachment_errors)
+
+    @patch('gs.group.list.store.messagestore.log')
+    def test_spool_error(self, l):
+        '''Test that an attachment that cannot be decoded is skipped, with
+or without threads'''
+        for threads in (0, 3):
+            messageStore = EmailMessageStore.from_email_message(
+                MagicMock(), self.message)
+            messageStore.message = self.get_files_msg(3)
+            messageStore.attachment_threads = threads
+            spool = messageStore.spool_attachment
+
+            def spool_attachment(part):
+                if part.get_filename() == 'gangland1.txt':
+                    raise ValueError('Durk')
+                return spool(part)
+            with patch.object(messageStore, 'spool_attachment',
+                              side_effect=spool_attachment):
+                r = messageStore.spooled_attachments
+
+            self.assertEqual(['gangland0.txt', 'gangland2.txt'],
+                             [a['filename'] for a in r[2:]])
+            errors = messageStore.attachment_errors
+            self.assertEqual(1, len(errors))
+            self.assertEqual('gangland1.txt', errors[0][0])
+
+    @patch('gs.group.list.store.messagestore.transaction')
+    @patch('gs.group.list.store.messagestore.log')
+    @patch('gs.group.list.store.messagestore.FileMetadataStorageQuery')
+    @patch('gs.group.list.store.messagestore.EmailMessageStorageQuery')
+    def test_store_attachment_errors(self, EmailMessageStorageQuery,
+                                     FileMetadataStorageQuery, l, t):
+        'Test that storing a message logs the attachments that were skipped'
+        self.messageStore.attachment_errors.append(
+            ('gangland1.txt', ValueError('Durk')))
+        with patch.object(self.messageStore, 'store_attachments',
+                          return_value=[]):
+            self.messageStore.store()
+
+        m = l.warn.call_args[0][0]
+        self.assertIn('gangland1.txt', m)
+
     @staticmethod
     def get_attachment(payload='', fileId='', filename='', length=0,
                        md5_sum='', encoding='utf-8', mimetype='text/plain',
@@ -192,6 +282,191 @@ used in the HTML body'''
             self.messageStore.store_attachment(a)
         addFileMock.assert_called_once_with(a, 'Violence', '')
 
+    def get_full_message_store(self):
+        testFile = os.path.join('tests', 'Testing_all_the_things.mbox')
+        filename = resource_filename('gs.group.list.store', testFile)
+        with codecs.open(filename, encoding='utf-8') as infile:
+            parser = Parser()
+            m = parser.parse(infile)
+        context = MagicMock()
+        retval = EmailMessageStore(
+            context, m, list_title='Ethel the Frog', group_id='ethel')
+        return retval
+
+    @patch('gs.group.list.store.messagestore.transaction')
+    @patch('gs.group.list.store.messagestore.log')
+    @patch('gs.group.list.store.messagestore.FileMetadataStorageQuery')
+    @patch('gs.group.list.store.messagestore.EmailMessageStorageQuery')
+    def test_full_message_deferred(self, EmailMessageStorageQuery,
+                                   FileMetadataStorageQuery, l, t):
+        'Test that the attachments are stored after the commit'
+        messageStore = self.get_full_message_store()
+        messageStore.defer_attachments = True
+        with patch.object(messageStore, 'add_file') as addFileMock:
+            addFileMock.side_effect = ['a', 'b', 'c']
+            post_id, fileIds = messageStore.store()
+            self.assertEqual(0, addFileMock.call_count)
+            self.assertEqual([], fileIds)
+            t.get().addAfterCommitHook.assert_called_once_with(
+                messageStore.store_attachments_after_commit)
+
+            messageStore.store_attachments_after_commit(True)
+        self.assertEqual(3, addFileMock.call_count)
+        insertMetadata = FileMetadataStorageQuery().insert_metadata
+        self.assertEqual(3, insertMetadata.call_count)
+
+    @patch('gs.group.list.store.messagestore.transaction')
+    @patch('gs.group.list.store.messagestore.log')
+    @patch('gs.group.list.store.messagestore.EmailMessageStorageQuery')
+    def test_store_rollback(self, EmailMessageStorageQuery, l, t):
+        'Test that only the message is rolled back when storing it fails'
+        EmailMessageStorageQuery().insert.side_effect = \
+            DuplicateMessageError('Violence')
+        with self.assertRaises(DuplicateMessageError):
+            self.messageStore.store()
+        t.savepoint().rollback.assert_called_once_with()
+        self.assertEqual(0, t.abort.call_count)
+        # The post is stored, so it is not forgotten
+        self.assertEqual(0, t.get().addAfterCommitHook.call_count)
+
+    @patch('gs.group.list.store.messagestore.transaction')
+    @patch('gs.group.list.store.messagestore.log')
+    @patch('gs.group.list.store.messagestore.EmailMessageStorageQuery')
+    def test_store_rollback_forget(self, EmailMessageStorageQuery, l, t):
+        'Test that a post that was rolled back is forgotten'
+        EmailMessageStorageQuery().insert.side_effect = ValueError('Bung')
+        with self.assertRaises(ValueError):
+            self.messageStore.store()
+        t.get().addAfterCommitHook.assert_called_once_with(
+            forget_posts, ([self.messageStore.post_id], ))
+
+    @patch('gs.group.list.store.messagestore.transaction')
+    @patch('gs.group.list.store.messagestore.activitySummary')
+    @patch('gs.group.list.store.messagestore.log')
+    @patch('gs.group.list.store.messagestore.FileMetadataStorageQuery')
+    @patch('gs.group.list.store.messagestore.EmailMessageStorageQuery')
+    def test_store_activity(self, EmailMessageStorageQuery,
+                            FileMetadataStorageQuery, l, activitySummary, t):
+        'Test that the activity is recorded once the post is committed'
+        self.messageStore.record_activity = True
+        self.messageStore.store()
+        t.get().addAfterCommitHook.assert_called_once_with(
+            self.messageStore.activity_after_commit)
+        self.assertEqual(0, activitySummary.record.call_count)
+
+        self.messageStore.activity_after_commit(True)
+        self.assertEqual(1, activitySummary.record.call_count)
+
+    @patch('gs.group.list.store.messagestore.log')
+    @patch('gs.group.list.store.messagestore.FileMetadataStorageQuery')
+    @patch('gs.group.list.store.messagestore.EmailMessageStorageQuery')
+    def test_store_index_search(self, EmailMessageStorageQuery,
+                                FileMetadataStorageQuery, l):
+        'Test that the search vector is set when the post is stored'
+        self.messageStore.index_search = True
+        self.messageStore.searchQuery = MagicMock()
+        self.messageStore.store()
+
+        self.messageStore.searchQuery.index_text.assert_called_once_with(
+            [self.messageStore.search_text()])
+
+    @patch('gs.group.list.store.messagestore.log')
+    @patch('gs.group.list.store.messagestore.FileMetadataStorageQuery')
+    @patch('gs.group.list.store.messagestore.EmailMessageStorageQuery')
+    def test_store_index_search_compressed(self, EmailMessageStorageQuery,
+                                           FileMetadataStorageQuery, l):
+        'Test that the search vector is built from the uncompressed body'
+        self.messageStore.index_search = True
+        self.messageStore.compress_columns = ('body', )
+        self.messageStore.compress_threshold = 0
+        self.messageStore.searchQuery = MagicMock()
+        self.messageStore.store()
+
+        posts = self.messageStore.searchQuery.index_text.call_args[0][0]
+        self.assertEqual(self.messageStore.body, posts[0]['body'])
+        self.assertIn('violence', posts[0]['body'])
+
+    @patch('gs.group.list.store.messagestore.transaction')
+    @patch('gs.group.list.store.messagestore.log')
+    @patch('gs.group.list.store.messagestore.FileMetadataStorageQuery')
+    @patch('gs.group.list.store.messagestore.EmailMessageStorageQuery')
+    def test_store_write_behind(self, EmailMessageStorageQuery,
+                                FileMetadataStorageQuery, l, t):
+        'Test that the post is spooled, rather than written, at the commit'
+        EmailMessageStorageQuery().stored.return_value = False
+        writeBehind = MagicMock()
+        writeBehind.__contains__.return_value = False
+        self.messageStore.write_behind = writeBehind
+        self.messageStore.store()
+
+        self.assertEqual(0, EmailMessageStorageQuery().insert.call_count)
+        self.assertEqual(0, FileMetadataStorageQuery().insert_metadata.
+                         call_count)
+        post = EmailMessageStorageQuery().post_values()
+        writeBehind.append_at_commit.assert_called_once_with(post, [])
+
+    @patch('gs.group.list.store.messagestore.transaction')
+    @patch('gs.group.list.store.messagestore.log')
+    @patch('gs.group.list.store.messagestore.EmailMessageStorageQuery')
+    def test_store_write_behind_duplicate(self, EmailMessageStorageQuery,
+                                          l, t):
+        'Test that a post that is in the spool is a duplicate'
+        writeBehind = MagicMock()
+        writeBehind.__contains__.return_value = True
+        self.messageStore.write_behind = writeBehind
+
+        with self.assertRaises(DuplicateMessageError):
+            self.messageStore.store()
+        self.assertEqual(0, t.get().addAfterCommitHook.call_count)
+
+    @patch('gs.group.list.store.messagestore.transaction')
+    @patch('gs.group.list.store.messagestore.log')
+    @patch('gs.group.list.store.messagestore.FileMetadataStorageQuery')
+    def test_after_commit_aborted(self, FileMetadataStorageQuery, l, t):
+        'Test that the attachments are not stored if the post is not'
+        messageStore = self.get_full_message_store()
+        with patch.object(messageStore, 'add_file') as addFileMock:
+            messageStore.store_attachments_after_commit(False)
+        self.assertEqual(0, addFileMock.call_count)
+
+    def test_add_file_duplicate(self):
+        'Test that the content of a duplicate file is shared'
+        p = b'This is not an image'
+        a = self.get_attachment(payload=p, length=len(p), md5_sum='abc',
+                                mimetype='image/jpeg', filename='foo.jpg')
+        self.messageStore.deduplicate_files = True
+        self.messageStore.digestQuery = MagicMock()
+        self.messageStore.digestQuery.get_file_id.return_value = 'a'
+        storage = self.messageStore.storage
+        storage.add_file.return_value = 'b'
+
+        r = self.messageStore.add_file(a, 'Violence', '')
+        self.assertEqual('b', r)
+        self.messageStore.digestQuery.get_file_id.assert_called_once_with(
+            'abc', len(p))
+        storage.add_file.assert_called_once_with(b'')
+        storage.get_file().update_data.assert_called_once_with(
+            storage.get_file().data, 'image/jpeg', len(p))
+        digestQuery = self.messageStore.digestQuery
+        self.assertEqual(0, digestQuery.set_file_id.call_count)
+
+    def test_add_file_new(self):
+        'Test that a new file is recorded so it can be shared'
+        p = b'This is not an image'
+        a = self.get_attachment(payload=p, length=len(p), md5_sum='abc',
+                                mimetype='image/jpeg', filename='foo.jpg')
+        self.messageStore.deduplicate_files = True
+        self.messageStore.digestQuery = MagicMock()
+        self.messageStore.digestQuery.get_file_id.return_value = None
+        storage = self.messageStore.storage
+        storage.add_file.return_value = 'b'
+
+        r = self.messageStore.add_file(a, 'Violence', '')
+        self.assertEqual('b', r)
+        storage.add_file.assert_called_once_with(p)
+        self.messageStore.digestQuery.set_file_id.assert_called_once_with(
+            'abc', len(p), 'b')
+
     @patch('gs.group.list.store.messagestore.log')
     @patch('gs.group.list.store.messagestore.FileMetadataStorageQuery')
     @patch('gs.group.list.store.messagestore.EmailMessageStorageQuery')
@@ -225,3 +500,146 @@ used in the HTML body'''
         self.assertIn('gs-logo.svg', filenames)
         self.assertIn('mobile-email-file-link-test.jpg', filenames)
         self.assertIn('gs-14.11-announcement.txt', filenames)
+
+
+class StoreManyTest(TestCase):
+    m = '''From: Me <a.member@example.com>
+Subject: {0}
+To: Group <group@groups.example.com>
+Message-ID: <{1}@example.com>
+
+Tonight on Ethel the Frog we look at {0}.\n'''
+
+    def get_store(self, subject, messageId):
+        message = EmailMessage(self.m.format(subject, messageId),
+                               list_title='Ethel the Frog', group_id='ethel')
+        context = MagicMock()
+        retval = EmailMessageStore.from_email_message(context, message)
+        retval.emailQuery = MagicMock()
+        retval.emailQuery.post_values.return_value = {
+            'post_id': retval.post_id}
+        return retval
+
+    @patch('gs.group.list.store.messagestore.log')
+    @patch('gs.group.list.store.messagestore.BatchStorageQuery')
+    def test_store_many(self, BatchStorageQuery, l):
+        'Test that all the messages are stored in one batch'
+        batchQuery = BatchStorageQuery()
+        batchQuery.existing_post_ids.return_value = set()
+        stores = [self.get_store('violence', 'a'),
+                  self.get_store('gangland', 'b')]
+        r = store_many(stores)
+
+        self.assertEqual([(s.post_id, []) for s in stores], r)
+        batchQuery.insert_posts.assert_called_once_with(
+            [{'post_id': s.post_id} for s in stores])
+        self.assertEqual(1, batchQuery.update_topics.call_count)
+        batchQuery.insert_files.assert_called_once_with([])
+
+    @patch('gs.group.list.store.messagestore.log')
+    @patch('gs.group.list.store.messagestore.BatchStorageQuery')
+    def test_store_many_duplicate(self, BatchStorageQuery, l):
+        'Test that a duplicate does not stop the batch'
+        stores = [self.get_store('violence', 'a'),
+                  self.get_store('gangland', 'b'),
+                  self.get_store('violence', 'a')]
+        batchQuery = BatchStorageQuery()
+        batchQuery.existing_post_ids.return_value = set([stores[1].post_id])
+        r = store_many(stores)
+
+        self.assertEqual(3, len(r))
+        self.assertEqual((stores[0].post_id, []), r[0])
+        self.assertIsInstance(r[1], DuplicateMessageError)
+        self.assertIsInstance(r[2], DuplicateMessageError)
+        batchQuery.insert_posts.assert_called_once_with(
+            [{'post_id': stores[0].post_id}])
+
+    @patch('gs.group.list.store.instrumentation.queryUtility')
+    @patch('gs.group.list.store.messagestore.log')
+    @patch('gs.group.list.store.messagestore.BatchStorageQuery')
+    def test_store_many_timings(self, BatchStorageQuery, l, queryUtility):
+        'Test that the stages of writing the batch are timed'
+        batchQuery = BatchStorageQuery()
+        batchQuery.existing_post_ids.return_value = set()
+        batchQuery.aggregate_topics.return_value = [{}]
+        instrumentation = queryUtility()
+        stores = [self.get_store('violence', 'a'),
+                  self.get_store('gangland', 'b')]
+        store_many(stores)
+
+        r = dict([(c[0][1], c[0][3])
+                  for c in instrumentation.record.call_args_list
+                  if c[0][0] is None])
+        self.assertEqual({'duplicate': 2, 'post': 2, 'topic': 1,
+                          'file_metadata': 0, 'store_many': 2}, r)
+
+    @patch('gs.group.list.store.messagestore.log')
+    @patch('gs.group.list.store.messagestore.BatchStorageQuery')
+    def test_store_many_no_topics(self, BatchStorageQuery, l):
+        'Test that the topics can be left to be rebuilt later'
+        batchQuery = BatchStorageQuery()
+        batchQuery.existing_post_ids.return_value = set()
+        stores = [self.get_store('violence', 'a')]
+        store_many(stores, update_topics=False)
+
+        self.assertEqual(1, batchQuery.insert_posts.call_count)
+        self.assertEqual(0, batchQuery.update_topics.call_count)
+
+    @patch('gs.group.list.store.messagestore.transaction')
+    @patch('gs.group.list.store.messagestore.log')
+    @patch('gs.group.list.store.messagestore.BatchStorageQuery')
+    def test_store_many_fallback(self, BatchStorageQuery, l, t):
+        'Test that the messages are stored one at a time if the batch fails'
+        batchQuery = BatchStorageQuery()
+        batchQuery.existing_post_ids.return_value = set()
+        batchQuery.insert_files.side_effect = ValueError('Gangland')
+        stores = [self.get_store('violence', 'a'),
+                  self.get_store('gangland', 'b')]
+        error = DuplicateMessageError('Gangland')
+        with patch.object(stores[0], 'store') as store0, \
+                patch.object(stores[1], 'store') as store1:
+            store0.return_value = (stores[0].post_id, [])
+            store1.side_effect = error
+            r = store_many(stores)
+
+        t.savepoint().rollback.assert_called_once_with()
+        self.assertEqual([(stores[0].post_id, []), error], r)
+
+    def get_files_store(self, subject, messageId):
+        m = MIMEMultipart()
+        m['From'] = 'Me <a.member@example.com>'
+        m['Subject'] = subject
+        m['To'] = 'Group <group@groups.example.com>'
+        m['Message-ID'] = '<{0}@example.com>'.format(messageId)
+        m.attach(MIMEText('Tonight on Ethel the Frog we look at '
+                          '{0}.'.format(subject)))
+        textFile = MIMEText('The violence of British Gangland.')
+        textFile.add_header('Content-Disposition', 'attachment',
+                            filename='gangland.txt')
+        m.attach(textFile)
+        retval = self.get_store(subject, messageId)
+        retval.message = Parser().parsestr(m.as_string())
+        return retval
+
+    @patch('gs.group.list.store.messagestore.transaction')
+    @patch('gs.group.list.store.messagestore.log')
+    @patch('gs.group.list.store.messagestore.FileMetadataStorageQuery')
+    @patch('gs.group.list.store.messagestore.BatchStorageQuery')
+    def test_store_many_fallback_attachments(self, BatchStorageQuery,
+                                             FileMetadataStorageQuery, l, t):
+        'Test that the attachments are decoded again if the batch fails'
+        batchQuery = BatchStorageQuery()
+        batchQuery.existing_post_ids.return_value = set()
+        batchQuery.insert_files.side_effect = ValueError('Gangland')
+        store = self.get_files_store('violence', 'a')
+        contents = []
+
+        def add_file(payload):
+            contents.append(payload.read())
+            return 'f{0}'.format(len(contents))
+        store.storage.add_file.side_effect = add_file
+        r = store_many([store])
+
+        self.assertEqual([(store.post_id, ['f2'])], r)
+        self.assertEqual(2, len(contents))
+        self.assertEqual(contents[0], contents[1])
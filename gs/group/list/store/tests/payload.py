@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#
+# Copyright © 2015 OnlineGroups.net and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+############################################################################
+from __future__ import absolute_import, unicode_literals
+from base64 import b64encode
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from unittest import TestCase
+from gs.group.list.store.payload import (iter_base64, leaf_parts,
+                                         spool_payload)
+
+
+class PayloadTest(TestCase):
+    data = b'When he grew up he took to putting the boot in.\n' * 100
+
+    def test_iter_base64(self):
+        'Test decoding base64 in pieces that are not a multiple of four'
+        encoded = b64encode(self.data).decode('ascii')
+        r = b''.join(iter_base64(encoded, chunkSize=7))
+        self.assertEqual(self.data, r)
+
+    def test_iter_base64_no_padding(self):
+        'Test decoding base64 that has lost its padding'
+        encoded = b64encode(b'Dinsdale').decode('ascii').rstrip('=')
+        r = b''.join(iter_base64(encoded))
+        self.assertEqual(b'Dinsdale', r)
+
+    def test_leaf_parts(self):
+        m = MIMEMultipart()
+        a = MIMEMultipart('alternative')
+        a.attach(MIMEText('Violence', 'plain'))
+        a.attach(MIMEText('<p>Violence</p>', 'html'))
+        m.attach(a)
+        m.attach(MIMEApplication(self.data))
+        r = leaf_parts(m)
+
+        self.assertEqual(
+            ['text/plain', 'text/html', 'application/octet-stream'],
+            [p.get_content_type() for p in r])
+
+    def test_spool(self):
+        'Test that a large payload is decoded to disk'
+        part = MIMEApplication(self.data)
+        outfile, length, md5Sum = spool_payload(part, threshold=16)
+
+        self.assertEqual(len(self.data), length)
+        self.assertTrue(outfile._rolled)
+        self.assertEqual(self.data, outfile.read())
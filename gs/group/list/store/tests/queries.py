@@ -0,0 +1,519 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#
+# Copyright © 2015 OnlineGroups.net and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+############################################################################
+from __future__ import absolute_import, unicode_literals
+from datetime import datetime
+from mock import (MagicMock, patch)
+from unittest import TestCase
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+import sqlalchemy.orm  # lint:ok
+from gs.group.list.store import queries
+from gs.group.list.store.cache import LRUCache
+from gs.group.list.store.compression import compress_text
+from gs.group.list.store.instrumentation import NullTimings
+from gs.group.list.store.queries import (
+    ArchiveQuery, BatchStorageQuery, EmailMessageStorageQuery,
+    FileMetadataStorageQuery, SearchIndexQuery, TopicStorageQuery, execute,
+    get_statement, get_table)
+
+
+class BatchStorageQueryTest(TestCase):
+
+    @staticmethod
+    def get_post(postId, topicId, day, subject='Violence'):
+        retval = {
+            'post_id': postId,
+            'topic_id': topicId,
+            'group_id': 'ethel',
+            'site_id': 'example',
+            'subject': subject,
+            'date': datetime(2015, 1, day, 12, 0), }
+        return retval
+
+    def test_aggregate_one(self):
+        'Test aggregating a single post'
+        posts = [self.get_post('a', 'x', 1)]
+        r = BatchStorageQuery.aggregate_topics(posts)
+
+        self.assertEqual(1, len(r))
+        self.assertEqual(1, r[0]['num_posts'])
+        self.assertEqual('a', r[0]['first_post_id'])
+        self.assertEqual('a', r[0]['last_post_id'])
+
+    def test_aggregate_topic(self):
+        'Test aggregating posts that are out of order'
+        posts = [self.get_post('b', 'x', 2, 'Re: Violence'),
+                 self.get_post('c', 'x', 3, 'Re: Violence'),
+                 self.get_post('a', 'x', 1)]
+        r = BatchStorageQuery.aggregate_topics(posts)
+
+        self.assertEqual(1, len(r))
+        self.assertEqual(3, r[0]['num_posts'])
+        self.assertEqual('a', r[0]['first_post_id'])
+        self.assertEqual('Violence', r[0]['original_subject'])
+        self.assertEqual('c', r[0]['last_post_id'])
+        self.assertEqual(datetime(2015, 1, 3, 12, 0),
+                         r[0]['last_post_date'])
+
+    def test_aggregate_topics(self):
+        'Test aggregating posts in different topics'
+        posts = [self.get_post('a', 'x', 1),
+                 self.get_post('b', 'y', 2),
+                 self.get_post('c', 'x', 3)]
+        r = BatchStorageQuery.aggregate_topics(posts)
+
+        self.assertEqual(2, len(r))
+        self.assertEqual(['x', 'y'], [t['topic_id'] for t in r])
+        self.assertEqual([2, 1], [t['num_posts'] for t in r])
+
+
+class EmailMessageStorageQueryTest(TestCase):
+
+    @patch('gs.group.list.store.queries.get_table')
+    @patch('gs.group.list.store.queries.RemoveQuery')
+    def test_remove(self, RemoveQuery, g):
+        'Test that removing a message removes its post, and fixes the topic'
+        message = MagicMock()
+        message.post_id = 'a'
+        q = EmailMessageStorageQuery(message)
+        q.remove()
+
+        RemoveQuery().remove_many.assert_called_once_with(['a'])
+
+    @patch('gs.group.list.store.queries.get_table')
+    def test_plain_message(self, g):
+        'Test the query for a message without the options of the store'
+        message = MagicMock(spec=['post_id', 'topic_id', 'group_id',
+                                  'site_id', 'sender_id', 'inreplyto',
+                                  'subject', 'date', 'body', 'html_body',
+                                  'headers', 'attachment_count'])
+        message.attachment_count = 0
+        message.headers = 'Subject: Violence'
+        q = EmailMessageStorageQuery(message)
+
+        self.assertIsNone(q.topicQuery.cache)
+        self.assertIsInstance(q.timings, NullTimings)
+        self.assertEqual('Subject: Violence', q.post_values()['header'])
+
+
+class SearchIndexQueryTest(TestCase):
+    metadata = sa.MetaData()
+    tables = {
+        'post': sa.Table('post', metadata,
+                         sa.Column('post_id', sa.Unicode, primary_key=True),
+                         sa.Column('subject', sa.Unicode),
+                         sa.Column('body', sa.UnicodeText)),
+        'post_search': sa.Table('post_search', metadata,
+                                sa.Column('post_id', sa.Unicode,
+                                          primary_key=True),
+                                sa.Column('search_vector', sa.UnicodeText)),
+    }
+
+    @patch('gs.group.list.store.queries.supports_upsert')
+    @patch('gs.group.list.store.queries.getSession')
+    @patch('gs.group.list.store.queries.get_table')
+    def test_index_compressed(self, get_table, getSession, supports_upsert):
+        'Test that a compressed body is decompressed before it is indexed'
+        get_table.side_effect = self.tables.get
+        supports_upsert.return_value = True
+        body = 'Tonight on Ethel the Frog we look at violence. ' * 200
+        getSession().execute().mappings.return_value = [
+            {'post_id': 'a', 'subject': 'Violence',
+             'body': compress_text(body)}]
+        q = SearchIndexQuery()
+        with patch.object(q, 'index_text') as index_text:
+            q.index_posts(['a'])
+
+        index_text.assert_called_once_with(
+            [{'post_id': 'a', 'subject': 'Violence', 'body': body}])
+
+
+class ArchiveQueryTest(TestCase):
+    '''Test the pages of the archive, using SQLite'''
+    metadata = sa.MetaData()
+    tables = {
+        'topic': sa.Table('topic', metadata,
+                          sa.Column('topic_id', sa.Unicode, primary_key=True),
+                          sa.Column('group_id', sa.Unicode),
+                          sa.Column('site_id', sa.Unicode),
+                          sa.Column('original_subject', sa.Unicode),
+                          sa.Column('first_post_id', sa.Unicode),
+                          sa.Column('last_post_id', sa.Unicode),
+                          sa.Column('last_post_date', sa.DateTime),
+                          sa.Column('num_posts', sa.Integer)),
+        'post': sa.Table('post', metadata,
+                         sa.Column('post_id', sa.Unicode, primary_key=True),
+                         sa.Column('topic_id', sa.Unicode),
+                         sa.Column('user_id', sa.Unicode),
+                         sa.Column('subject', sa.Unicode),
+                         sa.Column('date', sa.DateTime),
+                         sa.Column('body', sa.UnicodeText),
+                         sa.Column('htmlbody', sa.UnicodeText),
+                         sa.Column('has_attachments', sa.Boolean)),
+        'file': sa.Table('file', metadata,
+                         sa.Column('file_id', sa.Unicode, primary_key=True),
+                         sa.Column('file_name', sa.Unicode),
+                         sa.Column('mime_type', sa.Unicode),
+                         sa.Column('file_size', sa.Integer),
+                         sa.Column('date', sa.DateTime),
+                         sa.Column('post_id', sa.Unicode),
+                         sa.Column('topic_id', sa.Unicode)),
+    }
+
+    def setUp(self):
+        self.engine = sa.create_engine('sqlite://')
+        self.metadata.create_all(self.engine)
+        self.connection = self.engine.connect()
+        patchers = [
+            patch('gs.group.list.store.queries.get_table',
+                  side_effect=self.tables.get),
+            patch('gs.group.list.store.queries.getSession',
+                  return_value=self.connection)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # Two topics end at the same time, and so do two posts and two files
+        topics = [('a', 1), ('b', 3), ('c', 3), ('d', 2), ('e', 5)]
+        self.connection.execute(self.tables['topic'].insert(), [
+            {'topic_id': topicId, 'group_id': 'ethel', 'site_id': 'example',
+             'last_post_date': datetime(2015, 1, day, 12, 0)}
+            for topicId, day in topics])
+        self.connection.execute(self.tables['topic'].insert(), [
+            {'topic_id': 'z', 'group_id': 'frog', 'site_id': 'example',
+             'last_post_date': datetime(2015, 1, 9, 12, 0)}])
+        posts = [('p1', 1), ('p2', 2), ('p3', 2), ('p4', 3), ('p5', 4)]
+        self.connection.execute(self.tables['post'].insert(), [
+            {'post_id': postId, 'topic_id': 'a', 'subject': 'Violence',
+             'date': datetime(2015, 1, day, 12, 0), 'body': 'Frog'}
+            for postId, day in posts])
+        files = [('f1', 1), ('f2', 2), ('f3', 2)]
+        self.connection.execute(self.tables['file'].insert(), [
+            {'file_id': fileId, 'topic_id': 'a', 'post_id': 'p1',
+             'date': datetime(2015, 1, day, 12, 0)}
+            for fileId, day in files])
+
+    def tearDown(self):
+        self.connection.close()
+        self.engine.dispose()
+
+    @staticmethod
+    def all_pages(getPage, key, limit):
+        '''Get every page, passing the key of the last row of each page to
+get the next'''
+        retval = []
+        page = getPage(limit, None)
+        while page:
+            retval.append(page)
+            page = getPage(limit, key(page[-1]))
+        return retval
+
+    def test_topics(self):
+        q = ArchiveQuery()
+        r = q.topics('example', 'ethel')
+
+        self.assertEqual(['e', 'c', 'b', 'd', 'a'],
+                         [t['topic_id'] for t in r])
+
+    def test_topics_pages(self):
+        'Test that the topics that end at the same time are on the pages'
+        q = ArchiveQuery()
+        r = self.all_pages(
+            lambda limit, before: q.topics('example', 'ethel', limit,
+                                           before),
+            lambda t: (t['last_post_date'], t['topic_id']), 2)
+
+        self.assertEqual([['e', 'c'], ['b', 'd'], ['a']],
+                         [[t['topic_id'] for t in p] for p in r])
+
+    def test_topics_empty(self):
+        q = ArchiveQuery()
+        r = q.topics('example', 'graham')
+
+        self.assertEqual([], r)
+
+    def test_topics_last_page(self):
+        'Test that the page after the last is empty'
+        q = ArchiveQuery()
+        last = q.topics('example', 'ethel', 5)[-1]
+        r = q.topics('example', 'ethel', 5,
+                     (last['last_post_date'], last['topic_id']))
+
+        self.assertEqual([], r)
+
+    def test_posts_pages(self):
+        'Test that the posts made at the same time are on the pages'
+        q = ArchiveQuery()
+        r = self.all_pages(
+            lambda limit, after: q.posts('a', limit, after),
+            lambda p: (p['date'], p['post_id']), 2)
+
+        self.assertEqual([['p1', 'p2'], ['p3', 'p4'], ['p5']],
+                         [[p['post_id'] for p in page] for page in r])
+        self.assertNotIn('body', r[0][0])
+
+    def test_posts_body(self):
+        'Test that the bodies are read only when they are asked for'
+        q = ArchiveQuery()
+        r = q.posts('a', 1, withBody=True)
+
+        self.assertEqual('Frog', r[0]['body'])
+
+    def test_posts_empty(self):
+        q = ArchiveQuery()
+        r = q.posts('b')
+
+        self.assertEqual([], r)
+
+    def test_files_pages(self):
+        'Test that the files posted at the same time are on the pages'
+        q = ArchiveQuery()
+        r = self.all_pages(
+            lambda limit, after: q.files('a', limit, after),
+            lambda f: (f['date'], f['file_id']), 2)
+
+        self.assertEqual([['f1', 'f2'], ['f3']],
+                         [[f['file_id'] for f in page] for page in r])
+
+    def test_files_empty(self):
+        q = ArchiveQuery()
+        r = q.files('b')
+
+        self.assertEqual([], r)
+
+
+class StatementCacheTest(TestCase):
+
+    @patch.dict('gs.group.list.store.queries._tables', clear=True)
+    @patch('gs.group.list.store.queries.getTable')
+    def test_get_table(self, getTable):
+        'Test that a table is only looked up once'
+        r1 = get_table('post')
+        r2 = get_table('post')
+
+        self.assertIs(r1, r2)
+        getTable.assert_called_once_with('post')
+
+    @patch.dict('gs.group.list.store.queries._statements', clear=True)
+    def test_get_statement(self):
+        'Test that a statement is only built once'
+        factory = MagicMock()
+        r1 = get_statement('post_insert', factory)
+        r2 = get_statement('post_insert', factory)
+
+        self.assertIs(r1, r2)
+        self.assertEqual(1, factory.call_count)
+
+    @patch.dict('gs.group.list.store.queries._compiled', clear=True)
+    def test_execute(self):
+        'Test that the compiled statement is reused'
+        engine = sa.create_engine('sqlite://')
+        t = sa.Table('post', sa.MetaData(),
+                     sa.Column('post_id', sa.Unicode, primary_key=True))
+        t.create(engine)
+        session = sa.orm.sessionmaker(bind=engine)()
+        i = t.insert()
+        execute(session, i, {'post_id': 'a'})
+        execute(session, i, {'post_id': 'b'})
+
+        self.assertEqual(1, len(queries._compiled))
+        r = session.execute(sa.select(sa.func.count(t.c.post_id)))
+        self.assertEqual(2, r.scalar())
+        session.close()
+
+
+class TopicStorageQueryTest(TestCase):
+    metadata = sa.MetaData()
+    topicTable = sa.Table(
+        'topic', metadata,
+        sa.Column('topic_id', sa.Unicode, primary_key=True),
+        sa.Column('group_id', sa.Unicode, primary_key=True),
+        sa.Column('site_id', sa.Unicode, primary_key=True),
+        sa.Column('original_subject', sa.Unicode),
+        sa.Column('first_post_id', sa.Unicode),
+        sa.Column('last_post_id', sa.Unicode),
+        sa.Column('last_post_date', sa.DateTime),
+        sa.Column('num_posts', sa.Integer))
+
+    def setUp(self):
+        self.engine = sa.create_engine('sqlite://')
+        self.metadata.create_all(self.engine)
+        self.session = sa.orm.sessionmaker(bind=self.engine)()
+        patchers = [
+            patch('gs.group.list.store.queries.get_table',
+                  return_value=self.topicTable),
+            patch.dict('gs.group.list.store.queries._statements',
+                       clear=True)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    @staticmethod
+    def get_topic(postId, day, numPosts=1):
+        retval = {
+            'topic_id': 'x', 'group_id': 'ethel', 'site_id': 'example',
+            'original_subject': 'Violence', 'first_post_id': postId,
+            'last_post_id': postId,
+            'last_post_date': datetime(2015, 1, day, 12, 0),
+            'num_posts': numPosts}
+        return retval
+
+    def topic(self):
+        r = self.session.execute(self.topicTable.select())
+        retval = [tuple(row) for row in r]
+        return retval
+
+    def test_upsert_generic(self):
+        'Test that the posts are added to the topic'
+        q = TopicStorageQuery()
+        q.upsert(self.session, self.get_topic('a', 2))
+        q.upsert(self.session, self.get_topic('b', 3, 2))
+        r = self.topic()
+
+        self.assertEqual(1, len(r))
+        self.assertEqual(3, r[0][-1])
+        self.assertEqual('b', r[0][5])
+        self.assertEqual('a', r[0][4])
+
+    def test_upsert_generic_older(self):
+        'Test that an older post does not replace the last post'
+        q = TopicStorageQuery()
+        q.upsert(self.session, self.get_topic('a', 2))
+        q.upsert(self.session, self.get_topic('b', 1))
+        r = self.topic()
+
+        self.assertEqual(2, r[0][-1])
+        self.assertEqual('a', r[0][5])
+        self.assertEqual(datetime(2015, 1, 2, 12, 0), r[0][6])
+
+    def test_upsert_generic_cache(self):
+        'Test that the cached topic is kept up to date'
+        cache = LRUCache(4)
+        q = TopicStorageQuery(cache)
+        q.upsert(self.session, self.get_topic('a', 2))
+        q.upsert(self.session, self.get_topic('b', 3))
+        r = cache.get(('x', 'ethel', 'example'))
+
+        self.assertEqual(2, r['num_posts'])
+        self.assertEqual('b', r['last_post_id'])
+
+    @patch('gs.group.list.store.queries.execute')
+    @patch('gs.group.list.store.queries.supports_upsert')
+    def test_upsert_postgresql(self, supports_upsert, execute):
+        'Test that PostgreSQL adds the topic with one statement'
+        supports_upsert.return_value = True
+        cache = LRUCache(4)
+        cache.set(('x', 'ethel', 'example'), self.get_topic('a', 2))
+        q = TopicStorageQuery(cache)
+        topic = self.get_topic('b', 3)
+        q.upsert(self.session, topic)
+
+        self.assertEqual(1, execute.call_count)
+        s, params = execute.call_args[0][1:]
+        self.assertEqual(topic, params)
+        sql = '{0}'.format(s.compile(dialect=postgresql.dialect()))
+        self.assertIn('ON CONFLICT (topic_id, group_id, site_id) DO UPDATE',
+                      sql)
+        self.assertIsNone(cache.get(('x', 'ethel', 'example')))
+
+
+class FileMetadataStorageQueryTest(TestCase):
+    metadata = sa.MetaData()
+    tables = {
+        'post': sa.Table('post', metadata,
+                         sa.Column('post_id', sa.Unicode, primary_key=True),
+                         sa.Column('has_attachments', sa.Boolean)),
+        'file': sa.Table('file', metadata,
+                         sa.Column('file_id', sa.Unicode, primary_key=True),
+                         sa.Column('post_id', sa.Unicode)),
+    }
+
+    def setUp(self):
+        self.engine = sa.create_engine('sqlite://')
+        self.metadata.create_all(self.engine)
+        self.session = sa.orm.sessionmaker(bind=self.engine)()
+        self.session.execute(self.tables['post'].insert(), [
+            {'post_id': 'a', 'has_attachments': False},
+            {'post_id': 'b', 'has_attachments': True},
+            {'post_id': 'c', 'has_attachments': False}])
+        patchers = [
+            patch('gs.group.list.store.queries.get_table',
+                  side_effect=self.tables.get),
+            patch('gs.group.list.store.queries.getSession',
+                  return_value=self.session),
+            patch('gs.group.list.store.queries.mark_changed'),
+            patch.dict('gs.group.list.store.queries._statements',
+                       clear=True)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.metadata = [{'file_id': 'f1', 'post_id': 'a'},
+                         {'file_id': 'f2', 'post_id': 'a'},
+                         {'file_id': 'f3', 'post_id': 'b'}]
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def test_insert_metadata_generic(self):
+        'Test that the files are added, and the posts marked'
+        q = FileMetadataStorageQuery()
+        q.insert_metadata(self.metadata)
+
+        r = self.session.execute(sa.select(self.tables['file'].c.file_id))
+        self.assertEqual(['f1', 'f2', 'f3'], sorted(row[0] for row in r))
+        pt = self.tables['post']
+        r = self.session.execute(sa.select(pt.c.post_id,
+                                           pt.c.has_attachments))
+        self.assertEqual({'a': True, 'b': True, 'c': False}, dict(list(r)))
+
+    def test_insert_metadata_generic_marked(self):
+        'Test that the posts that are already marked are not updated'
+        results = []
+        sessionExecute = self.session.execute
+
+        def e(*args, **kwargs):
+            retval = sessionExecute(*args, **kwargs)
+            results.append(retval)
+            return retval
+        q = FileMetadataStorageQuery()
+        with patch.object(self.session, 'execute', side_effect=e):
+            q.insert_metadata(self.metadata)
+
+        # Only post a is updated, as post b is already marked
+        self.assertEqual(1, results[-1].rowcount)
+
+    @patch('gs.group.list.store.queries.supports_upsert')
+    def test_insert_metadata_postgresql(self, supports_upsert):
+        'Test that PostgreSQL adds the files and marks the posts at once'
+        supports_upsert.return_value = True
+        session = MagicMock()
+        with patch('gs.group.list.store.queries.getSession',
+                   return_value=session):
+            q = FileMetadataStorageQuery()
+            q.insert_metadata(self.metadata)
+
+        self.assertEqual(1, session.execute.call_count)
+        u = session.execute.call_args[0][0]
+        sql = '{0}'.format(u.compile(dialect=postgresql.dialect()))
+        self.assertTrue(sql.startswith(
+            'WITH new_files AS \n(INSERT INTO file'), sql)
+        self.assertIn('RETURNING file.post_id', sql)
+        self.assertIn('UPDATE post SET has_attachments', sql)
+        self.assertIn('SELECT new_files.post_id', sql)
+        self.assertIn('has_attachments IS NOT true', sql)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#
+# Copyright © 2015 OnlineGroups.net and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+############################################################################
+from __future__ import absolute_import, unicode_literals
+from mock import (MagicMock, patch)
+from unittest import TestCase
+from gs.group.list.store.reindex import ReindexQueue
+
+
+@patch('gs.group.list.store.reindex.log')
+@patch('gs.group.list.store.reindex.transaction')
+class ReindexQueueTest(TestCase):
+
+    def setUp(self):
+        self.storage = MagicMock()
+
+    def test_add(self, t, l):
+        'Test that adding a file does not reindex it'
+        q = ReindexQueue()
+        q.add(self.storage, 'a')
+
+        self.assertEqual(0, self.storage.get_file().reindex_file.call_count)
+        t.get().addBeforeCommitHook.assert_called_once_with(q.flush)
+
+    def test_flush(self, t, l):
+        'Test that the files are reindexed, once each'
+        q = ReindexQueue()
+        q.add(self.storage, 'a')
+        q.add(self.storage, 'b')
+        q.add(self.storage, 'a')
+        r = q.flush()
+
+        self.assertEqual(2, r)
+        self.assertEqual(2, self.storage.get_file().reindex_file.call_count)
+        self.assertEqual(1, t.get().addBeforeCommitHook.call_count)
+        self.assertEqual(0, q.flush())
+
+    def test_max_size(self, t, l):
+        'Test that a full queue is reindexed straight away'
+        q = ReindexQueue(maxSize=2)
+        q.add(self.storage, 'a')
+        q.add(self.storage, 'b')
+
+        self.assertEqual(2, self.storage.get_file().reindex_file.call_count)
+
+    def test_missing(self, t, l):
+        'Test that a file that has gone is skipped'
+        self.storage.get_file.return_value = None
+        q = ReindexQueue()
+        q.add(self.storage, 'a')
+        r = q.flush()
+
+        self.assertEqual(0, r)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#
+# Copyright © 2015 OnlineGroups.net and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+############################################################################
+from __future__ import absolute_import, unicode_literals
+from datetime import datetime
+from unittest import TestCase
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+from gs.group.list.store.statements import (
+    file_insert_marking_posts, post_insert_new, rebuild_topics,
+    topic_upsert, topic_values)
+
+
+class StatementsTest(TestCase):
+    metadata = sa.MetaData()
+    postTable = sa.Table(
+        'post', metadata,
+        sa.Column('post_id', sa.Unicode, primary_key=True),
+        sa.Column('topic_id', sa.Unicode),
+        sa.Column('group_id', sa.Unicode),
+        sa.Column('site_id', sa.Unicode),
+        sa.Column('subject', sa.Unicode),
+        sa.Column('date', sa.DateTime),
+        sa.Column('has_attachments', sa.Boolean))
+    topicTable = sa.Table(
+        'topic', metadata,
+        sa.Column('topic_id', sa.Unicode, primary_key=True),
+        sa.Column('group_id', sa.Unicode, primary_key=True),
+        sa.Column('site_id', sa.Unicode, primary_key=True),
+        sa.Column('original_subject', sa.Unicode),
+        sa.Column('first_post_id', sa.Unicode),
+        sa.Column('last_post_id', sa.Unicode),
+        sa.Column('last_post_date', sa.DateTime),
+        sa.Column('num_posts', sa.Integer))
+    fileTable = sa.Table(
+        'file', metadata,
+        sa.Column('file_id', sa.Unicode, primary_key=True),
+        sa.Column('post_id', sa.Unicode))
+
+    @staticmethod
+    def sql(statement):
+        retval = str(statement.compile(dialect=postgresql.dialect()))
+        return retval
+
+    def test_topic_values(self):
+        'Test that a post adds one post to its topic'
+        post = {'post_id': 'a', 'topic_id': 'x', 'group_id': 'ethel',
+                'site_id': 'example', 'subject': 'Violence',
+                'date': datetime(2015, 1, 1, 12, 0), 'body': 'Tonight'}
+        r = topic_values(post)
+
+        self.assertEqual(1, r['num_posts'])
+        self.assertEqual('a', r['first_post_id'])
+        self.assertEqual('a', r['last_post_id'])
+        self.assertEqual('Violence', r['original_subject'])
+        self.assertNotIn('body', r)
+
+    def test_post_insert_new(self):
+        r = self.sql(post_insert_new(self.postTable))
+        self.assertIn('ON CONFLICT (post_id) DO NOTHING', r)
+        self.assertIn('RETURNING post.post_id', r)
+
+    def test_topic_upsert(self):
+        r = self.sql(topic_upsert(self.topicTable))
+        self.assertIn('ON CONFLICT (topic_id, group_id, site_id)', r)
+        self.assertIn('topic.num_posts + excluded.num_posts', r)
+
+    def test_file_insert(self):
+        'Test that the files are added, and the posts marked, at once'
+        metadata = [{'file_id': 'f', 'post_id': 'a'}]
+        r = self.sql(file_insert_marking_posts(
+            self.fileTable, self.postTable, metadata))
+        self.assertTrue(r.startswith('WITH new_files AS'))
+        self.assertIn('INSERT INTO file', r)
+        self.assertIn('UPDATE post SET has_attachments', r)
+
+    def test_rebuild_topics(self):
+        topicScope = [self.topicTable.c.group_id == 'ethel']
+        postScope = [self.postTable.c.group_id == 'ethel']
+        i, u, d = rebuild_topics(self.postTable, self.topicTable,
+                                 postScope, topicScope)
+
+        self.assertIn('INSERT INTO topic', self.sql(i))
+        self.assertIn('GROUP BY', self.sql(u))
+        self.assertIn('first_post_id=', self.sql(u))
+        self.assertIn('original_subject=', self.sql(u))
+        self.assertIn('DELETE FROM topic', self.sql(d))
+
+    def test_rebuild_topics_generic(self):
+        'Test rebuilding the topics without UPDATE ... FROM'
+        topicScope = [self.topicTable.c.group_id == 'ethel']
+        postScope = [self.postTable.c.group_id == 'ethel']
+        i, u, d = rebuild_topics(self.postTable, self.topicTable,
+                                 postScope, topicScope, postgresql=False)
+
+        self.assertNotIn('GROUP BY', self.sql(u))
+        self.assertIn('count(p2.post_id)', self.sql(u))
+
+    def test_rebuild_topics_insert(self):
+        'Test that the topics that are added have their aggregates'
+        topicScope = [self.topicTable.c.group_id == 'ethel']
+        postScope = [self.postTable.c.group_id == 'ethel']
+        i, u, d = rebuild_topics(self.postTable, self.topicTable,
+                                 postScope, topicScope)
+        r = self.sql(i)
+
+        self.assertIn('count(p2.post_id)', r)
+        self.assertIn('max(p2.date)', r)
@@ -14,8 +14,38 @@
 ############################################################################
 from __future__ import absolute_import, unicode_literals
 from unittest import TestSuite, main as unittest_main
-from gs.group.list.store.tests.messagestore import EmailMessageStoreTest
-testCases = (EmailMessageStoreTest, )
+from gs.group.list.store.tests.activity import ActivityTest
+try:
+    from gs.group.list.store.tests.asyncstore import AsyncStorageTest
+except (ImportError, SyntaxError):  # Python 2, or SQLAlchemy < 1.4
+    AsyncStorageTest = None  # lint:ok
+from gs.group.list.store.tests.cache import LRUCacheTest
+from gs.group.list.store.tests.compression import CompressionTest
+from gs.group.list.store.tests.dates import DatesTest
+from gs.group.list.store.tests.importer import (ArchiveImporterTest,
+                                                CheckpointTest)
+from gs.group.list.store.tests.instrumentation import InstrumentationTest
+from gs.group.list.store.tests.manifest import AttachmentManifestTest
+from gs.group.list.store.tests.messagestore import (EmailMessageStoreTest,
+                                                    StoreManyTest)
+from gs.group.list.store.tests.payload import PayloadTest
+from gs.group.list.store.tests.queries import (
+    ArchiveQueryTest, BatchStorageQueryTest, EmailMessageStorageQueryTest,
+    FileMetadataStorageQueryTest, SearchIndexQueryTest, StatementCacheTest,
+    TopicStorageQueryTest)
+from gs.group.list.store.tests.reindex import ReindexQueueTest
+from gs.group.list.store.tests.statements import StatementsTest
+from gs.group.list.store.tests.writebehind import WriteBehindTest
+testCases = (EmailMessageStoreTest, StoreManyTest, BatchStorageQueryTest,
+             ReindexQueueTest, PayloadTest, InstrumentationTest,
+             AttachmentManifestTest, DatesTest, LRUCacheTest,
+             EmailMessageStorageQueryTest, CompressionTest, ActivityTest,
+             StatementsTest, WriteBehindTest, CheckpointTest,
+             ArchiveImporterTest, SearchIndexQueryTest, ArchiveQueryTest,
+             TopicStorageQueryTest, StatementCacheTest,
+             FileMetadataStorageQueryTest, )
+if AsyncStorageTest is not None:
+    testCases += (AsyncStorageTest, )
 
 
 def load_tests(loader, tests, pattern):
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#
+# Copyright © 2015 OnlineGroups.net and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+############################################################################
+from __future__ import absolute_import, unicode_literals
+from datetime import datetime
+from mock import (MagicMock, patch)
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+import sqlalchemy as sa
+import transaction
+from gs.group.list.store.dates import FixedOffset
+from gs.group.list.store.queries import DuplicateMessageError
+from gs.group.list.store.writebehind import PostSpool, WriteBehind
+
+
+class WriteBehindTest(TestCase):
+
+    def setUp(self):
+        self.tempDir = mkdtemp()
+        self.path = os.path.join(self.tempDir, 'spool.sqlite')
+
+    def tearDown(self):
+        rmtree(self.tempDir)
+
+    @staticmethod
+    def get_post(postId):
+        retval = {
+            'post_id': postId,
+            'topic_id': 'x',
+            'group_id': 'ethel',
+            'site_id': 'example',
+            'subject': 'Violence',
+            'date': datetime(2015, 1, 1, 12, 0, tzinfo=FixedOffset(780)), }
+        return retval
+
+    def test_spool(self):
+        'Test that the posts come out of the spool in order'
+        spool = PostSpool(self.path)
+        spool.append(self.get_post('a'), [])
+        spool.append(self.get_post('b'), [{'file_id': 'f', 'post_id': 'b'}])
+
+        self.assertEqual(2, len(spool))
+        self.assertIn('a', spool)
+        r = spool.entries()
+        self.assertEqual(['a', 'b'], [post['post_id'] for e, post, m in r])
+        self.assertEqual(self.get_post('a'), r[0][1])
+        self.assertEqual([{'file_id': 'f', 'post_id': 'b'}], r[1][2])
+
+        spool.remove([r[0][0]])
+        self.assertEqual(1, len(spool))
+        self.assertNotIn('a', spool)
+        spool.close()
+
+    def test_spool_duplicate(self):
+        spool = PostSpool(self.path)
+        spool.append(self.get_post('a'), [])
+        with self.assertRaises(DuplicateMessageError):
+            spool.append(self.get_post('a'), [])
+        spool.close()
+
+    def test_flush(self):
+        'Test that the posts are written in batches'
+        write = MagicMock(side_effect=lambda posts, metadata: len(posts))
+        writeBehind = WriteBehind(self.path, batchSize=2, write=write)
+        for postId in 'abc':
+            writeBehind.spool.append(self.get_post(postId), [])
+        r = writeBehind.flush()
+
+        self.assertEqual(3, r)
+        self.assertEqual(2, write.call_count)
+        self.assertEqual(0, len(writeBehind.spool))
+
+    def test_replay(self):
+        'Test that the posts left in the spool are written when restarted'
+        spool = PostSpool(self.path)
+        spool.append(self.get_post('a'), [])
+        spool.close()
+
+        write = MagicMock(return_value=1)
+        writeBehind = WriteBehind(self.path, write=write)
+        writeBehind.stop()
+        self.assertEqual(1, write.call_count)
+        self.assertNotIn('a', writeBehind)
+
+    def test_append_at_commit(self):
+        'Test that the post is added to the spool when it is committed'
+        write = MagicMock(side_effect=lambda posts, metadata: len(posts))
+        writeBehind = WriteBehind(self.path, write=write)
+        transaction.begin()
+        writeBehind.append_at_commit(self.get_post('a'), [])
+        self.assertNotIn('a', writeBehind)
+        transaction.commit()
+        transaction.begin()
+        writeBehind.append_at_commit(self.get_post('b'), [])
+        transaction.abort()
+        writeBehind.stop()
+
+        posts = [p['post_id'] for c in write.call_args_list for p in c[0][0]]
+        self.assertEqual(['a'], posts)
+        self.assertEqual(0, len(writeBehind.spool))
+
+    def test_append_at_commit_error(self):
+        'Test that the transaction fails if the post cannot be spooled'
+        writeBehind = WriteBehind(self.path, write=MagicMock())
+        writeBehind.spool.append(self.get_post('a'), [])
+        transaction.begin()
+        writeBehind.append_at_commit(self.get_post('a'), [])
+        with self.assertRaises(DuplicateMessageError):
+            transaction.commit()
+        transaction.abort()
+        writeBehind.spool.close()
+
+    def test_append_at_commit_abort(self):
+        'Test that the post is removed if the transaction fails after it'
+        writeBehind = WriteBehind(self.path, write=MagicMock())
+        failing = MagicMock()
+        failing.sortKey.return_value = '~~~'
+        failing.tpc_vote.side_effect = ValueError('Bung')
+        transaction.begin()
+        writeBehind.append_at_commit(self.get_post('a'), [])
+        transaction.get().join(failing)
+        with self.assertRaises(ValueError):
+            transaction.commit()
+        transaction.abort()
+
+        self.assertNotIn('a', writeBehind)
+        writeBehind.spool.close()
+
+    @patch('gs.group.list.store.writebehind.log')
+    def test_quarantine(self, l):
+        'Test that a post that cannot be written does not stop the rest'
+        def write(posts, metadata):
+            if 'b' in [p['post_id'] for p in posts]:
+                raise ValueError('Bung')
+            return len(posts)
+        writeBehind = WriteBehind(self.path, write=write)
+        for postId in 'abc':
+            writeBehind.spool.append(self.get_post(postId), [])
+        r = writeBehind.flush()
+
+        self.assertEqual(2, r)
+        self.assertEqual(0, len(writeBehind.spool))
+        q = writeBehind.spool.quarantined()
+        self.assertEqual(['b'], [post['post_id'] for e, post, m, err in q])
+        self.assertEqual('Bung', q[0][3])
+        writeBehind.spool.close()
+
+    def test_flush_error(self):
+        'Test that the posts stay in the spool if there is no database'
+        error = sa.exc.OperationalError('SELECT', {}, ValueError('Bung'))
+        writeBehind = WriteBehind(self.path, write=MagicMock(
+            side_effect=error))
+        writeBehind.spool.append(self.get_post('a'), [])
+
+        with self.assertRaises(sa.exc.OperationalError):
+            writeBehind.flush()
+        self.assertIn('a', writeBehind)
+        self.assertEqual([], writeBehind.spool.quarantined())
+        writeBehind.spool.close()
+
+    def test_start_left(self):
+        'Test that the flusher starts at once if posts were left behind'
+        spool = PostSpool(self.path)
+        spool.append(self.get_post('a'), [])
+        spool.close()
+
+        writeBehind = WriteBehind(self.path, write=MagicMock(return_value=1))
+        self.assertIsNotNone(writeBehind.thread)
+        writeBehind.stop()
+        self.assertNotIn('a', writeBehind)
+
+    def test_start_empty(self):
+        writeBehind = WriteBehind(self.path, write=MagicMock())
+        self.assertIsNone(writeBehind.thread)
+        writeBehind.spool.close()
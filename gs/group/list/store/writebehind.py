@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+############################################################################
+#
+# Copyright © 2015 OnlineGroups.net and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+############################################################################
+'''Write the rows for the posts behind the delivery of the messages
+
+With write-behind (the ``write_behind`` option of ``EmailMessageStore``)
+the rows for a post, and the metadata for its files, are appended to a
+local spool (a SQLite database) as the transaction that stored the
+message is committed. A flusher thread then writes the rows in the
+spool to the relational database in batches, so many posts share one
+transaction (and one commit) rather than one each. The rows are kept in
+the spool until they have been committed, so the posts that are in the
+spool when the process stops are written when it is next started. Posts
+that cannot be written are moved to a quarantine table in the spool, so
+they do not hold up the posts behind them.'''
+from __future__ import absolute_import, unicode_literals
+from logging import getLogger
+log = getLogger('gs.group.list.store.writebehind')
+import pickle
+import sqlite3
+from threading import Condition, Lock, Thread
+import sqlalchemy as sa
+import transaction
+from .queries import BatchStorageQuery, DuplicateMessageError
+
+#: The largest number of posts written in one transaction
+BATCH_SIZE = 100
+#: The longest time (in seconds) a post waits in the spool
+INTERVAL = 0.25
+#: The errors that mean the database could not be reached, rather than the
+#: post could not be written. The posts are kept in the spool, and written
+#: again later.
+UNAVAILABLE_ERRORS = (sa.exc.OperationalError, sa.exc.InterfaceError,
+                      sa.exc.DisconnectionError)
+
+
+def write_batch(posts, metadata):
+    '''Write the posts, their topics, and the metadata for their files in
+one transaction
+
+:param list posts: The values for the rows in the ``post`` table.
+:param list metadata: The rows for the ``file`` table.
+:returns: The number of posts that were written.
+:rtype: int
+
+Posts that are already in the database (because the process stopped after
+the batch was committed, but before it was removed from the spool) are
+skipped, so writing a batch again is harmless.'''
+    with transaction.manager:
+        batchQuery = BatchStorageQuery()
+        existing = batchQuery.existing_post_ids([p['post_id']
+                                                 for p in posts])
+        posts = [p for p in posts if p['post_id'] not in existing]
+        metadata = [m for m in metadata if m['post_id'] not in existing]
+        batchQuery.insert_posts(posts)
+        batchQuery.update_topics(batchQuery.aggregate_topics(posts))
+        batchQuery.insert_files(metadata)
+    retval = len(posts)
+    return retval
+
+
+class PostSpool(object):
+    '''The spool of posts that are waiting to be written
+
+:param str path: The path to the SQLite database for the spool.
+:param bool durable: If ``True`` every post is synchronised to the disk
+                     when it is appended, so no post is lost if the
+                     computer stops. If ``False`` the posts are only
+                     synchronised at checkpoints: a post is not lost if
+                     the process stops, but the last posts could be lost
+                     if the computer stops.'''
+
+    def __init__(self, path, durable=True):
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False,
+                                          isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        synchronous = 'FULL' if durable else 'NORMAL'
+        self.connection.execute('PRAGMA synchronous = ' + synchronous)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS spool ('
+            'entry_id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'post_id TEXT NOT NULL UNIQUE, '
+            'post BLOB NOT NULL, '
+            'metadata BLOB NOT NULL)')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS quarantine ('
+            'entry_id INTEGER PRIMARY KEY, '
+            'post_id TEXT NOT NULL, '
+            'post BLOB NOT NULL, '
+            'metadata BLOB NOT NULL, '
+            'error TEXT NOT NULL)')
+
+    def __len__(self):
+        with self.lock:
+            r = self.connection.execute('SELECT count(*) FROM spool')
+            retval = r.fetchone()[0]
+        return retval
+
+    def __contains__(self, postId):
+        with self.lock:
+            r = self.connection.execute(
+                'SELECT 1 FROM spool WHERE post_id = ?', (postId, ))
+            retval = r.fetchone() is not None
+        return retval
+
+    def append(self, post, metadata):
+        '''Add a post to the spool
+
+:param dict post: The values for the row in the ``post`` table.
+:param list metadata: The rows for the ``file`` table for the post.
+:returns: The identifier of the entry in the spool.
+:rtype: int
+:raises DuplicateMessageError: The post is already in the spool.'''
+        p = sqlite3.Binary(pickle.dumps(post, 2))
+        m = sqlite3.Binary(pickle.dumps(list(metadata), 2))
+        with self.lock:
+            try:
+                r = self.connection.execute(
+                    'INSERT INTO spool (post_id, post, metadata) '
+                    'VALUES (?, ?, ?)', (post['post_id'], p, m))
+            except sqlite3.IntegrityError:
+                msg = 'Post id "{0}" is already in the spool.'
+                raise DuplicateMessageError(msg.format(post['post_id']))
+        retval = r.lastrowid
+        return retval
+
+    def entries(self, limit=BATCH_SIZE):
+        '''The oldest posts in the spool
+
+:returns: The ``(entryId, post, metadata)`` of each post.
+:rtype: list'''
+        with self.lock:
+            r = self.connection.execute(
+                'SELECT entry_id, post, metadata FROM spool '
+                'ORDER BY entry_id LIMIT ?', (limit, ))
+            rows = r.fetchall()
+        retval = [(entryId, pickle.loads(bytes(p)), pickle.loads(bytes(m)))
+                  for entryId, p, m in rows]
+        return retval
+
+    def remove(self, entryIds):
+        '''Remove the posts that have been written'''
+        with self.lock:
+            self.connection.executemany(
+                'DELETE FROM spool WHERE entry_id = ?',
+                [(entryId, ) for entryId in entryIds])
+
+    def quarantine(self, entryId, error):
+        '''Move a post that could not be written to the quarantine table
+
+:param int entryId: The identifier of the entry in the spool.
+:param str error: Why the post could not be written.'''
+        with self.lock:
+            c = self.connection
+            c.execute('BEGIN IMMEDIATE')
+            try:
+                c.execute(
+                    'INSERT INTO quarantine '
+                    '(entry_id, post_id, post, metadata, error) '
+                    'SELECT entry_id, post_id, post, metadata, ? FROM spool '
+                    'WHERE entry_id = ?', (error, entryId))
+                c.execute('DELETE FROM spool WHERE entry_id = ?',
+                          (entryId, ))
+            except Exception:
+                c.execute('ROLLBACK')
+                raise
+            c.execute('COMMIT')
+
+    def quarantined(self):
+        '''The posts that could not be written
+
+:returns: The ``(entryId, post, metadata, error)`` of each post.
+:rtype: list'''
+        with self.lock:
+            r = self.connection.execute(
+                'SELECT entry_id, post, metadata, error FROM quarantine '
+                'ORDER BY entry_id')
+            rows = r.fetchall()
+        retval = [(entryId, pickle.loads(bytes(p)), pickle.loads(bytes(m)),
+                   error) for entryId, p, m, error in rows]
+        return retval
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class SpoolDataManager(object):
+    '''Add a post to the spool as the transaction that stored the message is
+committed
+
+:param writeBehind: The write-behind to add the post to.
+:type writeBehind: WriteBehind
+:param dict post: The values for the row in the ``post`` table.
+:param list metadata: The rows for the ``file`` table for the post.
+
+The post is appended when the transaction votes, after the other data
+managers (so the files are in the ZODB). If the post cannot be appended the
+vote fails, and the transaction is aborted, so the delivery of the message
+is retried. If the transaction is aborted after the vote then the post is
+removed from the spool.'''
+    transaction_manager = transaction.manager
+
+    def __init__(self, writeBehind, post, metadata):
+        self.writeBehind = writeBehind
+        self.post = post
+        self.metadata = metadata
+        self.entryId = None
+
+    def sortKey(self):
+        # After the other data managers, which vote first
+        retval = '~~gs.group.list.store.writebehind:{0}'.format(id(self))
+        return retval
+
+    def abort(self, txn):
+        pass
+
+    def tpc_begin(self, txn):
+        pass
+
+    def commit(self, txn):
+        pass
+
+    def tpc_vote(self, txn):
+        self.entryId = self.writeBehind.spool.append(self.post,
+                                                     self.metadata)
+
+    def tpc_finish(self, txn):
+        self.writeBehind.notify()
+
+    def tpc_abort(self, txn):
+        if self.entryId is not None:
+            self.writeBehind.spool.remove([self.entryId])
+            self.entryId = None
+
+    def savepoint(self):
+        # Nothing is written until the vote, so there is nothing to undo
+        retval = NullSavepoint()
+        return retval
+
+
+class NullSavepoint(object):
+    'The savepoint of a data manager that has nothing to roll back'
+
+    def rollback(self):
+        pass
+
+
+class WriteBehind(object):
+    '''Write the posts in a spool to the database in batches
+
+:param str path: The path to the SQLite database for the spool.
+:param int batchSize: The largest number of posts written in one
+                      transaction. A batch is written as soon as this many
+                      posts are in the spool.
+:param float interval: The longest time, in seconds, that a post waits in
+                       the spool.
+:param bool durable: Synchronise the spool for every post (see
+                     ``PostSpool``).
+:param write: The function that writes a batch (``write_batch``).
+
+The flusher thread is started when the first post is appended, or at once
+if posts were left in the spool by a previous process. If a batch cannot
+be written then its posts are written one at a time, and the posts that
+still fail are moved to the quarantine table of the spool (unless the
+database could not be reached, in which case the batch is written again
+later).'''
+
+    def __init__(self, path, batchSize=BATCH_SIZE, interval=INTERVAL,
+                 durable=True, write=write_batch):
+        self.spool = PostSpool(path, durable)
+        self.batchSize = batchSize
+        self.interval = interval
+        self.write = write
+        self.condition = Condition()
+        self.thread = None
+        self.stopping = False
+        if len(self.spool):
+            self.start()
+
+    def __contains__(self, postId):
+        return postId in self.spool
+
+    def append(self, post, metadata):
+        '''Add a post to the spool, to be written later
+
+:param dict post: The values for the row in the ``post`` table.
+:param list metadata: The rows for the ``file`` table for the post.
+:raises DuplicateMessageError: The post is already in the spool.'''
+        self.spool.append(post, metadata)
+        self.notify()
+
+    def append_at_commit(self, post, metadata):
+        '''Add a post to the spool as the current transaction is committed
+
+:param dict post: The values for the row in the ``post`` table.
+:param list metadata: The rows for the ``file`` table for the post.
+
+If the transaction is aborted then the post is not added (see
+``SpoolDataManager``).'''
+        dataManager = SpoolDataManager(self, post, metadata)
+        transaction.get().join(dataManager)
+
+    def notify(self):
+        'Start the flusher, or wake it if a batch is waiting'
+        with self.condition:
+            if self.thread is None:
+                self.start()
+            elif len(self.spool) >= self.batchSize:
+                self.condition.notify()
+
+    def start(self):
+        self.stopping = False
+        self.thread = Thread(target=self.run,
+                             name='gs.group.list.store.writebehind')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.stopping:
+            try:
+                self.flush()
+            except Exception:
+                m = 'Could not write the posts in the spool, trying again '\
+                    'in {0}s'
+                log.exception(m.format(self.interval))
+            with self.condition:
+                if (not self.stopping) and \
+                        (len(self.spool) < self.batchSize):
+                    self.condition.wait(self.interval)
+
+    def flush(self):
+        '''Write every post in the spool, in batches
+
+:returns: The number of posts that were written.
+:rtype: int'''
+        retval = 0
+        entries = self.spool.entries(self.batchSize)
+        while entries:
+            posts = [post for entryId, post, metadata in entries]
+            metadata = [m for entryId, post, metadata in entries
+                        for m in metadata]
+            try:
+                retval += self.write(posts, metadata)
+            except UNAVAILABLE_ERRORS:
+                raise
+            except Exception:
+                m = 'Could not write the batch of {0} posts, writing them '\
+                    'one at a time'
+                log.exception(m.format(len(entries)))
+                retval += self.write_each(entries)
+            else:
+                self.spool.remove([entryId for entryId, p, m in entries])
+            entries = self.spool.entries(self.batchSize)
+        if retval:
+            m = 'Wrote {0} posts from the spool'
+            log.info(m.format(retval))
+        return retval
+
+    def write_each(self, entries):
+        '''Write posts one at a time, quarantining those that fail
+
+:param list entries: The ``(entryId, post, metadata)`` of each post.
+:returns: The number of posts that were written.
+:rtype: int
+:raises UNAVAILABLE_ERRORS: The database could not be reached. The posts
+                            that were not written are left in the spool.'''
+        retval = 0
+        for entryId, post, metadata in entries:
+            try:
+                retval += self.write([post], metadata)
+            except UNAVAILABLE_ERRORS:
+                raise
+            except Exception as e:
+                m = 'Could not write the post {0}, moving it to the '\
+                    'quarantine: {1}'
+                log.error(m.format(post['post_id'], e))
+                self.spool.quarantine(entryId, '{0}'.format(e))
+            else:
+                self.spool.remove([entryId])
+        return retval
+
+    def stop(self):
+        '''Stop the flusher, and write the posts that are left'''
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
@@ -54,15 +54,22 @@ setup(
     zip_safe=False,
     install_requires=[
         'setuptools',
-        'SQLAlchemy',
+        'SQLAlchemy>=1.4',
+        'transaction',
         'zope.cachedescriptors',
+        'zope.component',
         'zope.datetime',
         'zope.interface',
         'zope.sqlalchemy',
         'gs.database',
         'gs.group.list.base', ],
+    extras_require={'async': ['SQLAlchemy>=1.4', 'asyncpg', ]},
     test_suite="gs.group.list.store.tests.test_all",
     tests_require=['mock', ],
     entry_points="""
     # -*- Entry points: -*-
+    [console_scripts]
+    gs_store_import = gs.group.list.store.importer:main
+    gs_store_recompute_topics = gs.group.list.store.importer:recompute_main
+    gs_store_index_search = gs.group.list.store.importer:index_main
     """,)